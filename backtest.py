@@ -2,6 +2,8 @@
 
 from __future__ import print_function
 import datetime
+import inspect
+import os.path
 import pprint
 
 try:
@@ -10,6 +12,12 @@ except ImportError:
     import queue
 
 import time
+import tracemalloc
+
+from checkpoint import save_checkpoint, load_checkpoint
+from event import EventQueue
+from journal import set_journal
+from tracer import set_tracer
 
 class Backtest(object):
     '''
@@ -18,7 +26,9 @@ class Backtest(object):
 
     def __init__(
         self, csv_dir, symbol_list, initial_capital, heartbeat, start_date, data_handler, execution_handler, portfolio, strategy,
-        external_data_dir, strategy_title
+        external_data_dir, strategy_title, journal=None, portfolio_params=None, execution_params=None,
+        strategy_params=None, data_params=None, checkpoint_path=None, checkpoint_every=1000, state_path=None,
+        event_log=None, tracer=None, memory_every=None, trace_memory=False
     ):
         '''
         Initializes the backtest with the path to the historical data, the list of symbols to be traded, the initial capital,
@@ -38,6 +48,26 @@ class Backtest(object):
         portfolio - (Class) Keeps track of portfolio current and prior positions.
         strategy - (Class) Generates signals based on market data.
         external_data_dir - A path to a csv file containing external data for the strategy
+        strategy_title - The title used for the output chart
+        journal - (Optional) An EventJournal that orders, signals and broker messages are recorded to
+        portfolio_params - (Optional) A dict of extra keyword arguments for the Portfolio, e.g. history_dir
+        execution_params - (Optional) A dict of extra keyword arguments for the ExecutionHandler
+        strategy_params - (Optional) A dict of extra keyword arguments for the Strategy, e.g. workers for a PerSymbolStrategy
+        data_params - (Optional) A dict of extra keyword arguments for the DataHandler, e.g. a Universe
+        checkpoint_path - (Optional) A file the state of the backtest is saved to, every checkpoint_every bars,
+                          so it can be continued with Backtest.resume() if the run dies
+        checkpoint_every - The number of bars between checkpoints
+        state_path - (Optional) A file the state of the backtest is saved to when it has gone through the data,
+                     with a fingerprint of the data, so Backtest.incremental() can go on from there once more
+                     bars have been appended
+        event_log - (Optional) A file every Market, Signal, Rebalance, Order and Fill event is recorded to, with
+                    the simulated datetime it was handled on, for event_log.replay() and event_log.diff_event_logs()
+        tracer - (Optional) A Tracer the event loop and the components trace their spans to
+        memory_every - (Optional) The number of bars between memory reports recorded to the journal (as 'MEMORY')
+        trace_memory - If True (or a number of frames), the allocations made during simulate_trading() are traced
+                       with tracemalloc and the lines of our code that grew the most are added to the run report.
+                       True keeps 10 frames per allocation, enough to find the line that called into pandas but
+                       several times slower than 1, which only finds the line inside pandas
         '''
 
         self.csv_dir = csv_dir
@@ -47,6 +77,15 @@ class Backtest(object):
         self.start_date = start_date
         self.external_data_dir = external_data_dir
         self.strategy_title = strategy_title
+        self.portfolio_params = portfolio_params or {}
+        self.execution_params = execution_params or {}
+        self.strategy_params = strategy_params or {}
+        self.data_params = data_params or {}
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.state_path = state_path
+        self.memory_every = memory_every
+        self.trace_memory = trace_memory
 
         # we are actually passing in the class names of the handlers we want
         self.data_handler_cls = data_handler
@@ -54,15 +93,34 @@ class Backtest(object):
         self.portfolio_cls = portfolio
         self.strategy_cls = strategy
 
-        self.events = queue.Queue()
+        self.events = EventQueue()
+
+        # the components pick the journal and tracer up when they are created, so they have to be set first
+        self.journal = set_journal(journal)
+        self.tracer = set_tracer(tracer)
 
         self.signals = 0
         self.orders = 0
         self.fills = 0
         self.num_strats = 1
+        self.iteration = 0
+        self.report = None
+        self.settings = self._settings(
+            csv_dir, symbol_list, initial_capital, heartbeat, start_date, data_handler, execution_handler, portfolio,
+            strategy, external_data_dir, strategy_title, journal, portfolio_params, execution_params, strategy_params,
+            data_params, checkpoint_path, checkpoint_every, state_path, event_log, tracer, memory_every, trace_memory
+        )
 
         self._generate_trading_instances()
 
+        self.event_log = None
+        if event_log is not None:
+            from event_log import EventLogWriter
+            self.event_log = EventLogWriter(
+                event_log, self.data_handler,
+                description = {'start_date': start_date, 'initial_capital': initial_capital}
+            )
+
     def _generate_trading_instances(self):
         '''
         Generates the trading instance objects from their class types
@@ -71,10 +129,16 @@ class Backtest(object):
         '''
 
         print('Creating DataHandler , Strategy, Portfolio and ExecutionHandler')
-        self.data_handler = self.data_handler_cls(self.events, self.csv_dir, self.symbol_list)
-        self.strategy = self.strategy_cls(self.data_handler, self.events, self.external_data_dir)
-        self.portfolio = self.portfolio_cls(self.data_handler, self.events, self.start_date, self.initial_capital)
-        self.execution_handler = self.execution_handler_cls(self.events)
+        self.data_handler = self.data_handler_cls(self.events, self.csv_dir, self.symbol_list, **self.data_params)
+        self.strategy = self.strategy_cls(self.data_handler, self.events, self.external_data_dir, **self.strategy_params)
+        self.portfolio = self.portfolio_cls(
+            self.data_handler, self.events, self.start_date, self.initial_capital, **self.portfolio_params
+        )
+        # execution handlers that model fills from the bars (volume, high/low) are given the DataHandler too
+        if getattr(self.execution_handler_cls, 'requires_bars', False):
+            self.execution_handler = self.execution_handler_cls(self.events, self.data_handler, **self.execution_params)
+        else:
+            self.execution_handler = self.execution_handler_cls(self.events, **self.execution_params)
 
     def _run_backtest(self):
         '''
@@ -83,48 +147,259 @@ class Backtest(object):
         For a...
             MarketEvent:  Strategy Object calculates new signals, Portfolio Object reindexes the time
             Signalevent:  Portfolio Object handles the signal and converts it to OrderEvents
+            RebalanceEvent: Portfolio Object converts the target weights into a batch of OrderEvents
             OrderEvent:   ExecutionHandler is sent the order and sends it to the broker
             FillEvent:    Portfolio updates according to the new positions
         '''
-        i = 0
+        tracer = self.tracer
         while True:
-            i += 1
-            # print(i)
-            # Update the market bars
-            if self.data_handler.continue_backtest == True:
-                self.data_handler.update_bars()
-            else:
-                break
+            self.iteration += 1
+            # print(self.iteration)
+            # only the bars the tracer samples are traced, on the others span() hands back a shared no-op span
+            tracer.sample()
+            with tracer.span('bar', 'loop', {'iteration': self.iteration}):
 
-            # Handle the events
-            while True:
-                try:
-                    event = self.events.get(False)
-                except queue.Empty:
-                    break
+                # Update the market bars
+                if self.data_handler.continue_backtest == True:
+                    with tracer.span('DataHandler.update_bars', 'data'):
+                        self.data_handler.update_bars()
                 else:
-                    if event is not None:
-                        if event.type == 'MARKET':
-                            self.strategy.calculate_signals(event)
-                            self.portfolio.update_timeindex(event)
+                    break
 
-                        elif event.type == 'SIGNAL':
-                            self.signals += 1
-                            self.portfolio.update_signal(event)
+                # Handle the events
+                while True:
+                    try:
+                        event = self.events.get(False)
+                    except queue.Empty:
+                        # give the execution handler a chance to fill the orders it is holding for this bar
+                        with tracer.span('ExecutionHandler.on_bar_end', 'execution'):
+                            self.execution_handler.on_bar_end()
+                        if self.events.empty():
+                            break
+                    else:
+                        if event is not None:
+                            if self.event_log is not None:
+                                self.event_log.record(event)
+                            if tracer.sampling:
+                                with tracer.span(event.type, 'event', self._trace_args(event)):
+                                    self._dispatch(event)
+                            else:
+                                self._dispatch(event)
 
-                        elif event.type == 'ORDER':
-                            self.orders += 1
-                            self.execution_handler.execute_order(event)
+                time.sleep(self.heartbeat)
 
-                        elif event.type == 'FILL':
-                            self.fills += 1
-                            self.portfolio.update_fill(event)
+                if self.checkpoint_path is not None and self.iteration % self.checkpoint_every == 0:
+                    with tracer.span('Backtest.save_checkpoint', 'loop'):
+                        self.save_checkpoint()
 
-            time.sleep(self.heartbeat)
+                if self.memory_every is not None and self.iteration % self.memory_every == 0:
+                    self.journal.info('MEMORY', iteration = self.iteration, report = self.memory_report())
 
-    def _output_performance(self):
+    def _dispatch(self, event):
+        '''
+        Hands an event to the components that handle it. Each call is a span of the tracer, which is a no-op
+        unless the bar is sampled
+        '''
+        span = self.tracer.span
+        if event.type == 'MARKET' and getattr(event, 'timeframe', None) is not None:
+            # a bar of a timeframe the strategy subscribed to closed
+            with span('Strategy.calculate_signals', 'strategy'):
+                self.strategy.calculate_signals(event)
+
+        elif event.type == 'MARKET':
+            with span('ExecutionHandler.on_market', 'execution'):
+                self.execution_handler.on_market(event)
+            with span('Strategy.calculate_signals', 'strategy'):
+                self.strategy.calculate_signals(event)
+            with span('Portfolio.update_timeindex', 'portfolio'):
+                self.portfolio.update_timeindex(event)
+
+        elif event.type == 'SIGNAL':
+            self.signals += 1
+            with span('Portfolio.update_signal', 'portfolio'):
+                self.portfolio.update_signal(event)
+
+        elif event.type == 'REBALANCE':
+            self.signals += 1
+            with span('Portfolio.update_rebalance', 'portfolio'):
+                self.portfolio.update_rebalance(event)
+
+        elif event.type == 'ORDER':
+            self.orders += 1
+            with span('ExecutionHandler.execute_order', 'execution'):
+                self.execution_handler.execute_order(event)
+
+        elif event.type == 'FILL':
+            self.fills += 1
+            with span('Portfolio.update_fill', 'portfolio'):
+                self.portfolio.update_fill(event)
+
+    @staticmethod
+    def _trace_args(event):
+        '''
+        Returns the args an event's span is shown with: the symbol of a signal, order or fill, the timeframe of
+        a resampled bar
         '''
-        Outputs the strategy performance from the backtest.
+        for name in ('symbol', 'timeframe'):
+            value = getattr(event, name, None)
+            if value is not None:
+                return {name: value}
+        return None
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # the components record to the restored journal and tracer
+        self.journal = set_journal(self.journal)
+        self.tracer = set_tracer(self.tracer)
+
+    @classmethod
+    def _settings(cls, *args, **kwargs):
+        '''
+        Returns a string identifying what a backtest constructed with these arguments simulates, leaving out the
+        ones that only change how it runs (heartbeat, journal, checkpoints, event log, tracer, memory reports).
+        Parameters without a stable repr (e.g. objects without their own __repr__) never compare equal, which just
+        means a full run
+        '''
+        arguments = inspect.signature(cls.__init__).bind(None, *args, **kwargs)
+        arguments.apply_defaults()
+        settings = []
+        for name, value in arguments.arguments.items():
+            if name in (
+                'self', 'heartbeat', 'journal', 'checkpoint_path', 'checkpoint_every', 'state_path', 'event_log',
+                'tracer', 'memory_every', 'trace_memory'
+            ):
+                continue
+            if isinstance(value, type):
+                value = '%s.%s' % (value.__module__, value.__name__)
+            elif isinstance(value, dict):
+                value = sorted(value.items())
+            settings.append((name, value))
+        return repr(settings)
+
+    @classmethod
+    def incremental(cls, *args, **kwargs):
+        '''
+        Takes the arguments of Backtest() and returns a backtest whose simulate_trading() only simulates the bars
+        appended to the data since the last run with the same settings: the state that run saved to state_path
+        is restored and its data handler extended. If there is no saved state, the settings differ or the data
+        was changed other than by appending bars, a new Backtest is returned, i.e. a full run. Either way the
+        state is saved again at the end of the run. A restored backtest records to the journal, tracer and event
+        log passed in, like a new one
+        '''
+        arguments = inspect.signature(cls.__init__).bind(None, *args, **kwargs).arguments
+        state_path = arguments.get('state_path')
+        if state_path is None:
+            raise ValueError('incremental() needs a state_path')
+
+        if os.path.exists(state_path):
+            try:
+                settings, fingerprint, backtest = load_checkpoint(state_path)
+            except Exception as e:
+                print('Not extending the saved backtest, it could not be loaded: %s' % e)
+            else:
+                if settings == cls._settings(*args, **kwargs) and backtest.data_handler.extend(fingerprint):
+                    for name in ('heartbeat', 'checkpoint_path', 'checkpoint_every', 'state_path'):
+                        if name in arguments:
+                            setattr(backtest, name, arguments[name])
+                    backtest._apply_outputs(
+                        arguments.get('journal'), arguments.get('tracer'), arguments.get('event_log')
+                    )
+                    return backtest
+                # the journal of the saved backtest was reopened when it was loaded
+                backtest.journal.close()
+        return cls(*args, **kwargs)
+
+    def _apply_outputs(self, journal, tracer, event_log):
+        '''
+        Makes a restored backtest record to the journal, tracer and event log passed to incremental() rather than
+        the ones it was saved with: the restored journal is closed, and the restored event log too unless it is
+        the same file, which then carries on where it left off
+        '''
+        self.journal.close()
+        restored, self.journal = self.journal, set_journal(journal)
+        self._replace_shared('journal', restored, self.journal)
+        # the restored tracer holds no spans and no files, so it is just dropped
+        restored, self.tracer = self.tracer, set_tracer(tracer)
+        self._replace_shared('tracer', restored, self.tracer)
+
+        if self.event_log is not None and self.event_log.path != event_log:
+            self.event_log.close()
+            self.event_log = None
+        if self.event_log is None and event_log is not None:
+            from event_log import EventLogWriter
+            self.event_log = EventLogWriter(
+                event_log, self.data_handler,
+                description = {'start_date': self.start_date, 'initial_capital': self.initial_capital}
+            )
+
+    def _replace_shared(self, name, old, new):
+        '''
+        Points the components' references to a shared object (the journal or the tracer) at another one
+        '''
+        components = (
+            self.data_handler, self.data_handler.universe, self.strategy, self.portfolio,
+            self.execution_handler
+        )
+        for component in components:
+            if component is not None and getattr(component, name, None) is old:
+                setattr(component, name, new)
+
+    def save_state(self, path=None):
+        '''
+        Saves the backtest together with the settings it was created with and a fingerprint of its data, for
+        incremental()
+
+        Parameters:
+        path - (Optional) The state file, defaults to state_path
+        '''
+        save_checkpoint((self.settings, self.data_handler.data_fingerprint(), self), path or self.state_path)
+
+    def save_checkpoint(self, path=None):
+        '''
+        Saves the state of the backtest between two bars: the data handler's position, the strategy, portfolio
+        and execution handler, and the pending events
+
+        Parameters:
+        path - (Optional) The checkpoint file, defaults to checkpoint_path
+        '''
+        save_checkpoint(self, path or self.checkpoint_path)
+
+    @classmethod
+    def resume(cls, path):
+        '''
+        Returns the backtest saved to a checkpoint; its simulate_trading() carries on from the bar after the
+        checkpoint, with the same results as a run that wasn't interrupted. The data files must be unchanged,
+        and the classes of the components importable as they were
+
+        Parameters:
+        path - The checkpoint file
+        '''
+        backtest = load_checkpoint(path)
+        if backtest.data_handler.data_changed:
+            raise ValueError('The data has changed since the checkpoint was saved')
+        return backtest
+
+    def memory_report(self):
+        '''
+        Returns estimates of the memory held by each component of the backtest, broken down by attribute (see
+        memory.memory_report()). Can be called during the run (e.g. from a strategy) and after it
+        '''
+        from memory import memory_report
+
+        components = [
+            ('data_handler', self.data_handler), ('strategy', self.strategy), ('portfolio', self.portfolio),
+            ('execution_handler', self.execution_handler), ('events', self.events), ('journal', self.journal),
+            ('tracer', self.tracer)
+        ]
+        if self.event_log is not None:
+            components.append(('event_log', self.event_log))
+        return memory_report(components)
+
+    def _output_performance(self, snapshot=None):
+        '''
+        Outputs the strategy performance from the backtest, and records it to the journal as a 'RUN_REPORT'
+        together with the memory report and, if snapshot (a tracemalloc.Snapshot taken when the run started)
+        is given, the allocations made since then
         '''
         self.portfolio.create_equity_curve_dataframe()
 
@@ -139,12 +414,58 @@ class Backtest(object):
         print('Orders: %s' % self.orders)
         print('Fills: %s' % self.fills)
 
+        print('Trade summary...')
+        trades = self.portfolio.blotter.summary()
+        pprint.pprint(trades)
+
         # print('Printing chart...')
         # self.portfolio.print_chart()
 
+        from memory import format_memory_report, tracemalloc_diff
+
+        # the allocations are compared before the memory report makes its own
+        allocations = None
+        if snapshot is not None:
+            # with a single frame per allocation there is no caller to put it down to
+            root = os.path.dirname(os.path.abspath(__file__)) if tracemalloc.get_traceback_limit() > 1 else None
+            allocations = tracemalloc_diff(snapshot, tracemalloc.take_snapshot(), root = root)
+
+        self.report = {
+            'stats': stats, 'signals': self.signals, 'orders': self.orders, 'fills': self.fills, 'trades': trades,
+            'memory': self.memory_report()
+        }
+        if allocations is not None:
+            self.report['tracemalloc'] = allocations
+
+        print('Memory...')
+        print(format_memory_report(self.report['memory'], self.report.get('tracemalloc')))
+        self.journal.info('RUN_REPORT', **self.report)
+
     def simulate_trading(self):
         '''
         Runs the backtest and outputs performance
         '''
-        self._run_backtest()
-        self._output_performance()
+        snapshot = None
+        started_tracing = bool(self.trace_memory) and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(10 if self.trace_memory is True else self.trace_memory)
+        try:
+            if self.trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+            self._run_backtest()
+            if self.state_path is not None:
+                self.save_state()
+            self._output_performance(snapshot)
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+            # strategies that evaluate symbols on a thread pool shut it down
+            if hasattr(self.strategy, 'close'):
+                self.strategy.close()
+            # the IB handler sends the orders it still has queued and disconnects
+            if hasattr(self.execution_handler, 'close'):
+                self.execution_handler.close()
+            if self.event_log is not None:
+                self.event_log.close()
+            self.tracer.close()
+            self.journal.close()
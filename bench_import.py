@@ -0,0 +1,103 @@
+# bench_import.py
+
+# Measures the cold-start (import) latency of the backtest entry points. Every target is imported in a fresh
+# interpreter so nothing is shared through sys.modules, and the bare interpreter startup time is subtracted so
+# the numbers only reflect what our own import graph costs.
+#
+# Usage:
+#   python bench_import.py                  # 10 runs per target
+#   python bench_import.py -n 25 --top 15   # more runs, plus the 15 slowest modules from -X importtime
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# (label, statement) pairs - the statement is exactly what a short job runs before it reads any data
+TARGETS = [
+    ('Backtest', 'from backtest import Backtest'),
+    ('strategy_mac', 'import strategy_mac'),
+    ('strategy_biotechapproval', 'import strategy_biotechapproval'),
+    ('strategy_biotech_opt', 'import strategy_biotech_opt'),
+]
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def time_statement(statement, runs):
+    '''
+    Runs the statement in a fresh interpreter `runs` times and returns the list of wall clock times in seconds.
+    A failed import raises a RuntimeError with the child's stderr so a broken entry point isn't reported as "fast"
+
+    Parameters:
+    statement - The python statement to execute (normally an import)
+    runs - The number of fresh interpreters to launch
+    '''
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, '-c', statement], cwd = REPO_DIR,
+            stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True
+        )
+        timings.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            raise RuntimeError('%r failed:\n%s' % (statement, proc.stderr))
+    return timings
+
+
+def slowest_imports(statement, top):
+    '''
+    Uses `python -X importtime` to list the `top` modules with the largest cumulative import time
+
+    Returns a list of (cumulative microseconds, module name) tuples, slowest first
+    '''
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement], cwd = REPO_DIR,
+        stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        # lines look like: "import time:       self [us] |  cumulative | imported package"
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        rows.append((int(parts[1]), parts[2].strip()))
+    rows.sort(reverse = True)
+    return rows[:top]
+
+
+def median(values):
+    ordered = sorted(values)
+    mid = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[mid]
+    return (ordered[mid - 1] + ordered[mid]) / 2.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = 'Cold-start import benchmark for the backtest entry points')
+    parser.add_argument('-n', '--runs', type = int, default = 10, help = 'fresh interpreters per target')
+    parser.add_argument('--top', type = int, default = 0, help = 'also list the N slowest modules per target')
+    args = parser.parse_args(argv)
+
+    baseline = median(time_statement('pass', args.runs))
+    print('Interpreter startup (subtracted): %.1f ms' % (baseline * 1000.0))
+    print('%-26s %10s %10s %10s' % ('target', 'min ms', 'median ms', 'max ms'))
+
+    for label, statement in TARGETS:
+        timings = [t - baseline for t in time_statement(statement, args.runs)]
+        print('%-26s %10.1f %10.1f %10.1f' % (
+            label, min(timings) * 1000.0, median(timings) * 1000.0, max(timings) * 1000.0
+        ))
+        for cumulative_us, module in slowest_imports(statement, args.top):
+            print('    %10.1f ms  %s' % (cumulative_us / 1000.0, module))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# blotter.py
+
+# The trade blotter keeps a trade-level record of a run. Every fill is appended to a set of compact columns and
+# matched first-in-first-out against the open lots of its symbol, so that closed round trips (entry and exit
+# price, holding period, P&L and commission) are known as soon as they happen. Summaries are computed from the
+# columns with NumPy/pandas rather than by looping over the trades.
+
+from __future__ import print_function
+
+from array import array
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+
+class TradeBlotter(object):
+    '''
+    An append-only, columnar store of fills and the round trips they form.
+
+    Quantities are signed: positive for a buy, negative for a sell. A round trip's direction is 1 when a long
+    position was opened and closed, -1 for a short. Commissions are allocated to round trips pro rata by quantity,
+    so partial closes carry their share of both the entry and the exit commission.
+    '''
+
+    def __init__(self):
+        '''
+        Initializes empty fill and round trip columns
+        '''
+        # symbols are stored as small integer codes into self.symbols
+        self.symbols = []
+        self._symbol_codes = {}
+
+        # fills
+        self.fill_time = array('q') # nanoseconds since the epoch
+        self.fill_symbol = array('i')
+        self.fill_quantity = array('d')
+        self.fill_price = array('d')
+        self.fill_commission = array('d')
+
+        # round trips
+        self.rt_symbol = array('i')
+        self.rt_direction = array('b')
+        self.rt_quantity = array('d')
+        self.rt_entry_time = array('q')
+        self.rt_exit_time = array('q')
+        self.rt_entry_price = array('d')
+        self.rt_exit_price = array('d')
+        self.rt_commission = array('d')
+        self.rt_pnl = array('d')
+
+        # open lots per symbol code, oldest first: [signed quantity, price, time, commission per share]
+        self._open_lots = {}
+
+    def _symbol_code(self, symbol):
+        code = self._symbol_codes.get(symbol)
+        if code is None:
+            code = len(self.symbols)
+            self._symbol_codes[symbol] = code
+            self.symbols.append(symbol)
+            self._open_lots[code] = deque()
+        return code
+
+    def record_fill(self, timeindex, symbol, quantity, price, commission):
+        '''
+        Appends a fill and closes as much of the symbol's open lots as it offsets
+
+        Parameters:
+        timeindex - The bar datetime of the fill
+        symbol - The instrument that was traded
+        quantity - The signed quantity (positive for BUY, negative for SELL)
+        price - The price per share the fill was valued at
+        commission - The commission charged for the fill
+        '''
+        if quantity == 0:
+            return
+        code = self._symbol_code(symbol)
+        ts = pd.Timestamp(timeindex).value
+
+        self.fill_time.append(ts)
+        self.fill_symbol.append(code)
+        self.fill_quantity.append(quantity)
+        self.fill_price.append(price)
+        self.fill_commission.append(commission)
+
+        commission_per_share = commission / abs(quantity)
+        lots = self._open_lots[code]
+        remaining = quantity
+
+        # close the oldest lots of the opposite sign first
+        while remaining != 0 and lots and (lots[0][0] > 0) != (remaining > 0):
+            lot = lots[0]
+            direction = 1 if lot[0] > 0 else -1
+            matched = min(abs(remaining), abs(lot[0]))
+            rt_commission = (lot[3] + commission_per_share) * matched
+
+            self.rt_symbol.append(code)
+            self.rt_direction.append(direction)
+            self.rt_quantity.append(matched)
+            self.rt_entry_time.append(lot[2])
+            self.rt_exit_time.append(ts)
+            self.rt_entry_price.append(lot[1])
+            self.rt_exit_price.append(price)
+            self.rt_commission.append(rt_commission)
+            self.rt_pnl.append(direction * matched * (price - lot[1]) - rt_commission)
+
+            lot[0] -= direction * matched
+            remaining += direction * matched
+            if lot[0] == 0:
+                lots.popleft()
+
+        # whatever is left opens (or adds to) a position
+        if remaining != 0:
+            lots.append([remaining, price, ts, commission_per_share])
+
+    def fills_frame(self):
+        '''
+        Returns the fills as a DataFrame
+        '''
+        return pd.DataFrame({
+            'datetime': pd.to_datetime(np.frombuffer(self.fill_time, dtype = np.int64)),
+            'symbol': self._decode(self.fill_symbol),
+            'quantity': np.frombuffer(self.fill_quantity),
+            'price': np.frombuffer(self.fill_price),
+            'commission': np.frombuffer(self.fill_commission),
+        })
+
+    def round_trips_frame(self):
+        '''
+        Returns the closed round trips as a DataFrame, including the holding period of each
+        '''
+        entry = pd.to_datetime(np.frombuffer(self.rt_entry_time, dtype = np.int64))
+        exit = pd.to_datetime(np.frombuffer(self.rt_exit_time, dtype = np.int64))
+        return pd.DataFrame({
+            'symbol': self._decode(self.rt_symbol),
+            'direction': np.frombuffer(self.rt_direction, dtype = np.int8),
+            'quantity': np.frombuffer(self.rt_quantity),
+            'entry_datetime': entry,
+            'exit_datetime': exit,
+            'holding_period': exit - entry,
+            'entry_price': np.frombuffer(self.rt_entry_price),
+            'exit_price': np.frombuffer(self.rt_exit_price),
+            'commission': np.frombuffer(self.rt_commission),
+            'pnl': np.frombuffer(self.rt_pnl),
+        })
+
+    def _decode(self, codes):
+        return np.array(self.symbols, dtype = object)[np.frombuffer(codes, dtype = np.int32)]
+
+    def pnl_by_symbol(self):
+        '''
+        Returns a pandas Series of realised round trip P&L per symbol
+        '''
+        pnl = np.bincount(
+            np.frombuffer(self.rt_symbol, dtype = np.int32), weights = np.frombuffer(self.rt_pnl),
+            minlength = len(self.symbols)
+        )
+        return pd.Series(pnl, index = self.symbols, name = 'pnl')
+
+    def summary(self):
+        '''
+        Creates a dict of summary statistics over the closed round trips
+        '''
+        pnl = np.frombuffer(self.rt_pnl)
+        n = len(pnl)
+        if n == 0:
+            return {'Fills': len(self.fill_time), 'Round Trips': 0}
+
+        holding = np.frombuffer(self.rt_exit_time, dtype = np.int64) - np.frombuffer(self.rt_entry_time, dtype = np.int64)
+        wins = pnl[pnl > 0]
+        losses = pnl[pnl < 0]
+
+        return {
+            'Fills': len(self.fill_time),
+            'Round Trips': n,
+            'Win Rate': '%0.2f%%' % (100.0 * len(wins) / n),
+            'Total P&L': '%0.2f' % pnl.sum(),
+            'Average P&L': '%0.2f' % pnl.mean(),
+            'Profit Factor': '%0.2f' % (wins.sum() / -losses.sum()) if len(losses) else 'inf',
+            'Average Holding Period': str(pd.Timedelta(int(holding.mean()))),
+            'Total Commission': '%0.2f' % np.frombuffer(self.rt_commission).sum(),
+            'P&L by Symbol': dict((s, round(v, 2)) for s, v in self.pnl_by_symbol().items()),
+        }
@@ -0,0 +1,111 @@
+# checkpoint.py
+
+# Snapshots of a running backtest, so a long run that dies can be resumed instead of started over. The whole
+# object graph of the Backtest is pickled; the components that hold things pickle can't (or shouldn't) copy
+# define __getstate__/__setstate__: the data handler keeps its position in the data rather than the data, the
+# event queue its pending events, the journal its file and settings, and thread pools are recreated.
+#
+# A checkpoint is written to a temporary file that replaces the previous one in a single rename, so a crash
+# while writing leaves the last complete checkpoint in place.
+#
+# What only grows during a run (the portfolio's history, the recorded indicator series) is kept out of the
+# pickle: the objects holding it write the part added since the last checkpoint as a segment file, in a
+# directory next to the checkpoint, and pickle the names of their segments. Segments are never rewritten, so a
+# checkpoint costs what changed since the previous one rather than the whole history. Segments no checkpoint
+# refers to any more (e.g. written after the checkpoint a run was resumed from) are removed.
+
+from __future__ import print_function
+
+import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+_saving = None # (segment directory, names of the segments referred to) while save_checkpoint() pickles
+_loading = None # the segment directory while load_checkpoint() unpickles
+
+
+def _segment_dir(path):
+    return path + '.segments'
+
+
+def _write(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, protocol = pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def save_checkpoint(obj, path):
+    '''
+    Atomically pickles obj to path, with the segments its objects save next to it
+
+    Parameters:
+    obj - The object to save, e.g. a Backtest
+    path - The checkpoint file
+    '''
+    global _saving
+    directory = _segment_dir(path)
+    _saving = (directory, set())
+    try:
+        _write(obj, path)
+    finally:
+        directory, kept = _saving
+        _saving = None
+
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name not in kept:
+                os.remove(os.path.join(directory, name))
+
+
+def load_checkpoint(path):
+    '''
+    Returns the object saved to path by save_checkpoint()
+    '''
+    global _loading
+    _loading = _segment_dir(path)
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    finally:
+        _loading = None
+
+
+def saving_segments():
+    '''
+    Returns the segment directory of the checkpoint being saved, None unless called from the __getstate__ of an
+    object save_checkpoint() is pickling. The segments of a directory are named by their objects, which must
+    keep a name for every segment they write
+    '''
+    return None if _saving is None else _saving[0]
+
+
+def save_segment(name, obj):
+    '''
+    Pickles obj to a new segment of the checkpoint being saved. Returns the name
+    '''
+    directory = _saving[0]
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    _write(obj, os.path.join(directory, name))
+    return name
+
+
+def keep_segments(names):
+    '''
+    Marks the segments (written by this or an earlier checkpoint) the checkpoint being saved refers to
+    '''
+    _saving[1].update(names)
+
+
+def load_segment(name):
+    '''
+    Returns the object saved to a segment of the checkpoint being loaded
+    '''
+    with open(os.path.join(_loading, name), 'rb') as f:
+        return pickle.load(f)
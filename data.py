@@ -4,12 +4,25 @@ from __future__ import print_function
 
 from abc import ABCMeta, abstractmethod
 import datetime
+import hashlib
 import os, os.path
 
 import numpy as np
 import pandas as pd
 
 from event import MarketEvent
+from universe import listing_windows
+from resample import ResampledBars, Timeframe
+
+def _rows_of_runs(firsts, lengths):
+    '''
+    Returns the rows of runs of consecutive rows given by their first rows and lengths
+    '''
+    firsts = np.asarray(firsts, dtype = np.int64)
+    lengths = np.asarray(lengths, dtype = np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum(), dtype = np.int64) + np.repeat(firsts - offsets, lengths)
+
 
 class DataHandler(object):
     '''
@@ -24,6 +37,25 @@ class DataHandler(object):
     # only inheritants of the class (subclasses) can be instantiated
     __metaclass__ = ABCMeta
 
+    def __init__(self):
+        '''
+        Sets the defaults of the state the DataHandler's methods keep, which subclasses call before setting up
+        their data. A handler keeps its bars in matrices over a timeline if it sets them with _build_matrices()
+        '''
+        self.universe = None
+        self.bars_pushed = 0 # the number of times update_bars() has pushed bars
+        self.history_rewritten = False # set when a restored handler's data no longer has the bars it pushed
+
+        self._bar_listeners = []
+        self._timeframes = [] # the subscribed ResampledBars
+        self._indicator_cache_owner = None # the token IndicatorBanks tag the series they record with
+        self._data_versions = {}
+        self._pushed = {} # symbol -> the runs of timeline rows pushed, as of the last checkpoint
+
+        self.timeline = None
+        self._cursor = 0
+        self._matrices = None
+
     @abstractmethod # lets Python know that the method will be overridden in subclasses
     def get_latest_bar(self, symbol, N=1):
         '''
@@ -66,6 +98,367 @@ class DataHandler(object):
         '''
         raise NotImplementedError('Should implement update_bars()')
 
+    def add_bar_listener(self, listener):
+        '''
+        Registers a callable that is called as listener(symbols) every time update_bars() has pushed new bars,
+        before the MarketEvent is put on the queue, so e.g. indicators are up to date when strategies see the event
+
+        Parameters:
+        listener - The callable. symbols is the list of the symbols that got a new bar
+        '''
+        self._bar_listeners.append(listener)
+
+    def remove_bar_listener(self, listener):
+        '''
+        Unregisters a callable added with add_bar_listener()
+        '''
+        if listener in self._bar_listeners:
+            self._bar_listeners.remove(listener)
+
+    def _notify_bar_listeners(self, symbols):
+        '''
+        Calls the registered bar listeners with the symbols that got a new bar
+        '''
+        self.bars_pushed += 1
+        for listener in self._bar_listeners:
+            listener(symbols)
+
+    def subscribe(self, timeframe, fields = None):
+        '''
+        Starts building bars of a longer timeframe from the handler's bars, e.g. hourly or daily bars from
+        minute data. From then on a MarketEvent with event.timeframe set to the timeframe's name is put on the
+        queue, after the handler's own MarketEvent, whenever one of its bars closes
+
+        Parameters:
+        timeframe - A Timeframe or its spec, e.g. '5min', '1h', '1D' or '1W'
+        fields - (Optional) The fields to aggregate, by default every numeric field
+
+        Returns:
+        The ResampledBars of the timeframe (shared by everything subscribed to the same one)
+        '''
+        if not isinstance(timeframe, Timeframe):
+            timeframe = Timeframe(timeframe)
+        for resampled in self._timeframes:
+            if resampled.timeframe == timeframe:
+                return resampled
+
+        if fields is None:
+            fields = list(self._matrices or {})
+        resampled = ResampledBars(timeframe, self.symbol_list, fields)
+        resampled.cursor = self._cursor
+        self._timeframes.append(resampled)
+        return resampled
+
+    def timeframe(self, name):
+        '''
+        Returns the ResampledBars subscribed to under name (e.g. an event's timeframe)
+        '''
+        timeframe = name if isinstance(name, Timeframe) else Timeframe(name)
+        for resampled in self._timeframes:
+            if resampled.timeframe == timeframe:
+                return resampled
+        raise KeyError('Not subscribed to the %s timeframe' % timeframe.name)
+
+    def _update_timeframes(self):
+        '''
+        Folds the bar just pushed into the subscribed timeframes, putting a MarketEvent for each one whose bar
+        it closes. The next date of the timeline tells whether the bar is the last of its period
+        '''
+        for resampled in self._timeframes:
+            if resampled.cursor == self._cursor:
+                continue # no new bar, e.g. once the data is exhausted
+            resampled.cursor = self._cursor
+
+            rows = np.vstack([self.get_latest_bar_array(field) for field in resampled.fields])
+            next_dt = self.timeline[self._cursor] if self._cursor < len(self.timeline) else None
+            if resampled.update(self.timeline[self._cursor - 1], rows, next_dt):
+                self.events.put(MarketEvent(resampled.name))
+
+    def __getstate__(self):
+        '''
+        Checkpoints the handler without its data, which is read from the files again on restore: the bars
+        pushed so far are kept as row numbers of the timeline. Only handlers with a timeline can be checkpointed
+        '''
+        if self.timeline is None:
+            raise TypeError("%s can't be checkpointed" % type(self).__name__)
+        state = self.__dict__.copy()
+        for key in ('symbol_data', '_frames', '_matrices', 'timeline', '_pushed'):
+            state.pop(key, None)
+        state['latest_symbol_data'] = self._pushed_runs()
+        # the last bar pushed, to check the reloaded data against
+        state['_last_bar'] = (
+            self.timeline[self._cursor - 1] if self._cursor else None,
+            dict((f, m[self._cursor - 1].copy()) for f, m in self._matrices.items()) if self._cursor else {}
+        )
+        return state
+
+    def __setstate__(self, state):
+        '''
+        Reloads the data. If the files have changed since the checkpoint, data_changed is set; if the bars
+        already pushed aren't in the new data as they were, history_rewritten is set too and the handler can't
+        go on
+        '''
+        runs = state.pop('latest_symbol_data')
+        last_dt, last_values = state.pop('_last_bar')
+        self.__dict__.update(state)
+        rows = dict((s, _rows_of_runs(firsts, lengths)) for s, (firsts, lengths) in runs.items())
+        self._pushed = dict((s, (list(firsts), list(lengths), len(rows[s]))) for s, (firsts, lengths) in runs.items())
+        versions, cursor, universe = self._data_versions, self._cursor, self.universe
+
+        # reload the data, keeping the Universe out of it as binding would reset it
+        self.universe = None
+        self.symbol_data = {}
+        self.latest_symbol_data = dict((s, []) for s in self.symbol_list)
+        self._open_convert_csv_files()
+        self.universe = universe
+        self._cursor = cursor
+
+        self.data_changed = self._data_versions != versions
+        self.history_rewritten = False
+        if cursor:
+            self.history_rewritten = (
+                cursor > len(self.timeline) or self.timeline[cursor - 1] != last_dt
+                or self.timeline.searchsorted(last_dt, side = 'right') != cursor
+                or any(
+                    f not in self._matrices or not np.array_equal(self._matrices[f][cursor - 1], v, equal_nan = True)
+                    for f, v in last_values.items()
+                )
+            )
+        if self.history_rewritten:
+            return
+
+        for s in self.symbol_list:
+            frame = self._frames[s]
+            self.symbol_data[s] = frame.iloc[cursor:].iterrows()
+            self.latest_symbol_data[s] = list(frame.iloc[rows[s]].iterrows())
+
+    def _pushed_runs(self):
+        '''
+        Returns symbol -> (first rows, lengths) of the runs of consecutive timeline rows of the bars pushed so
+        far, which is what a checkpoint keeps of them. The runs of the last checkpoint are only extended with the
+        bars pushed since, so a checkpoint doesn't cost the whole history
+        '''
+        pushed = self._pushed
+        runs = {}
+        for s, bars in self.latest_symbol_data.items():
+            firsts, lengths, n = pushed.get(s, ([], [], 0))
+            if len(bars) > n:
+                rows = self.timeline.get_indexer(pd.DatetimeIndex([bar[0] for bar in bars[n:]]))
+                starts = np.concatenate(([0], np.flatnonzero(np.diff(rows) != 1) + 1))
+                firsts, lengths = list(firsts), list(lengths)
+                for first, length in zip(rows[starts], np.diff(np.append(starts, len(rows)))):
+                    if lengths and firsts[-1] + lengths[-1] == first:
+                        lengths[-1] += int(length)
+                    else:
+                        firsts.append(int(first))
+                        lengths.append(int(length))
+                pushed[s] = (firsts, lengths, len(bars))
+            runs[s] = (firsts, lengths)
+        return runs
+
+    def data_fingerprint(self, previous = None):
+        '''
+        Returns a dict of symbol -> (size, sha1 of the contents) of the files the bars are read from. Given a
+        previous fingerprint, only as many bytes of each file as it had are hashed, so the result is equal to
+        it if the files have only been appended to since
+        '''
+        if not hasattr(self, '_data_path'):
+            raise TypeError("%s doesn't read its bars from files" % type(self).__name__)
+        fingerprint = {}
+        for s in self.symbol_list:
+            size = None if previous is None else previous.get(s, (0, None))[0]
+            digest = hashlib.sha1()
+            n = 0
+            with open(self._data_path(s), 'rb') as f:
+                while size is None or n < size:
+                    block = f.read(1 << 20 if size is None else min(1 << 20, size - n))
+                    if not block:
+                        break
+                    digest.update(block)
+                    n += len(block)
+            fingerprint[s] = (n, digest.hexdigest())
+        return fingerprint
+
+    def extend(self, fingerprint):
+        '''
+        Lets a handler restored from the saved state of a finished backtest go on with the bars that have been
+        appended to its files since, so only those are simulated
+
+        Parameters:
+        fingerprint - The data_fingerprint() taken when the state was saved
+
+        Returns:
+        False if the data was changed other than by appending bars, or the components listening to the bars
+        can't be extended, in which case the backtest has to be run again from the start
+        '''
+        if self.history_rewritten or self.data_fingerprint(fingerprint) != fingerprint:
+            return False
+        for listener in self._bar_listeners:
+            owner = getattr(listener, '__self__', None)
+            if owner is not None and hasattr(owner, 'extendable') and not owner.extendable():
+                return False
+
+        if self._cursor < len(self.timeline):
+            # a timeframe bar that was closed because the data ended may go on in the new bars
+            for resampled in self._timeframes:
+                if resampled.closed_by_end and \
+                        resampled.timeframe.bucket(self.timeline[self._cursor]) == resampled.datetimes[-1].value:
+                    return False
+
+        if self.universe is not None:
+            self.universe.relist(self.listings)
+        self.continue_backtest = self._cursor < len(self.timeline)
+        self.data_changed = False
+        return True
+
+    def _build_matrices(self, frames, timeline):
+        '''
+        Keeps the numeric columns of the symbols' (aligned) DataFrames as (dates x symbols) matrices, so the
+        cross-sectional accessors below are array slices. _cursor is the number of dates pushed so far
+
+        Parameters:
+        frames - A dict of symbol -> DataFrame, all indexed by timeline
+        timeline - The dates the bars are pushed for
+        '''
+        self.timeline = timeline
+        self._cursor = 0
+        self._matrices = {}
+        if not self.symbol_list:
+            return
+        for field in frames[self.symbol_list[0]].columns:
+            try:
+                matrix = np.column_stack([frames[s][field].values for s in self.symbol_list]).astype(np.float64)
+            except (ValueError, TypeError):
+                continue # not a numeric field
+            matrix.flags.writeable = False
+            self._matrices[field] = matrix
+
+    def get_latest_bar_array(self, val_type):
+        '''
+        Returns the latest val_type value of every symbol of symbol_list as a numpy array (NaN before the
+        first bar, and for the inactive symbols of a handler with a Universe). Handlers that keep matrices
+        return a read-only view
+        '''
+        matrices = self._matrices
+        if matrices is not None and val_type in matrices:
+            if self._cursor == 0:
+                return np.full(len(self.symbol_list), np.nan)
+            latest = matrices[val_type][self._cursor - 1]
+            if self.universe is not None:
+                latest = np.where(self.universe.active, latest, np.nan)
+            return latest
+        return np.array([self.get_latest_bar_value(s, val_type) for s in self.symbol_list], dtype = np.float64)
+
+    def get_latest_bars_matrix(self, val_type, N=1):
+        '''
+        Returns an (N x symbols) array of the last N val_type values of every symbol of symbol_list, oldest
+        first, or N-k rows if less available. Handlers that keep matrices return a read-only view, which isn't
+        masked by the Universe (prices are NaN before a symbol's listing and padded after its delisting)
+        '''
+        matrices = self._matrices
+        if matrices is not None and val_type in matrices:
+            return matrices[val_type][max(0, self._cursor - N):self._cursor]
+        return np.column_stack([self.get_latest_bars_values(s, val_type, N) for s in self.symbol_list])
+
+    def get_latest_datetime(self):
+        '''
+        Returns the datetime of the latest bar pushed (of the first symbol for handlers without a timeline)
+        '''
+        if self.timeline is not None:
+            return self.timeline[self._cursor - 1] if self._cursor else None
+        return self.get_latest_bar_datetime(self.symbol_list[0])
+
+    @property
+    def active_mask(self):
+        '''
+        A boolean array over symbol_list of the symbols that got the latest bar: all of them unless the
+        handler was given a Universe
+        '''
+        if self.universe is None:
+            return np.ones(len(self.symbol_list), dtype = bool)
+        return self.universe.active
+
+    @property
+    def active_symbols(self):
+        '''
+        The list of the symbols that got the latest bar
+        '''
+        if self.universe is None:
+            return self.symbol_list
+        return self.universe.active_symbols
+
+    def is_active(self, symbol):
+        if self.universe is None:
+            return symbol in self.latest_symbol_data
+        return self.universe.is_active(symbol)
+
+    def _update_active_bars(self):
+        '''
+        update_bars() for handlers with a Universe and a timeline: moves on to the next date, lets the Universe
+        work out the active symbols, and pushes the bars of only those. The bars of a symbol are rows of
+        _frames, its DataFrame reindexed to the timeline
+        '''
+        if self._cursor >= len(self.timeline):
+            self.continue_backtest = False # of there is no next bar then the backtest is over
+            return
+
+        dt = self.timeline[self._cursor]
+        self._cursor += 1
+        updated = self.universe.update(self, dt)
+        for s in updated:
+            self.latest_symbol_data[s].append((dt, self._frames[s].iloc[self._cursor - 1]))
+        if self._cursor == len(self.timeline):
+            self.continue_backtest = False # that was the last bar
+        self._notify_bar_listeners(updated)
+        self.events.put(MarketEvent())
+        self._update_timeframes()
+
+    def data_version(self, symbol):
+        '''
+        Returns a string that identifies the bars the handler pushes for the symbol, so results computed from
+        them (e.g. cached indicator series) can be reused while it is unchanged. None if it can't be known,
+        e.g. for a live feed, or for a Universe whose screens can't be told apart
+        '''
+        version = self._data_versions.get(symbol)
+        universe = self.universe
+        if version is None or universe is None:
+            return version
+        # the inactive symbols get no bars, so a screened run computes different series from the same files
+        key = universe.cache_key()
+        return None if key is None else '%s|%s' % (version, key)
+
+
+def _csv_data_version(path, index):
+    '''
+    Fingerprints a csv file by its size and modification time, together with the dates it is reindexed to
+    '''
+    stat = os.stat(path)
+    if len(index) == 0:
+        return '%d-%d-0' % (stat.st_size, int(stat.st_mtime * 1e6))
+    return '%d-%d-%d-%s-%s' % (stat.st_size, int(stat.st_mtime * 1e6), len(index), index[0], index[-1])
+
+
+BAR_COLUMNS = [
+    'price_date',
+    'open_price',
+    'high_price',
+    'low_price',
+    'close_price',
+    'adj_close_price',
+    'volume'
+]
+
+
+def read_bar_csv(path):
+    '''
+    Reads a csv file of OHLCV bars (the columns of BAR_COLUMNS, after a header row) into a DataFrame indexed
+    on the date
+    '''
+    # load the csv file with no head information, indexed on the date
+    return pd.io.parsers.read_csv(
+        path, header = 0, index_col = 0, parse_dates = True, names = BAR_COLUMNS
+    ).sort_values(by = 'price_date')   # .sort()
+
 
 class HistoricCSVDataHandler(DataHandler):
     '''
@@ -73,7 +466,7 @@ class HistoricCSVDataHandler(DataHandler):
     provide an interface to obtain the 'latest' bar in a simulation of a live trading interface
     '''
 
-    def __init__(self, events, csv_dir, symbol_list):
+    def __init__(self, events, csv_dir, symbol_list, universe = None):
         '''
         Initializes the DataHandler by getting the location of the csv files (csv_dir) and a list of symbols to track.
 
@@ -83,11 +476,14 @@ class HistoricCSVDataHandler(DataHandler):
         events - The Event Queue
         csv_dir - Absolute directory path to the csv files
         symbol_list - A list of symbol strings
+        universe - (Optional) A Universe; if given, bars are only pushed for its active symbols
         '''
+        super(HistoricCSVDataHandler, self).__init__()
 
         self.events = events
         self.csv_dir = csv_dir
         self.symbol_list = symbol_list
+        self.universe = universe
 
         self.symbol_data = {}
         self.latest_symbol_data = {}
@@ -118,33 +514,46 @@ class HistoricCSVDataHandler(DataHandler):
 
         comb_index = None
         for s in self.symbol_list: # for each and every symbol we care about
-            # load the csv file with no head information, indexed on the date
-            self.symbol_data[s] = pd.io.parsers.read_csv(
-                os.path.join(self.csv_dir, '%s.csv' % s),
-                header = 0, index_col = 0, parse_dates = True,
-                names = [
-                    'price_date',
-                    'open_price',
-                    'high_price',
-                    'low_price',
-                    'close_price',
-                    'adj_close_price',
-                    'volume'
-                ]
-            ).sort_values(by = 'price_date')   # .sort()
+            self.symbol_data[s] = self._read_symbol_frame(s)
 
             # combine the index to pad forward values
             if comb_index is None: # if it's the first symbol, set the index to the dates of the first symbol
                 comb_index = self.symbol_data[s].index
             else: # if it's not the first symbol, combine the dates of all of the symbols
-                comb_index.union(self.symbol_data[s].index)
+                comb_index = comb_index.union(self.symbol_data[s].index)
 
             # set the latest symbol data to None
             self.latest_symbol_data[s] = []
 
+        # each symbol is listed between the first and last dates of its own data
+        self.listings = listing_windows(self.symbol_data)
+
         # Reindex the dataframes
+        self._data_versions = {}
+        frames = {}
         for s in self.symbol_list:
-            self.symbol_data[s] = self.symbol_data[s].reindex(index=comb_index, method = 'pad').iterrows()
+            frames[s] = self.symbol_data[s].reindex(index=comb_index, method = 'pad')
+            self.symbol_data[s] = frames[s].iterrows()
+            self._data_versions[s] = self._data_version(s, comb_index)
+        self._build_matrices(frames, comb_index)
+        self._frames = frames
+        if self.universe is not None:
+            self.universe.bind(self.symbol_list, self.listings)
+
+    def _data_path(self, symbol):
+        '''
+        Returns the file the bars of a symbol are read from
+        '''
+        return os.path.join(self.csv_dir, '%s.csv' % symbol)
+
+    def _read_symbol_frame(self, symbol):
+        '''
+        Returns the bars of a symbol as a DataFrame indexed by price_date
+        '''
+        return read_bar_csv(self._data_path(symbol))
+
+    def _data_version(self, symbol, index):
+        return _csv_data_version(self._data_path(symbol), index)
 
     def _get_new_bar(self, symbol):
         '''
@@ -217,9 +626,13 @@ class HistoricCSVDataHandler(DataHandler):
 
     def update_bars(self):
         '''
-        Pushes the latest bar to the latest_symbol_data structure for all symbols in the symbol list
+        Pushes the latest bar to the latest_symbol_data structure for all symbols in the symbol list, or only
+        the active ones if the handler has a Universe
         '''
+        if self.universe is not None:
+            return self._update_active_bars()
 
+        updated = []
         for s in self.symbol_list:
             try:
                 bar = next(self._get_new_bar(s)) # grab the new bar
@@ -228,7 +641,17 @@ class HistoricCSVDataHandler(DataHandler):
             else:
                 if bar is not None:
                     self.latest_symbol_data[s].append(bar) # tack the next bar onto the latest_symbol_data
+                    updated.append(s)
+        if not updated:
+            return
+        self._cursor += 1
+        # the backtest is over once the last bar has been pushed (rather than a bar later, which handed the
+        # strategies and the portfolio the last bar twice)
+        if self._cursor == len(self.timeline):
+            self.continue_backtest = False
+        self._notify_bar_listeners(updated)
         self.events.put(MarketEvent())
+        self._update_timeframes()
 
 
 class AlphaVantage_HistoricCSVDataHandler(DataHandler):
@@ -237,7 +660,7 @@ class AlphaVantage_HistoricCSVDataHandler(DataHandler):
     provide an interface to obtain the 'latest' bar in a simulation of a live trading interface
     '''
 
-    def __init__(self, events, csv_dir, symbol_list):
+    def __init__(self, events, csv_dir, symbol_list, universe = None):
         '''
         Initializes the DataHandler by getting the location of the csv files (csv_dir) and a list of symbols to track.
 
@@ -247,11 +670,14 @@ class AlphaVantage_HistoricCSVDataHandler(DataHandler):
         events - The Event Queue
         csv_dir - Absolute directory path to the csv files
         symbol_list - A list of symbol strings
+        universe - (Optional) A Universe; if given, bars are only pushed for its active symbols
         '''
+        super(AlphaVantage_HistoricCSVDataHandler, self).__init__()
 
         self.events = events
         self.csv_dir = csv_dir
         self.symbol_list = symbol_list
+        self.universe = universe
 
         self.symbol_data = {}
         self.latest_symbol_data = {}
@@ -277,7 +703,7 @@ class AlphaVantage_HistoricCSVDataHandler(DataHandler):
             # load the csv file with no head information, indexed on the date
             
             self.symbol_data[s] = pd.io.parsers.read_csv(
-                os.path.join(self.csv_dir, '%s.csv' % s),
+                self._data_path(s),
                 header = 0, index_col = 0, parse_dates = True,
                 names = [
                     'Date',
@@ -289,14 +715,31 @@ class AlphaVantage_HistoricCSVDataHandler(DataHandler):
             if comb_index is None: # if it's the first symbol, set the index to the dates of the first symbol
                 comb_index = self.symbol_data[s].index
             else: # if it's not the first symbol, combine the dates of all of the symbols
-                comb_index.union(self.symbol_data[s].index)
+                comb_index = comb_index.union(self.symbol_data[s].index)
 
             # set the latest symbol data to None
             self.latest_symbol_data[s] = []
 
+        # each symbol is listed between the first and last dates of its own data
+        self.listings = listing_windows(self.symbol_data)
+
         # Reindex the dataframes
+        self._data_versions = {}
+        frames = {}
         for s in self.symbol_list:
-            self.symbol_data[s] = self.symbol_data[s].reindex(index=comb_index, method = 'pad').iterrows()
+            frames[s] = self.symbol_data[s].reindex(index=comb_index, method = 'pad')
+            self.symbol_data[s] = frames[s].iterrows()
+            self._data_versions[s] = _csv_data_version(self._data_path(s), comb_index)
+        self._build_matrices(frames, comb_index)
+        self._frames = frames
+        if self.universe is not None:
+            self.universe.bind(self.symbol_list, self.listings)
+
+    def _data_path(self, symbol):
+        '''
+        Returns the file the bars of a symbol are read from
+        '''
+        return os.path.join(self.csv_dir, '%s.csv' % symbol)
 
     def _get_new_bar(self, symbol):
         '''
@@ -369,9 +812,13 @@ class AlphaVantage_HistoricCSVDataHandler(DataHandler):
 
     def update_bars(self):
         '''
-        Pushes the latest bar to the latest_symbol_data structure for all symbols in the symbol list
+        Pushes the latest bar to the latest_symbol_data structure for all symbols in the symbol list, or only
+        the active ones if the handler has a Universe
         '''
+        if self.universe is not None:
+            return self._update_active_bars()
 
+        updated = []
         for s in self.symbol_list:
             try:
                 bar = next(self._get_new_bar(s)) # grab the new bar
@@ -380,4 +827,14 @@ class AlphaVantage_HistoricCSVDataHandler(DataHandler):
             else:
                 if bar is not None:
                     self.latest_symbol_data[s].append(bar) # tack the next bar onto the latest_symbol_data
+                    updated.append(s)
+        if not updated:
+            return
+        self._cursor += 1
+        # the backtest is over once the last bar has been pushed (rather than a bar later, which handed the
+        # strategies and the portfolio the last bar twice)
+        if self._cursor == len(self.timeline):
+            self.continue_backtest = False
+        self._notify_bar_listeners(updated)
         self.events.put(MarketEvent())
+        self._update_timeframes()
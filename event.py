@@ -2,6 +2,11 @@
 
 from __future__ import print_function
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 class Event(object):
     '''
     Event is the blase class for providing an interface for all subsequent (inherited events),
@@ -16,11 +21,15 @@ class MarketEvent(Event):
     Handles the event of receiving a new market update with corresponding bars
     '''
 
-    def __init__(self):
+    def __init__(self, timeframe = None):
         '''
         Initialises the MarketEvent
+
+        Parameters:
+        timeframe - (Optional) The name of the timeframe (e.g. '1h') whose bar closed; None for the data handler's own bars
         '''
         self.type = 'MARKET'
+        self.timeframe = timeframe
 
 
 class SignalEvent(Event):
@@ -48,22 +57,50 @@ class SignalEvent(Event):
         self.strength = strength
 
 
+class RebalanceEvent(Event):
+    '''
+    Handles the event of a Strategy asking for the whole portfolio to be moved to a set of target weights.
+    This is received by a Portfolio object, which turns it into a batch of OrderEvents in one step.
+    '''
+
+    def __init__(self, strategy_id, datetime, weights):
+        '''
+        Initializes the RebalanceEvent
+
+        Parameters:
+        strategy_id - the unique identifier for the strategy that generated the RebalanceEvent
+        datetime - the timestamp at which the rebalance was requested
+        weights - dict of symbol -> target fraction of portfolio equity (negative for short).
+                  Symbols that are left out are targeted at zero.
+        '''
+
+        self.type = 'REBALANCE'
+        self.strategy_id = strategy_id
+        self.datetime = datetime
+        self.weights = weights
+
+
 class OrderEvent(Event):
     '''
     Handles the event of sending an Order to an execution system.
     The order contains a symbol (e.g. 'AAPL'), a type (market or limit), a quantity and a direction
     '''
 
-    def __init__(self, symbol, order_type, quantity, direction):
+    def __init__(self, symbol, order_type, quantity, direction, limit_price=None, stop_price=None,
+                 time_in_force='GTC', expire_time=None):
         '''
-        Initializes the order type, setting whether it is a Market order ('MKT') or Limit ('LMT')
-        it has a quantity and its direction ('BUY' or 'SELL')
+        Initializes the order type, setting whether it is a Market order ('MKT'), Limit ('LMT'), Stop ('STP')
+        or Stop Limit ('STP LMT'). It has a quantity and its direction ('BUY' or 'SELL')
 
         Parameters:
         symbol - the instrument to trade
-        order_type - 'MKT' or 'LMT'
+        order_type - 'MKT', 'LMT', 'STP' or 'STP LMT'
         quantity - number instruments to trade
         direction - 'BUY' or 'SELL'
+        limit_price - the limit price of a 'LMT' or 'STP LMT' order
+        stop_price - the trigger price of a 'STP' or 'STP LMT' order
+        time_in_force - 'GTC' (good till cancelled), 'DAY' (the next bar only) or 'GTD' (good till expire_time)
+        expire_time - the datetime a 'GTD' order expires after
         '''
 
         self.type = 'ORDER'
@@ -71,6 +108,10 @@ class OrderEvent(Event):
         self.order_type = order_type
         self.quantity = quantity
         self.direction = direction
+        self.limit_price = limit_price
+        self.stop_price = stop_price
+        self.time_in_force = time_in_force
+        self.expire_time = expire_time
 
     def print_order(self):
         '''
@@ -103,7 +144,7 @@ class FillEvent(Event):
         exchange - the exchange where the order was filled
         quantity - the filled quantity
         direction - 'BUY' or 'SELL'
-        fill_cost - the value of the holdings in dollars
+        fill_cost - the price per unit the fill was executed at, or None to let the Portfolio value it at the bar price
         commission - commission charged by brokerage
         '''
 
@@ -135,3 +176,18 @@ class FillEvent(Event):
             full_cost = max(1.3, 0.008 * self.quantity)
 
         return full_cost
+
+
+class EventQueue(queue.Queue):
+    '''
+    The queue events are passed through. A Queue that can be pickled, with the events it holds, so a running
+    backtest can be checkpointed
+    '''
+
+    def __getstate__(self):
+        return {'maxsize': self.maxsize, 'events': list(self.queue)}
+
+    def __setstate__(self, state):
+        queue.Queue.__init__(self, state['maxsize'])
+        for event in state['events']:
+            self.put(event)
@@ -0,0 +1,73 @@
+# event_calendar.py
+
+# A catalyst calendar for event-driven strategies. The catalyst CSV (e.g. Data/Biotech_Approvals_1Week.csv) is
+# read once, its date columns are normalised to calendar days, and two hash indexes are built per date column:
+# (ticker, day) -> rows, and day -> tickers. A strategy can then ask which of its symbols have an event on the
+# current bar's day in O(1), instead of filtering the whole DataFrame for every symbol on every bar.
+
+from __future__ import print_function
+
+import pandas as pd
+
+
+def to_day(dt):
+    '''
+    Returns the calendar day (datetime.date) of a datetime, pandas Timestamp or date
+    '''
+    return dt.date() if hasattr(dt, 'date') else dt
+
+
+class CatalystCalendar(object):
+    '''
+    An index of dated catalyst events per ticker
+    '''
+
+    def __init__(self, csv_path, ticker_column = 'ticker', date_columns = ('catalyst_date', 'exit_date')):
+        '''
+        Loads the catalyst file and builds the indexes
+
+        Parameters:
+        csv_path - The path to the csv file with a ticker column and one or more date columns
+        ticker_column - The name of the ticker column
+        date_columns - The date columns to index. Columns missing from the file are skipped
+        '''
+        self.csv_path = csv_path
+        self.ticker_column = ticker_column
+        self.data = pd.read_csv(csv_path)
+
+        self.date_columns = [c for c in date_columns if c in self.data.columns]
+        self._by_key = {}
+        self._by_day = {}
+
+        tickers = self.data[ticker_column].tolist()
+        for column in self.date_columns:
+            self.data[column] = pd.to_datetime(self.data[column]).dt.normalize()
+            by_key = {}
+            by_day = {}
+            for row, (ticker, day) in enumerate(zip(tickers, self.data[column].dt.date)):
+                if pd.isnull(day):
+                    continue
+                by_key.setdefault((ticker, day), []).append(row)
+                tickers_on_day = by_day.setdefault(day, [])
+                if ticker not in tickers_on_day:
+                    tickers_on_day.append(ticker)
+            self._by_key[column] = by_key
+            self._by_day[column] = by_day
+
+    def has_event(self, ticker, dt, column = 'catalyst_date'):
+        '''
+        Returns True if the ticker has an event in the given date column on the day of dt
+        '''
+        return (ticker, to_day(dt)) in self._by_key[column]
+
+    def events(self, ticker, dt, column = 'catalyst_date'):
+        '''
+        Returns the rows of the catalyst file for the ticker's events on the day of dt (possibly empty)
+        '''
+        return self.data.iloc[self._by_key[column].get((ticker, to_day(dt)), [])]
+
+    def symbols_on(self, dt, column = 'catalyst_date'):
+        '''
+        Returns the tickers with an event in the given date column on the day of dt, in file order
+        '''
+        return self._by_day[column].get(to_day(dt), [])
@@ -0,0 +1,559 @@
+# event_log.py
+
+# A compact binary log of every Market, Signal, Rebalance, Order and Fill event a backtest handles, stamped with
+# the simulated datetime of the bar it was handled on rather than the wall clock, so two runs of the same
+# backtest write identical logs. Market records carry the bar's prices and the active symbols, which is all a
+# Portfolio reads from its data handler: replay() drives a Portfolio from a log alone, without loading data or
+# running the strategy, and diff_event_logs() streams two logs side by side and stops at the first record that
+# differs, e.g. to find the first event a strategy change altered.
+#
+# The file is a header (magic, version and a JSON description: the symbols and the price field) followed by
+# struct-packed records. Each record starts with its kind and the simulated datetime (int64 nanoseconds);
+# strings (symbols, directions, order types ...) are written once, as a STRING record, and referred to by id.
+
+from __future__ import print_function
+
+import argparse
+import json
+import struct
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+import pandas as pd
+
+from data import DataHandler
+from event import FillEvent, MarketEvent, RebalanceEvent, SignalEvent
+from portfolio import Portfolio
+
+MAGIC = b'QSEL'
+VERSION = 1
+
+STRING, MARKET, SIGNAL, REBALANCE, ORDER, FILL = range(6)
+KIND_NAMES = {MARKET: 'MARKET', SIGNAL: 'SIGNAL', REBALANCE: 'REBALANCE', ORDER: 'ORDER', FILL: 'FILL'}
+
+NAT = np.iinfo(np.int64).min # the int64 of NaT, for events handled before the first bar
+
+_PREAMBLE = struct.Struct('<4sHI') # magic, version, length of the JSON header
+_RECORD = struct.Struct('<Bq') # kind, simulated datetime
+_STRING = struct.Struct('<HH') # id, length of the utf-8 bytes
+_MARKET = struct.Struct('<H') # timeframe (0 for the data handler's own bars, which carry the prices)
+_SIGNAL = struct.Struct('<qHHd') # strategy_id, symbol, signal_type, strength
+_REBALANCE = struct.Struct('<qH') # strategy_id, number of weights
+_WEIGHT = struct.Struct('<Hd') # symbol, weight
+_ORDER = struct.Struct('<HHHHdddq') # symbol, order_type, direction, time_in_force, quantity, limit, stop, expiry
+_FILL = struct.Struct('<HHHddd') # symbol, exchange, direction, quantity, fill_cost, commission
+
+
+def _to_nanos(dt):
+    return NAT if dt is None else pd.Timestamp(dt).value
+
+
+def _to_float(value):
+    return np.nan if value is None else float(value)
+
+
+def _from_float(value):
+    return None if np.isnan(value) else value
+
+
+def _quantity(value):
+    # quantities are whole shares unless a sizer made them fractional
+    return int(value) if float(value).is_integer() else value
+
+
+class EventLogWriter(object):
+    '''
+    Records the events a backtest handles to a binary event log. Records are packed into an in-memory buffer
+    that is written out in blocks
+    '''
+
+    def __init__(self, path, bars, price_field = 'Adj_Close', buffer_size = 1 << 16, description = None):
+        '''
+        Creates the log file and writes its header
+
+        Parameters:
+        path - The log file, overwritten if it exists
+        bars - The DataHandler the backtest runs on
+        price_field - The bar field Market records carry, the one the Portfolio values positions at
+        buffer_size - Bytes of records buffered before they're written out
+        description - (Optional) A dict of extra JSON values for the header, e.g. the initial capital
+        '''
+        self.path = path
+        self.bars = bars
+        self.price_field = price_field
+        self.buffer_size = buffer_size
+        self.description = dict(description or {})
+        self.description.update({'symbol_list': list(bars.symbol_list), 'price_field': price_field})
+
+        self._strings = {None: 0}
+        self._buffer = bytearray()
+        self._time = NAT
+        self._file = open(path, 'wb')
+
+        header = json.dumps(self.description, default = str, sort_keys = True).encode('utf-8')
+        self._file.write(_PREAMBLE.pack(MAGIC, VERSION, len(header)) + header)
+
+    def _string(self, value):
+        '''
+        Returns the id of a string, writing a STRING record the first time it is seen
+        '''
+        try:
+            return self._strings[value]
+        except KeyError:
+            pass
+        string_id = len(self._strings)
+        data = str(value).encode('utf-8')
+        self._buffer += _RECORD.pack(STRING, 0) + _STRING.pack(string_id, len(data)) + data
+        self._strings[value] = string_id
+        return string_id
+
+    def record(self, event):
+        '''
+        Appends an event to the log. Events that aren't Market, Signal, Rebalance, Order or Fill events are
+        ignored
+        '''
+        kind = event.type
+        buf = self._buffer
+        if kind == 'MARKET':
+            timeframe = getattr(event, 'timeframe', None)
+            if timeframe is None:
+                self._time = _to_nanos(self.bars.get_latest_datetime())
+                prices = np.asarray(self.bars.get_latest_bar_array(self.price_field), dtype = '<f8')
+                buf += _RECORD.pack(MARKET, self._time) + _MARKET.pack(0)
+                buf += prices.tobytes()
+                buf += np.packbits(self.bars.active_mask).tobytes()
+            else:
+                timeframe = self._string(timeframe)
+                buf += _RECORD.pack(MARKET, self._time) + _MARKET.pack(timeframe)
+        elif kind == 'SIGNAL':
+            symbol, signal_type = self._string(event.symbol), self._string(event.signal_type)
+            buf += _RECORD.pack(SIGNAL, self._time)
+            buf += _SIGNAL.pack(int(event.strategy_id), symbol, signal_type, float(event.strength))
+        elif kind == 'REBALANCE':
+            weights = [(self._string(s), float(w)) for s, w in sorted(event.weights.items())]
+            buf += _RECORD.pack(REBALANCE, self._time) + _REBALANCE.pack(int(event.strategy_id), len(weights))
+            for symbol, weight in weights:
+                buf += _WEIGHT.pack(symbol, weight)
+        elif kind == 'ORDER':
+            symbol, order_type = self._string(event.symbol), self._string(event.order_type)
+            direction, time_in_force = self._string(event.direction), self._string(event.time_in_force)
+            buf += _RECORD.pack(ORDER, self._time) + _ORDER.pack(
+                symbol, order_type, direction, time_in_force, float(event.quantity),
+                _to_float(event.limit_price), _to_float(event.stop_price), _to_nanos(event.expire_time)
+            )
+        elif kind == 'FILL':
+            symbol, exchange, direction = (
+                self._string(event.symbol), self._string(event.exchange), self._string(event.direction)
+            )
+            # the fill's timeindex is left out: some execution handlers stamp it with the wall clock
+            buf += _RECORD.pack(FILL, self._time) + _FILL.pack(
+                symbol, exchange, direction, float(event.quantity), _to_float(event.fill_cost),
+                float(event.commission)
+            )
+        else:
+            return
+
+        if len(buf) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the buffered records to the file
+        '''
+        if self._buffer:
+            self._file.write(self._buffer)
+            del self._buffer[:]
+        self._file.flush()
+
+    def __getstate__(self):
+        '''
+        A checkpointed log keeps its settings, the string ids handed out so far and how far its file had been
+        written
+        '''
+        state = self.__dict__.copy()
+        if self._file.closed:
+            state['offset'] = None
+        else:
+            self.flush()
+            state['offset'] = self._file.tell()
+        del state['_file']
+        return state
+
+    def __setstate__(self, state):
+        # records written after the checkpoint are dropped, as they will be written again
+        offset = state.pop('offset')
+        self.__dict__.update(state)
+        self._file = open(self.path, 'r+b')
+        if offset is None:
+            self._file.seek(0, 2)
+        else:
+            self._file.truncate(offset)
+            self._file.seek(offset)
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+class EventRecord(object):
+    '''
+    A record read back from an event log: its kind ('MARKET', 'SIGNAL', ...), the simulated datetime it was
+    handled on and its fields. Records compare equal when all of those do, NaN prices included
+    '''
+
+    def __init__(self, kind, time, fields):
+        self.kind = kind
+        self.time = time
+        self.fields = fields
+
+    @property
+    def datetime(self):
+        return None if self.time == NAT else pd.Timestamp(self.time)
+
+    def differences(self, other):
+        '''
+        Returns the names of the fields that differ from another record of the same kind
+        '''
+        names = []
+        if self.time != other.time:
+            names.append('datetime')
+        for name, value in self.fields.items():
+            theirs = other.fields.get(name)
+            if isinstance(value, np.ndarray):
+                same = isinstance(theirs, np.ndarray) and np.array_equal(value, theirs, equal_nan = True)
+            elif isinstance(value, float) and isinstance(theirs, float) and np.isnan(value) and np.isnan(theirs):
+                same = True
+            else:
+                same = value == theirs
+            if not same:
+                names.append(name)
+        return names
+
+    def __eq__(self, other):
+        return (isinstance(other, EventRecord) and self.kind == other.kind and not self.differences(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        fields = ', '.join('%s=%r' % (k, v) for k, v in self.fields.items() if not isinstance(v, np.ndarray))
+        return '%s(%s%s%s)' % (self.kind, self.datetime, ', ' if fields else '', fields)
+
+
+class EventLogReader(object):
+    '''
+    Streams the records of an event log, one EventRecord at a time
+
+    Usage:
+    with EventLogReader(path) as log:
+        for record in log:
+            ...
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        magic, version, length = _PREAMBLE.unpack(self._file.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError('%s is not an event log' % path)
+        if version != VERSION:
+            raise ValueError('%s is an event log of version %d, this is version %d' % (path, version, VERSION))
+        self.description = json.loads(self._file.read(length).decode('utf-8'))
+        self.symbol_list = self.description['symbol_list']
+        self.price_field = self.description['price_field']
+        self._strings = {0: None}
+
+    def _read(self, layout):
+        data = self._file.read(layout.size)
+        if len(data) < layout.size:
+            raise ValueError('%s ends in the middle of a record' % self.path)
+        return layout.unpack(data)
+
+    def __iter__(self):
+        read, strings, n = self._read, self._strings, len(self.symbol_list)
+        while True:
+            head = self._file.read(_RECORD.size)
+            if not head:
+                return
+            if len(head) < _RECORD.size:
+                raise ValueError('%s ends in the middle of a record' % self.path)
+            kind, time = _RECORD.unpack(head)
+
+            if kind == STRING:
+                string_id, length = read(_STRING)
+                strings[string_id] = self._file.read(length).decode('utf-8')
+                continue
+
+            if kind == MARKET:
+                timeframe, = read(_MARKET)
+                fields = {'timeframe': strings[timeframe]}
+                if timeframe == 0:
+                    fields['prices'] = np.frombuffer(self._file.read(8 * n), dtype = '<f8')
+                    packed = np.frombuffer(self._file.read((n + 7) // 8), dtype = np.uint8)
+                    fields['active'] = np.unpackbits(packed)[:n].astype(bool)
+            elif kind == SIGNAL:
+                strategy_id, symbol, signal_type, strength = read(_SIGNAL)
+                fields = {
+                    'strategy_id': strategy_id, 'symbol': strings[symbol], 'signal_type': strings[signal_type],
+                    'strength': strength
+                }
+            elif kind == REBALANCE:
+                strategy_id, count = read(_REBALANCE)
+                weights = {}
+                for _ in range(count):
+                    symbol, weight = read(_WEIGHT)
+                    weights[strings[symbol]] = weight
+                fields = {'strategy_id': strategy_id, 'weights': weights}
+            elif kind == ORDER:
+                symbol, order_type, direction, time_in_force, quantity, limit, stop, expiry = read(_ORDER)
+                fields = {
+                    'symbol': strings[symbol], 'order_type': strings[order_type], 'direction': strings[direction],
+                    'time_in_force': strings[time_in_force], 'quantity': _quantity(quantity),
+                    'limit_price': _from_float(limit), 'stop_price': _from_float(stop),
+                    'expire_time': None if expiry == NAT else pd.Timestamp(expiry)
+                }
+            elif kind == FILL:
+                symbol, exchange, direction, quantity, fill_cost, commission = read(_FILL)
+                fields = {
+                    'symbol': strings[symbol], 'exchange': strings[exchange], 'direction': strings[direction],
+                    'quantity': _quantity(quantity), 'fill_cost': _from_float(fill_cost), 'commission': commission
+                }
+            else:
+                raise ValueError('%s has a record of unknown kind %d' % (self.path, kind))
+
+            yield EventRecord(KIND_NAMES[kind], time, fields)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ReplayDataHandler(DataHandler):
+    '''
+    A data handler that serves the prices of an event log's Market records, so a Portfolio can be run from the
+    log. Only the price field the log was written with is available
+    '''
+
+    def __init__(self, symbol_list, price_field):
+        super(ReplayDataHandler, self).__init__()
+        self.symbol_list = symbol_list
+        self.price_field = price_field
+        self.symbol_index = dict((s, i) for i, s in enumerate(symbol_list))
+        self.continue_backtest = True
+
+        self._prices = np.full(len(symbol_list), np.nan)
+        self._active = np.zeros(len(symbol_list), dtype = bool)
+        self._times = np.full(len(symbol_list), NAT, dtype = np.int64)
+        self._time = NAT
+
+    def update_from_record(self, record):
+        '''
+        Moves on to the bar of a base MARKET record
+        '''
+        self._time = record.time
+        self._prices = record.fields['prices']
+        self._active = record.fields['active']
+        self._times[self._active] = record.time
+
+    def _check_field(self, val_type):
+        if val_type != self.price_field:
+            raise KeyError('The event log only has the %r field, not %r' % (self.price_field, val_type))
+
+    def get_latest_bar(self, symbol):
+        return (self.get_latest_bar_datetime(symbol), self.get_latest_bar_value(symbol, self.price_field))
+
+    def get_latest_bars(self, symbol, N=1):
+        return [self.get_latest_bar(symbol)]
+
+    def get_latest_bar_datetime(self, symbol):
+        time = self._times[self.symbol_index[symbol]]
+        return None if time == NAT else pd.Timestamp(time)
+
+    def get_latest_bar_value(self, symbol, val_type):
+        self._check_field(val_type)
+        return self._prices[self.symbol_index[symbol]]
+
+    def get_latest_bars_values(self, symbol, val_type, N=1):
+        return np.array([self.get_latest_bar_value(symbol, val_type)])
+
+    def get_latest_bar_array(self, val_type):
+        self._check_field(val_type)
+        return self._prices
+
+    def get_latest_datetime(self):
+        return None if self._time == NAT else pd.Timestamp(self._time)
+
+    @property
+    def active_mask(self):
+        return self._active
+
+    @property
+    def active_symbols(self):
+        return [s for s, a in zip(self.symbol_list, self._active) if a]
+
+    def is_active(self, symbol):
+        return bool(self._active[self.symbol_index[symbol]])
+
+    def update_bars(self):
+        raise NotImplementedError('A ReplayDataHandler is moved on by replay()')
+
+
+def replay(path, portfolio = Portfolio, start_date = None, initial_capital = None, **portfolio_params):
+    '''
+    Runs a Portfolio from an event log alone: it gets the log's Market, Signal, Rebalance and Fill events in the
+    order the backtest handled them. The orders the Portfolio generates are dropped; the fills of the log stand
+    in for the execution handler, so a changed Portfolio (sizing, risk checks) that would have ordered
+    differently isn't replayed faithfully past its first different order
+
+    Parameters:
+    path - The event log
+    portfolio - (Class) The Portfolio to run
+    start_date - (Optional) The start date of the portfolio, defaults to the one in the log's header
+    initial_capital - (Optional) The starting capital, defaults to the one in the log's header
+    portfolio_params - Extra keyword arguments for the Portfolio
+
+    Returns:
+    The Portfolio, after the last event of the log
+    '''
+    with EventLogReader(path) as log:
+        description = log.description
+        if start_date is None:
+            start_date = pd.Timestamp(description['start_date']).to_pydatetime()
+        if initial_capital is None:
+            initial_capital = description['initial_capital']
+
+        bars = ReplayDataHandler(log.symbol_list, log.price_field)
+        events = queue.Queue()
+        replayed = portfolio(bars, events, start_date, initial_capital, **portfolio_params)
+        market = MarketEvent()
+
+        for record in log:
+            fields = record.fields
+            if record.kind == 'MARKET':
+                if fields['timeframe'] is None:
+                    bars.update_from_record(record)
+                    replayed.update_timeindex(market)
+            elif record.kind == 'SIGNAL':
+                replayed.update_signal(SignalEvent(
+                    fields['strategy_id'], fields['symbol'], record.datetime, fields['signal_type'],
+                    fields['strength']
+                ))
+            elif record.kind == 'REBALANCE':
+                replayed.update_rebalance(RebalanceEvent(fields['strategy_id'], record.datetime, fields['weights']))
+            elif record.kind == 'FILL':
+                replayed.update_fill(FillEvent(
+                    record.datetime, fields['symbol'], fields['exchange'], fields['quantity'],
+                    fields['direction'], fields['fill_cost'], fields['commission']
+                ))
+
+            # the orders are in the log already
+            while not events.empty():
+                events.get(False)
+
+    return replayed
+
+
+class Divergence(object):
+    '''
+    Where two event logs first differ: the index of the event (not counting STRING records), and the two
+    records, either of which is None if that log ended first
+    '''
+
+    def __init__(self, index, first, second, symbol_list):
+        self.index = index
+        self.first = first
+        self.second = second
+        self.symbol_list = symbol_list
+
+    def describe(self):
+        '''
+        Returns a readable description of the divergence
+        '''
+        lines = ['The logs diverge at event %d' % self.index]
+        if self.first is None or self.second is None:
+            ended, other = ('first', self.second) if self.first is None else ('second', self.first)
+            lines.append('The %s log ends here, the other has %r' % (ended, other))
+            return '\n'.join(lines)
+
+        lines.append('first:  %r' % self.first)
+        lines.append('second: %r' % self.second)
+        if self.first.kind == self.second.kind:
+            fields = self.first.differences(self.second)
+            lines.append('differing fields: %s' % ', '.join(fields))
+            for name in ('prices', 'active'):
+                if name in fields:
+                    a, b = self.first.fields[name], self.second.fields[name]
+                    for i in np.flatnonzero(~((a == b) | (pd.isnull(a) & pd.isnull(b)))):
+                        lines.append('  %s %s: %s != %s' % (name, self.symbol_list[i], a[i], b[i]))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return 'Divergence(%d, %r, %r)' % (self.index, self.first, self.second)
+
+
+def diff_event_logs(first_path, second_path):
+    '''
+    Streams two event logs side by side and returns a Divergence at the first record that differs, or None if
+    the logs are the same. Neither log is read past the divergence
+
+    Parameters:
+    first_path - An event log
+    second_path - Another event log of a backtest on the same symbols
+    '''
+    with EventLogReader(first_path) as first, EventLogReader(second_path) as second:
+        if first.symbol_list != second.symbol_list or first.price_field != second.price_field:
+            raise ValueError('The event logs are of backtests on different symbols or price fields')
+
+        first_records, second_records = iter(first), iter(second)
+        index = 0
+        while True:
+            a, b = next(first_records, None), next(second_records, None)
+            if a is None and b is None:
+                return None
+            if a is None or b is None or a != b:
+                return Divergence(index, a, b, first.symbol_list)
+            index += 1
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Compare or replay the binary event logs of backtests')
+    commands = parser.add_subparsers(dest = 'command')
+    diff = commands.add_parser('diff', help = 'report the first event two logs differ at')
+    diff.add_argument('first')
+    diff.add_argument('second')
+    show = commands.add_parser('show', help = 'print the events of a log')
+    show.add_argument('path')
+    show.add_argument('--limit', type = int, help = 'the number of events printed')
+    replayed = commands.add_parser('replay', help = 'run a Portfolio from a log and print its final holdings')
+    replayed.add_argument('path')
+    args = parser.parse_args(argv)
+
+    if args.command == 'diff':
+        divergence = diff_event_logs(args.first, args.second)
+        print('The logs are the same' if divergence is None else divergence.describe())
+        return 0 if divergence is None else 1
+    elif args.command == 'show':
+        with EventLogReader(args.path) as log:
+            for i, record in enumerate(log):
+                if args.limit is not None and i >= args.limit:
+                    break
+                print(record)
+    elif args.command == 'replay':
+        portfolio = replay(args.path)
+        print(portfolio.current_holdings)
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,229 @@
+# event_study.py
+
+# An event study over the catalyst calendar: instead of running one Backtest per holding period, the forward
+# returns of every event at every horizon are computed at once from a (dates x symbols) price matrix, by fancy
+# indexing the rows each event's entry lands on. Abnormal returns are the forward returns in excess of a
+# benchmark's over the same rows, and the cross-event means get bootstrap confidence intervals.
+#
+#   python event_study.py Data Data/Biotech_Approvals_1Week.csv --max-horizon 180
+
+from __future__ import print_function
+
+import argparse
+import os, os.path
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from event_calendar import CatalystCalendar
+
+
+def load_price_matrix(csv_dir, symbol_list, field = 'Adj_Close'):
+    '''
+    Reads the <<symbol>>.csv files (Date, Adj_Close) and aligns them on the union of their dates. Prices are
+    padded forward over missing days but left NaN before a symbol's first price
+
+    Parameters:
+    csv_dir - The directory of the csv files
+    symbol_list - A list of symbol strings
+    field - The price column to use
+
+    Returns:
+    A DataFrame indexed by date with a column per symbol
+    '''
+    columns = {}
+    for s in symbol_list:
+        data = pd.read_csv(os.path.join(csv_dir, '%s.csv' % s), index_col = 0, parse_dates = True)
+        columns[s] = data[field].sort_index()
+    return pd.DataFrame(columns).sort_index().ffill()
+
+
+def equal_weight_index(prices):
+    '''
+    Returns the price index of an equal-weighted, daily rebalanced portfolio of the columns of prices, counting
+    each symbol only once it has a price
+    '''
+    returns = prices.pct_change(fill_method = None).mean(axis = 1).fillna(0.0)
+    return (1.0 + returns).cumprod()
+
+
+def bootstrap_mean_ci(values, n_boot = 1000, alpha = 0.05, seed = None, max_cells = 5000000):
+    '''
+    Bootstraps the mean across events of every horizon at once. NaNs (events with no price at a horizon) are
+    left out of each resampled mean
+
+    Parameters:
+    values - An (events x horizons) array
+    n_boot - The number of bootstrap resamples
+    alpha - The CIs cover the (alpha/2, 1 - alpha/2) percentiles of the resampled means
+    seed - (Optional) The seed of the random number generator
+    max_cells - The resamples are drawn in batches of at most this many values, to bound the memory used
+
+    Returns:
+    low, high - Arrays with the bounds of the CI per horizon
+    '''
+    values = np.asarray(values, dtype = np.float64)
+    n_events, n_horizons = values.shape
+    if n_events == 0:
+        nan = np.full(n_horizons, np.nan)
+        return nan, nan.copy()
+
+    rng = np.random.RandomState(seed)
+    batch = max(1, max_cells // max(1, n_events * n_horizons))
+    means = np.empty((n_boot, n_horizons))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category = RuntimeWarning) # all-NaN resamples give NaN means
+        for start in range(0, n_boot, batch):
+            stop = min(n_boot, start + batch)
+            idx = rng.randint(0, n_events, size = (stop - start, n_events))
+            means[start:stop] = np.nanmean(values[idx], axis = 1)
+        low = np.nanpercentile(means, 100.0 * alpha / 2.0, axis = 0)
+        high = np.nanpercentile(means, 100.0 * (1.0 - alpha / 2.0), axis = 0)
+    return low, high
+
+
+class EventStudy(object):
+    '''
+    Forward and abnormal returns of a set of dated events, for a range of holding periods
+
+    An event on day d is entered at the close of the entry_lag'th trading day after the first trading day on
+    or after d (entry_lag = 1 matches the strategies, which buy the bar after the catalyst), and its return at
+    horizon h is the return from that close to the close h trading days later.
+    '''
+
+    def __init__(self, prices, events, horizons = range(1, 181), benchmark = None, entry_lag = 1,
+                 ticker_column = 'ticker', date_column = 'catalyst_date'):
+        '''
+        Computes the return matrices
+
+        Parameters:
+        prices - A DataFrame of prices indexed by date with a column per symbol, e.g. from load_price_matrix()
+        events - A DataFrame with a ticker and a date column, or a CatalystCalendar. Events of tickers that
+                 aren't columns of prices are dropped
+        horizons - The holding periods, in trading days
+        benchmark - (Optional) A price Series, or the name of a column of prices, the abnormal returns are
+                    measured against. Defaults to the equal-weighted index of all the columns of prices
+        entry_lag - The number of trading days from the event day to the entry
+        ticker_column - The name of the ticker column of events
+        date_column - The name of the date column of events
+        '''
+        if isinstance(events, CatalystCalendar):
+            events = events.data
+        events = events[events[ticker_column].isin(prices.columns)]
+        events = events.dropna(subset = [date_column])
+
+        self.prices = prices
+        self.ticker_column = ticker_column
+        self.horizons = np.asarray(list(horizons), dtype = np.int64)
+        self.entry_lag = entry_lag
+
+        if benchmark is None:
+            benchmark = equal_weight_index(prices)
+        elif not isinstance(benchmark, pd.Series):
+            benchmark = prices[benchmark]
+        self.benchmark = benchmark.reindex(prices.index).ffill()
+
+        # row of the entry close of each event, and column of its symbol
+        dates = pd.to_datetime(events[date_column]).values
+        entry_rows = prices.index.values.searchsorted(dates, side = 'left') + entry_lag
+        cols = prices.columns.get_indexer(events[ticker_column])
+
+        self.events = events.assign(entry_date = [
+            prices.index[r] if r < len(prices.index) else pd.NaT for r in entry_rows
+        ]).reset_index(drop = True)
+
+        self.forward_returns = self._forward(prices.values, entry_rows, cols)
+        benchmark_forward = self._forward(self.benchmark.values[:, None], entry_rows, np.zeros_like(cols))
+        self.abnormal_returns = self.forward_returns - benchmark_forward
+
+    def _forward(self, values, entry_rows, cols):
+        '''
+        Returns the (events x horizons) forward returns of values[:, cols] from entry_rows, NaN where the entry
+        or the exit is outside the data or has no price
+        '''
+        n = values.shape[0]
+        exit_rows = entry_rows[:, None] + self.horizons[None, :]
+        valid = (entry_rows[:, None] < n) & (exit_rows < n)
+
+        entry = values[np.minimum(entry_rows, n - 1), cols][:, None]
+        exit_ = values[np.minimum(exit_rows, n - 1), cols[:, None]]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            forward = exit_ / entry - 1.0
+        forward[~valid] = np.nan
+        return forward
+
+    def forward_frame(self, abnormal = False):
+        '''
+        Returns the forward (or abnormal) returns as a DataFrame with a row per event and a column per horizon
+        '''
+        values = self.abnormal_returns if abnormal else self.forward_returns
+        index = pd.MultiIndex.from_arrays([self.events[self.ticker_column], self.events['entry_date']])
+        return pd.DataFrame(values, index = index, columns = self.horizons)
+
+    def summary(self, abnormal = True, n_boot = 1000, alpha = 0.05, seed = None):
+        '''
+        Returns a DataFrame indexed by horizon with the number of events, the mean, median and t-stat of their
+        returns, the fraction that were positive, and the bootstrap CI of the mean
+
+        Parameters:
+        abnormal - Summarise the abnormal returns if True, the raw forward returns otherwise
+        n_boot - The number of bootstrap resamples
+        alpha - The CIs are (1 - alpha) intervals
+        seed - (Optional) The seed of the bootstrap
+        '''
+        values = self.abnormal_returns if abnormal else self.forward_returns
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category = RuntimeWarning)
+            count = (~np.isnan(values)).sum(axis = 0)
+            mean = np.nanmean(values, axis = 0)
+            std = np.nanstd(values, axis = 0, ddof = 1)
+            t_stat = mean / (std / np.sqrt(count))
+            hit_rate = np.nansum(values > 0, axis = 0) / count.astype(np.float64)
+            median = np.nanmedian(values, axis = 0)
+        low, high = bootstrap_mean_ci(values, n_boot = n_boot, alpha = alpha, seed = seed)
+
+        return pd.DataFrame({
+            'events': count,
+            'mean': mean,
+            'median': median,
+            't_stat': t_stat,
+            'hit_rate': hit_rate,
+            'ci_low': low,
+            'ci_high': high
+        }, index = pd.Index(self.horizons, name = 'horizon'))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Forward and abnormal returns after catalyst dates')
+    parser.add_argument('csv_dir', help = 'directory of the <<symbol>>.csv price files')
+    parser.add_argument('catalyst_csv', help = 'csv file with ticker and catalyst_date columns')
+    parser.add_argument('--symbols', nargs = '*', help = 'defaults to every ticker of the catalyst file with a price file')
+    parser.add_argument('--max-horizon', type = int, default = 180)
+    parser.add_argument('--entry-lag', type = int, default = 1)
+    parser.add_argument('--benchmark', help = 'symbol of the benchmark, defaults to the equal-weighted universe')
+    parser.add_argument('--boot', type = int, default = 1000)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--raw', action = 'store_true', help = 'summarise raw instead of abnormal returns')
+    args = parser.parse_args(argv)
+
+    calendar = CatalystCalendar(args.catalyst_csv)
+    symbols = args.symbols
+    if not symbols:
+        tickers = pd.unique(calendar.data[calendar.ticker_column])
+        symbols = [t for t in tickers if os.path.exists(os.path.join(args.csv_dir, '%s.csv' % t))]
+    if args.benchmark and args.benchmark not in symbols:
+        symbols.append(args.benchmark)
+
+    prices = load_price_matrix(args.csv_dir, symbols)
+    study = EventStudy(prices, calendar, horizons = range(1, args.max_horizon + 1),
+                       benchmark = args.benchmark, entry_lag = args.entry_lag)
+    summary = study.summary(abnormal = not args.raw, n_boot = args.boot, seed = args.seed)
+
+    shown = [h for h in (1, 5, 10, 21, 42, 63, 126, 180, 252) if h <= args.max_horizon]
+    print('%d events over %d symbols' % (len(study.events), len(symbols)))
+    print(summary.loc[shown].to_string(float_format = lambda x: '%.4f' % x))
+
+
+if __name__ == '__main__':
+    main()
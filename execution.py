@@ -3,12 +3,19 @@
 from __future__ import print_function
 from abc import ABCMeta, abstractmethod
 import datetime
+import math
+import random
 try:
     import Queue as queue
 except ImportError:
     import queue
 
+import numpy as np
+
 from event import FillEvent, OrderEvent
+from journal import get_journal
+from matching import OrderBook
+from scheduler import FillScheduler
 
 class ExecutionHandler(object):
     '''
@@ -31,6 +38,23 @@ class ExecutionHandler(object):
         '''
         raise NotImplementedError("Should implement execute_order()")
 
+    def on_market(self, event):
+        '''
+        Called by the Backtest for every MarketEvent, before the strategy sees it. Handlers that keep
+        pending orders use it to react to the new bar. The default does nothing
+
+        Parameters:
+        event - The MarketEvent
+        '''
+        pass
+
+    def on_bar_end(self):
+        '''
+        Called by the Backtest whenever the events queue has been drained for the current bar. Handlers that
+        batch their orders fill them here and put the FillEvents on the queue. The default does nothing
+        '''
+        pass
+
 class SimulatedExecutionHandler(ExecutionHandler):
     '''
     This ExecutionHandler class is the simplest of execution handlers because it will simply assume all orders
@@ -69,3 +93,339 @@ class SimulatedExecutionHandler(ExecutionHandler):
                 fill_cost = None # no fill_cost because we modeled the cost of ill in the Portfolio object
             )
             self.events.put(fill_event)
+
+
+class BarSimulatedExecutionHandler(ExecutionHandler):
+    '''
+    A simulated ExecutionHandler that fills orders against the bars of the DataHandler instead of instantly and
+    in full. Orders are held until the events of the current bar have been handled, then every pending order is
+    filled in one vectorised pass:
+
+    - the quantity filled per symbol and bar is capped at participation_rate * the bar's volume, shared
+      first-come-first-served between the orders for that symbol
+    - the fill price is the bar price moved against the order by a fixed slippage plus a square-root market
+      impact term, and kept inside the bar's low/high
+    - whatever isn't filled is carried forward to the next bar (for at most max_bars bars, if set)
+
+    The volume, high and low fields are optional; without them there is no participation cap or price clipping.
+    All price fields should be on the same basis (e.g. don't clip an adjusted close with an unadjusted high/low).
+    '''
+
+    requires_bars = True
+
+    def __init__(self, events, bars, price_field = 'Adj_Close', volume_field = None, high_field = None,
+                 low_field = None, participation_rate = 0.1, slippage_bps = 0.0, impact_coefficient = 0.0,
+                 max_bars = None, exchange = 'ARCA'):
+        '''
+        Initializes the handler with the event queue and the DataHandler to read bars from
+
+        Parameters:
+        events - The Queue of Event objects
+        bars - The DataHandler object that provides bar information
+        price_field - The bar field fills are priced from
+        volume_field - (Optional) The bar field holding the traded volume
+        high_field - (Optional) The bar field holding the high
+        low_field - (Optional) The bar field holding the low
+        participation_rate - The largest fraction of a bar's volume our fills may take
+        slippage_bps - Fixed cost in basis points, applied against the direction of the order
+        impact_coefficient - Impact cost as a fraction of price per sqrt(filled quantity / bar volume)
+        max_bars - (Optional) Cancel the unfilled remainder of an order after this many bars
+        exchange - The exchange reported on the FillEvents
+        '''
+        self.events = events
+        self.bars = bars
+        self.symbol_list = self.bars.symbol_list
+        self.symbol_index = dict((s, i) for i, s in enumerate(self.symbol_list))
+
+        self.price_field = price_field
+        self.volume_field = volume_field
+        self.high_field = high_field
+        self.low_field = low_field
+        self.participation_rate = participation_rate
+        self.slippage_bps = slippage_bps
+        self.impact_coefficient = impact_coefficient
+        self.max_bars = max_bars
+        self.exchange = exchange
+
+        # the pending order book, oldest first
+        self.pending_orders = []
+        self.pending_remaining = []
+        self.pending_age = []
+
+        # volume already taken per symbol in the current bar
+        self.volume_used = np.zeros(len(self.symbol_list))
+
+        self.journal = get_journal()
+
+    def execute_order(self, event):
+        '''
+        Adds the order to the pending book. It is filled when the bar's events have been handled
+
+        Parameters:
+        event - contains an Event object with order information
+        '''
+        if event.type == 'ORDER':
+            self.pending_orders.append(event)
+            self.pending_remaining.append(event.quantity)
+            self.pending_age.append(0)
+
+    def on_market(self, event):
+        '''
+        A new bar has arrived: reset the participation used and age the carried-forward orders
+        '''
+        self.volume_used[:] = 0.0
+        if self.pending_orders:
+            self.pending_age = [a + 1 for a in self.pending_age]
+            if self.max_bars is not None:
+                self._cancel_expired()
+
+    def _cancel_expired(self):
+        keep = [i for i, a in enumerate(self.pending_age) if a < self.max_bars]
+        if len(keep) == len(self.pending_orders):
+            return
+        for i in set(range(len(self.pending_orders))) - set(keep):
+            order = self.pending_orders[i]
+            self.journal.info('CANCEL', symbol = order.symbol, direction = order.direction,
+                              unfilled = self.pending_remaining[i])
+        self.pending_orders = [self.pending_orders[i] for i in keep]
+        self.pending_remaining = [self.pending_remaining[i] for i in keep]
+        self.pending_age = [self.pending_age[i] for i in keep]
+
+    def _bar_field(self, symbols, field, default):
+        if field is None:
+            return np.full(len(symbols), default)
+        return np.array([self.bars.get_latest_bar_value(s, field) for s in symbols], dtype = np.float64)
+
+    def on_bar_end(self):
+        '''
+        Fills all pending orders against the current bar in one pass and puts the FillEvents on the queue
+        '''
+        if not self.pending_orders:
+            return
+
+        # bar data for the symbols that have pending orders
+        symbols = sorted(set(o.symbol for o in self.pending_orders), key = self.symbol_index.get)
+        local = dict((s, i) for i, s in enumerate(symbols))
+        sym = np.array([local[o.symbol] for o in self.pending_orders], dtype = np.intp)
+        remaining = np.array(self.pending_remaining, dtype = np.float64)
+        direction = np.array([1.0 if o.direction == 'BUY' else -1.0 for o in self.pending_orders])
+
+        price = self._bar_field(symbols, self.price_field, np.nan)
+        volume = self._bar_field(symbols, self.volume_field, np.inf)
+        high = self._bar_field(symbols, self.high_field, np.inf)
+        low = self._bar_field(symbols, self.low_field, -np.inf)
+        used = self.volume_used[[self.symbol_index[s] for s in symbols]]
+
+        # capacity left per symbol this bar; nothing trades without a price or on a bar with no volume
+        capacity = np.where(
+            np.isfinite(price) & (np.nan_to_num(volume) > 0),
+            np.maximum(self.participation_rate * np.nan_to_num(volume, posinf = np.inf) - used, 0.0), 0.0
+        )
+
+        # first-come-first-served allocation of each symbol's capacity: order the book by symbol (stable keeps
+        # the time priority), then the quantity ahead of an order is its cumulative sum within the symbol
+        by_symbol = np.argsort(sym, kind = 'stable')
+        rem_sorted = remaining[by_symbol]
+        cum = np.cumsum(rem_sorted)
+        group_start = np.r_[0, np.flatnonzero(np.diff(sym[by_symbol])) + 1]
+        group_offset = np.repeat(cum[group_start] - rem_sorted[group_start], np.diff(np.r_[group_start, len(sym)]))
+        ahead = cum - rem_sorted - group_offset
+        filled_sorted = np.floor(np.clip(capacity[sym[by_symbol]] - ahead, 0.0, rem_sorted))
+        filled = np.empty_like(filled_sorted)
+        filled[by_symbol] = filled_sorted
+
+        # slippage and square-root impact against the order, kept inside the bar's range
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            participation = np.where(np.isfinite(volume[sym]), filled / volume[sym], 0.0)
+        cost = self.slippage_bps / 10000.0 + self.impact_coefficient * np.sqrt(np.nan_to_num(participation))
+        fill_price = np.clip(price[sym] * (1.0 + direction * cost), low[sym], high[sym])
+
+        self.volume_used[[self.symbol_index[s] for s in symbols]] += np.bincount(sym, weights = filled, minlength = len(symbols))
+
+        orders, remainders, ages = [], [], []
+        for i in np.flatnonzero(filled > 0):
+            order = self.pending_orders[i]
+            self.events.put(FillEvent(
+                timeindex = self.bars.get_latest_bar_datetime(order.symbol), symbol = order.symbol,
+                exchange = self.exchange, quantity = int(filled[i]), direction = order.direction,
+                fill_cost = fill_price[i]
+            ))
+        for i in np.flatnonzero(remaining - filled > 0):
+            orders.append(self.pending_orders[i])
+            remainders.append(int(remaining[i] - filled[i]))
+            ages.append(self.pending_age[i])
+        self.pending_orders, self.pending_remaining, self.pending_age = orders, remainders, ages
+
+
+class MatchingExecutionHandler(ExecutionHandler):
+    '''
+    A simulated ExecutionHandler that supports resting orders. Market orders are filled straight away at the
+    current bar's price, like the SimulatedExecutionHandler. Limit ('LMT'), stop ('STP') and stop-limit
+    ('STP LMT') orders go into an OrderBook and are matched against the open/high/low of every following bar,
+    honouring their time in force ('GTC', 'DAY' or 'GTD').
+
+    Without open/high/low fields (e.g. the AlphaVantage files) every bar is a single price_field point.
+    '''
+
+    requires_bars = True
+
+    def __init__(self, events, bars, price_field = 'Adj_Close', open_field = None, high_field = None,
+                 low_field = None, exchange = 'ARCA'):
+        '''
+        Initializes the handler with the event queue and the DataHandler to read bars from
+
+        Parameters:
+        events - The Queue of Event objects
+        bars - The DataHandler object that provides bar information
+        price_field - The bar field market orders are filled at
+        open_field - (Optional) The bar field holding the open, defaults to price_field
+        high_field - (Optional) The bar field holding the high, defaults to price_field
+        low_field - (Optional) The bar field holding the low, defaults to price_field
+        exchange - The exchange reported on the FillEvents
+        '''
+        self.events = events
+        self.bars = bars
+        self.price_field = price_field
+        self.open_field = open_field or price_field
+        self.high_field = high_field or price_field
+        self.low_field = low_field or price_field
+        self.exchange = exchange
+
+        self.order_book = OrderBook()
+        self.bar_no = 0
+        self.journal = get_journal()
+
+    def _fill(self, order, price):
+        self.events.put(FillEvent(
+            timeindex = self.bars.get_latest_bar_datetime(order.symbol), symbol = order.symbol,
+            exchange = self.exchange, quantity = order.quantity, direction = order.direction, fill_cost = price
+        ))
+
+    def execute_order(self, event):
+        '''
+        Fills a market order at the current price, or rests any other order in the book. Resting orders are
+        given an order_id attribute that can be passed to cancel_order()
+
+        Parameters:
+        event - contains an Event object with order information
+        '''
+        if event.type == 'ORDER':
+            if event.order_type == 'MKT':
+                self._fill(event, self.bars.get_latest_bar_value(event.symbol, self.price_field))
+            else:
+                event.order_id = self.order_book.add(event, self.bar_no)
+
+    def cancel_order(self, order_id):
+        '''
+        Cancels a resting order. Returns True if it was still in the book
+        '''
+        return self.order_book.cancel(order_id) is not None
+
+    def _expired(self, expired):
+        for resting in expired:
+            self.journal.info('EXPIRE', order_id = resting.order_id, symbol = resting.order.symbol,
+                              order_type = resting.order.order_type, direction = resting.order.direction)
+
+    def on_market(self, event):
+        '''
+        Matches the resting orders against the new bar. Only symbols with resting orders are looked at,
+        and within a symbol only the orders whose trigger price the bar reached
+        '''
+        self.bar_no += 1
+        if not len(self.order_book):
+            return
+
+        for symbol in self.order_book.symbols():
+            # GTD orders are good through their expire_time, so drop those that lapsed before this bar
+            self._expired(self.order_book.expire_until_time(self.bars.get_latest_bar_datetime(symbol)))
+            fills = self.order_book.match(
+                symbol,
+                self.bars.get_latest_bar_value(symbol, self.open_field),
+                self.bars.get_latest_bar_value(symbol, self.high_field),
+                self.bars.get_latest_bar_value(symbol, self.low_field)
+            )
+            for resting, price in fills:
+                self._fill(resting.order, price)
+
+        # DAY orders only live for the bar after the one they were placed on
+        self._expired(self.order_book.expire_through_bar(self.bar_no))
+
+
+class LatencyExecutionHandler(ExecutionHandler):
+    '''
+    A simulated ExecutionHandler that fills orders after a configurable order-to-fill latency instead of on the
+    bar that generated them, which avoids filling at the close of the very bar a signal was computed from.
+
+    The latency is one of:
+    - a number of bars (1, the default, is the next bar; fractions are rounded up)
+    - a datetime.timedelta, released on the first bar at or after order time + delay
+    - a function taking a random.Random and returning either of the above, to sample a delay per order
+
+    Delayed orders wait in FillScheduler priority queues keyed by simulated time (bar numbers for bar delays,
+    bar datetimes for timedelta delays) and are filled at the release bar's fill_field in the order they fall due.
+    '''
+
+    requires_bars = True
+
+    def __init__(self, events, bars, latency = 1, fill_field = 'Adj_Close', seed = None, exchange = 'ARCA'):
+        '''
+        Initializes the handler with the event queue and the DataHandler to read bars from
+
+        Parameters:
+        events - The Queue of Event objects
+        bars - The DataHandler object that provides bar information
+        latency - Bars (int), a datetime.timedelta, or a function of a random.Random returning either
+        fill_field - The bar field the fills are priced at, e.g. the open for "next bar's open" fills
+        seed - Seed for the random.Random passed to a latency function, so runs are repeatable
+        exchange - The exchange reported on the FillEvents
+        '''
+        self.events = events
+        self.bars = bars
+        self.latency = latency
+        self.fill_field = fill_field
+        self.rng = random.Random(seed)
+        self.exchange = exchange
+
+        self.bar_no = 0
+        self.bar_scheduler = FillScheduler()
+        self.time_scheduler = FillScheduler()
+
+    def _fill(self, order):
+        self.events.put(FillEvent(
+            timeindex = self.bars.get_latest_bar_datetime(order.symbol), symbol = order.symbol,
+            exchange = self.exchange, quantity = order.quantity, direction = order.direction,
+            fill_cost = self.bars.get_latest_bar_value(order.symbol, self.fill_field)
+        ))
+
+    def execute_order(self, event):
+        '''
+        Schedules the order's fill according to the latency. A zero delay fills on the current bar
+
+        Parameters:
+        event - contains an Event object with order information
+        '''
+        if event.type == 'ORDER':
+            delay = self.latency(self.rng) if callable(self.latency) else self.latency
+            if isinstance(delay, datetime.timedelta):
+                if delay <= datetime.timedelta(0):
+                    self._fill(event)
+                else:
+                    self.time_scheduler.schedule(self.bars.get_latest_datetime() + delay, event)
+            elif delay <= 0:
+                self._fill(event)
+            else:
+                # a sampled fractional delay is only over on the bar after it
+                self.bar_scheduler.schedule(self.bar_no + int(math.ceil(delay)), event)
+
+    def on_market(self, event):
+        '''
+        Advances the simulated clock to the new bar and fills the orders that have fallen due
+        '''
+        self.bar_no += 1
+        for order in self.bar_scheduler.release(self.bar_no):
+            self._fill(order)
+        if len(self.time_scheduler):
+            # the handler's clock, which keeps going when some symbols have no bars (e.g. under a Universe)
+            now = self.bars.get_latest_datetime()
+            for order in self.time_scheduler.release(now):
+                self._fill(order)
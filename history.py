@@ -0,0 +1,183 @@
+# history.py
+
+# The per-bar position and holdings history of a Portfolio. For ordinary runs this behaves like the list of dicts
+# it replaces. Given a spill directory and a memory budget, it writes the oldest rows to disk as columnar .npz
+# chunks whenever the in-memory rows would exceed the budget, so very long tick or minute level runs don't have
+# to hold their whole history in RAM. Consumers that need the whole history should stream it with iter_chunks().
+
+from __future__ import print_function
+
+import os
+import sys
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from checkpoint import saving_segments, save_segment, keep_segments, load_segment
+
+
+class BarHistory(object):
+    '''
+    An append-only sequence of dict rows with a fixed set of columns, one of which is 'datetime'.
+
+    Rows that have been spilled are stored one .npz file per chunk with one array per column: 'datetime' as int64
+    nanoseconds and everything else as float64.
+    '''
+
+    def __init__(self, columns, spill_dir=None, memory_budget=None, name='history'):
+        '''
+        Parameters:
+        columns - The ordered column names of a row, including 'datetime'
+        spill_dir - (Optional) Directory the chunks are written to. Without it nothing is ever spilled
+        memory_budget - (Optional) Approximate number of bytes the in-memory rows may use before they are spilled
+        name - Start of the chunk file names, which also get an id of the history, so several histories (e.g. of
+               several portfolios or runs) can share a spill directory
+        '''
+        self.columns = list(columns)
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget
+        self.name = name
+        self.prefix = '%s_%s' % (self.name, uuid.uuid4().hex[:12])
+
+        self._rows = []
+        self._last = None # the latest row, kept after it is spilled so history[-1] still works
+        self._chunks = []
+        self._spilled_rows = 0
+        self._max_rows = None # worked out from the first row, once its size is known
+        # checkpoint segment directory -> (segment names, spilled rows, number of the in-memory rows they hold)
+        self._checkpoints = {}
+
+        if self.spill_dir is not None and not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir)
+
+    def _estimate_max_rows(self, row):
+        '''
+        Estimates how many rows like this one fit in the memory budget
+        '''
+        row_bytes = sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row.values())
+        return max(1, int(self.memory_budget // row_bytes))
+
+    def append(self, row):
+        self._rows.append(row)
+        if self.spill_dir is None or self.memory_budget is None:
+            return
+        if self._max_rows is None:
+            self._max_rows = self._estimate_max_rows(row)
+        if len(self._rows) >= self._max_rows:
+            self.spill()
+
+    def spill(self):
+        '''
+        Writes the in-memory rows to a new chunk on disk and releases them
+        '''
+        if not self._rows:
+            return
+        path = os.path.join(self.spill_dir, '%s_%06d.npz' % (self.prefix, len(self._chunks)))
+        np.savez(path, **self._rows_to_columns(self._rows))
+        self._chunks.append(path)
+        self._spilled_rows += len(self._rows)
+        self._last = self._rows[-1]
+        self._rows = []
+
+    def _rows_to_columns(self, rows):
+        columns = {}
+        for c in self.columns:
+            if c == 'datetime':
+                columns[c] = pd.to_datetime([r[c] for r in rows]).values.astype('datetime64[ns]').view(np.int64)
+            else:
+                columns[c] = np.fromiter((r[c] for r in rows), dtype = np.float64, count = len(rows))
+        return columns
+
+    def __getstate__(self):
+        '''
+        In a checkpoint the in-memory rows are saved as segments, only the rows appended since the last
+        checkpoint being written out, and the spilled chunks are already on disk
+        '''
+        state = self.__dict__.copy()
+        directory = saving_segments()
+        if directory is None:
+            return state
+
+        names, spilled_rows, saved = self._checkpoints.get(directory, ([], 0, 0))
+        if spilled_rows != self._spilled_rows:
+            # the rows of the segments have been spilled since
+            names, saved = [], 0
+        if len(self._rows) > saved:
+            name = '%s_%d.pkl' % (self.prefix, self._spilled_rows + saved)
+            names = names + [save_segment(name, self._rows[saved:])]
+            saved = len(self._rows)
+        self._checkpoints[directory] = (names, self._spilled_rows, saved)
+        keep_segments(names)
+
+        state['_checkpoints'] = dict(self._checkpoints)
+        state['_rows'] = names
+        state['_segmented'] = True
+        return state
+
+    def __setstate__(self, state):
+        segmented = state.pop('_segmented', False)
+        self.__dict__.update(state)
+        if segmented:
+            self._rows = [row for name in state['_rows'] for row in load_segment(name)]
+
+    @property
+    def spilled(self):
+        return len(self._chunks) > 0
+
+    def __len__(self):
+        return self._spilled_rows + len(self._rows)
+
+    def __getitem__(self, i):
+        '''
+        Only the in-memory rows can be indexed, plus the latest row (history[-1]), which is kept in memory even
+        after it has been spilled. Older spilled rows raise an IndexError; read them with iter_chunks()
+        '''
+        if not self._rows and self._last is not None and i == -1:
+            return self._last
+        try:
+            return self._rows[i]
+        except IndexError:
+            if self.spilled:
+                raise IndexError('row %r of %s has been spilled to disk, read it with iter_chunks()' % (i, self.name))
+            raise
+
+    def __iter__(self):
+        '''
+        Iterates over every row as a dict, reading spilled chunks back one at a time
+        '''
+        for chunk in self.iter_chunks():
+            dates = pd.to_datetime(chunk['datetime'])
+            for i in range(len(dates)):
+                row = dict((c, chunk[c][i]) for c in self.columns if c != 'datetime')
+                row['datetime'] = dates[i]
+                yield row
+
+    def iter_chunks(self, columns=None):
+        '''
+        Yields the history as consecutive chunks, each a dict of column name to numpy array. Spilled chunks
+        are loaded one at a time, and only the requested columns are read
+
+        Parameters:
+        columns - (Optional) The columns to load. Defaults to all of them
+        '''
+        columns = self.columns if columns is None else columns
+        for path in self._chunks:
+            with np.load(path) as chunk:
+                yield dict((c, chunk[c]) for c in columns)
+        if self._rows:
+            tail = self._rows_to_columns(self._rows)
+            yield dict((c, tail[c]) for c in columns)
+
+    def to_dataframe(self):
+        '''
+        Returns the whole history as a DataFrame (in memory, so only use it when the history fits)
+        '''
+        if not self.spilled:
+            return pd.DataFrame(self._rows, columns = self.columns)
+        frames = []
+        for chunk in self.iter_chunks():
+            frame = pd.DataFrame(chunk, columns = self.columns)
+            frame['datetime'] = pd.to_datetime(frame['datetime'])
+            frames.append(frame)
+        return pd.concat(frames, ignore_index = True)
@@ -6,52 +6,85 @@
 from __future__ import print_function
 
 import datetime
-import time
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
-from ib.ext.Contract import Contract
-from ib.ext.Order import Order
-from ib.opt import ibConnection, message
+# NOTE: the IbPy modules (ib.ext / ib.opt) are imported inside the methods that need them so that importing
+# this module (e.g. to check which handlers are available) doesn't require or pay for the IB client library
 
 from event import FillEvent, OrderEvent
 from execution import ExecutionHandler
+from journal import get_journal, DEBUG
+from tracer import get_tracer
 
 class IBExecutionHandler(ExecutionHandler):
     '''
     Operates the order execution through the Interactive Brokers API,
     for user against accounts when trading live directly
+
+    Orders are submitted asynchronously: execute_order() only queues the order, and a dedicated I/O thread sends
+    it to TWS, so the event loop never waits on the connection. Server replies arrive on the connection's own
+    reader thread, where orderStatus messages are reconciled per order id into FillEvents on the events queue.
     '''
 
-    def __init__(self, events, order_routing = 'SMART', currency = 'USD'):
+    def __init__(self, events, order_routing = 'SMART', currency = 'USD', connection = None, emit_partial_fills = False):
         '''
         Initializes the IBExecitionHandler instance
+
+        Parameters:
+        events - The Queue of Event objects
+        order_routing - The exchange orders are routed to
+        currency - The currency of the contracts
+        connection - (Optional) An object with the ibConnection interface (register, registerAll, connect,
+                     disconnect, placeOrder), e.g. a mock_tws.MockTWSConnection. If it has Contract and Order
+                     attributes those classes are used instead of IbPy's. Defaults to a live TWS connection
+        emit_partial_fills - If True, a FillEvent is put on the queue for every increment of a partially filled
+                             order; otherwise the partial fills of an order are aggregated into one FillEvent
+                             when it is complete (or cancelled)
         '''
         self.events = events
         self.order_routing = order_routing
         self.currency = currency
+        self.emit_partial_fills = emit_partial_fills
         self.fill_dict = {}
+        self.journal = get_journal()
+        self.tracer = get_tracer()
+
+        # fill_dict is written by the event loop (new orders) and by the connection's reader thread (replies)
+        self._fill_lock = threading.Lock()
 
-        self.tws_conn = self.create_tws_connection()
-        self.order_id = self.create_inital_order_id()
+        self.tws_conn = connection if connection is not None else self.create_tws_connection()
+        self.order_id = self.create_initial_order_id()
         self.register_handlers()
 
+        # orders waiting to be sent to TWS by the I/O thread
+        self._outbox = queue.Queue()
+        self._io_thread = threading.Thread(target = self._submit_loop, name = 'IBExecutionHandler-io')
+        self._io_thread.daemon = True
+        self._io_thread.start()
+
     def _error_handler(self, msg):
         '''
         Handles the capturing of error message
         '''
         # Currently no error handling
-        print('Server Error: %s' % msg)
+        self.journal.error('IB_ERROR', msg = str(msg))
+        self.tracer.instant('IB.error', 'ib', {'msg': str(msg)})
 
     def _reply_handler(self, msg):
         '''
         Handles server replies
         '''
-        # Handle open order orderId processing
-        if msg.typeName == 'openOrder' and msg.orderId == self.order_id and not self.fill_dict.has_key(msg.orderId):
-            self.create_fill_dict_entry(msg)
-        # Handle fills
-        if msg.typeName == 'orderStatus' and msg.status == 'Filled' and self.fill_dict[msg.orderId]['filled'] == False:
-            self.create_fill(msg)
-        print('Server Response: %s, %s\n' % (msg.typeName, msg))
+        # Handle fills (orderStatus carries the cumulative filled quantity and average price of the order)
+        if msg.typeName == 'orderStatus':
+            with self.tracer.span('IB.orderStatus', 'ib', {'order_id': msg.orderId, 'status': msg.status}):
+                self.reconcile_order_status(msg)
+        # every server message is journalled at DEBUG, so skip formatting it unless that level is enabled
+        if self.journal.enabled_for(DEBUG):
+            self.journal.debug('IB_RESPONSE', type_name = msg.typeName, msg = str(msg))
 
     def create_tws_connection(self):
         '''
@@ -59,6 +92,8 @@ class IBExecutionHandler(ExecutionHandler):
         clientId of 10. The clientId is chosen by us and we will need separate IDs for the execution connection and
         market data connection, if the market data connection is used elsewhere
         '''
+        from ib.opt import ibConnection
+
         tws_conn = ibConnection()
         tws_conn.connect()
         return tws_conn
@@ -78,7 +113,7 @@ class IBExecutionHandler(ExecutionHandler):
         self.tws_conn.register(self._error_handler, 'Error')
 
         # Assign all of the server reply messages to the reply handler function we defined above
-        self.tws_conn.register(self._reply_handler)
+        self.tws_conn.registerAll(self._reply_handler)
 
     def create_contract(self, symbol, sec_type, exch, prim_exch, curr):
         '''
@@ -90,6 +125,9 @@ class IBExecutionHandler(ExecutionHandler):
         prim_exch - The primary exchange to carry out the contract on
         curr - The currency in which to purchase the contract
         '''
+        Contract = getattr(self.tws_conn, 'Contract', None)
+        if Contract is None:
+            from ib.ext.Contract import Contract
 
         contract = Contract()
         contract.m_symbol = symbol
@@ -100,62 +138,110 @@ class IBExecutionHandler(ExecutionHandler):
 
         return contract
 
-    def create_order(self, order_type, quantity, action):
+    def create_order(self, order_type, quantity, action, limit_price = None, stop_price = None, time_in_force = None):
         '''
-        Create and Order object (Market/Limit) to go long/short
+        Create and Order object (Market/Limit/Stop) to go long/short
 
-        order_type - 'MKT', 'LMT' for Market or Limit orders
+        order_type - 'MKT', 'LMT', 'STP' or 'STP LMT'
         quantity - Integral number of assets to order
         action - 'BUY' or 'SELL'
+        limit_price - (Optional) The limit price
+        stop_price - (Optional) The stop (auxiliary) price
+        time_in_force - (Optional) 'DAY', 'GTC' or 'GTD'
         '''
+        Order = getattr(self.tws_conn, 'Order', None)
+        if Order is None:
+            from ib.ext.Order import Order
+
         order = Order()
         order.m_orderType = order_type
         order.m_totalQuantity = quantity
         order.m_action = action
+        if limit_price is not None:
+            order.m_lmtPrice = limit_price
+        if stop_price is not None:
+            order.m_auxPrice = stop_price
+        if time_in_force is not None:
+            order.m_tif = time_in_force
 
         return order
 
-    def create_fill_dict_entry(self, msg):
+    def create_fill_dict_entry(self, order_id, symbol, exchange, direction, quantity):
         '''
         Creates an entry in the Fill Dictionary that lists orderIds and provides security information. This is
         needed for the event-driven behavior of the IB server message behavior.
+
+        The entry is made when the order is submitted, so replies can never arrive for an unknown order id.
+        'reported' and 'reported_cost' track how much of the order has already been put on the queue as fills.
         '''
-        self.fill_dict[msd.orderId] = {
-            'symbol': msg.contract.m_symbol,
-            'exchange': msg.contract.m_exchange,
-            'direction': mag.order.m_action,
+        self.fill_dict[order_id] = {
+            'symbol': symbol,
+            'exchange': exchange,
+            'direction': direction,
+            'quantity': quantity,
+            'reported': 0,
+            'reported_cost': 0.0,
             'filled': False
         }
 
-    def create_fill(self, msg):
+    def reconcile_order_status(self, msg):
+        '''
+        Turns an orderStatus reply into FillEvents. IB reports the cumulative filled quantity and average fill price
+        of an order, possibly several times and with repeats, so the part not yet reported is worked out from the
+        difference with what has already been put on the queue. Runs on the connection's reader thread.
+        '''
+        with self._fill_lock:
+            fd = self.fill_dict.get(msg.orderId)
+            if fd is None or fd['filled']:
+                return
+
+            done = msg.status in ('Filled', 'Cancelled', 'ApiCancelled', 'Inactive')
+            if msg.filled > fd['reported'] and (self.emit_partial_fills or done):
+                self.create_fill(msg, fd)
+            if done:
+                # Make sure that multiple messages dont create additional fills
+                fd['filled'] = True
+
+    def create_fill(self, msg, fd):
         '''
         Handles the creation of the FillEvent that will be placed onto the events queue subsequent to an order being filled
         '''
-        fd = self.fill_dict[msg.orderId]
-
-        # Prepare tge fill data
-        symbol = fd['symbol']
-        exchange = fd['exchange']
-        filled = msg.filled
-        direction = fd['direction']
-        fill_cost = msg.avgFillPrice
+        # Prepare the fill data: only the part of the cumulative fill that hasn't been reported yet
+        filled = msg.filled - fd['reported']
+        total_cost = msg.avgFillPrice * msg.filled
+        fill_cost = (total_cost - fd['reported_cost']) / filled
 
         # Create a fill event object
-        fill = FillEvent(
-            datetime.datetime.utcnow(), symbol, exchange, filled, direction, fill_cost
+        fill_event = FillEvent(
+            datetime.datetime.utcnow(), fd['symbol'], fd['exchange'], filled, fd['direction'], fill_cost
         )
 
-        # Make sure that multiple messages dont create additional fills
-        self.fill_dict[msg.orderId]['filled'] = True
+        fd['reported'] = msg.filled
+        fd['reported_cost'] = total_cost
 
         # Place the fill event onto the event queue
         self.events.put(fill_event)
 
-    def execute_order(self, event):
+    def _submit_loop(self):
         '''
-        Creates the necessary InteractiveBrokers order object and submits it to IB via their API
+        Sends the queued orders to TWS one after another, in the order they were executed. Runs on the I/O thread
+        '''
+        while True:
+            item = self._outbox.get()
+            if item is None:
+                break
+            order_id, ib_contract, ib_order = item
+            try:
+                with self.tracer.span('IB.placeOrder', 'ib', {'order_id': order_id}):
+                    self.tws_conn.placeOrder(order_id, ib_contract, ib_order)
+            except Exception as e:
+                self.journal.error('IB_SUBMIT_ERROR', order_id = order_id, msg = str(e))
 
-        The results are then queried in order to generate a corresponding FillEvent, which is placed back on the event queue.
+    def execute_order(self, event):
+        '''
+        Creates the necessary InteractiveBrokers order object and queues it for submission to IB via their API.
+        It returns straight away; the I/O thread sends the order, and the FillEvent is placed on the event queue
+        when the server reports the order filled.
 
         Paramaters:
         event - Contains an Event object with order information (OrderEvent?)
@@ -175,16 +261,32 @@ class IBExecutionHandler(ExecutionHandler):
 
             # Create the Interact Brokers order via the passed OrderEvent
             ib_order = self.create_order(
-                order_type, quantity, direction
+                order_type, quantity, direction, getattr(event, 'limit_price', None),
+                getattr(event, 'stop_price', None), getattr(event, 'time_in_force', None)
             )
 
-            # Use the connection to send the order to IB
-            self.tws_conn.placeOrder(
-                self.order_id, ib_contract, ib_order
-            )
-
-            # NOTE: this part is crucial bc it ensures the order goes through
-            time.sleep(1)
+            # register the order before it can possibly be answered, then hand it to the I/O thread
+            with self._fill_lock:
+                self.create_fill_dict_entry(self.order_id, asset, self.order_routing, direction, quantity)
+            event.order_id = self.order_id
+            self._outbox.put((self.order_id, ib_contract, ib_order))
+            # marks when the order was queued, to tell the wait for the I/O thread from the time in placeOrder()
+            self.tracer.instant('IB.order_queued', 'ib', {'order_id': self.order_id})
 
             # Increment the order ID for this session
             self.order_id += 1
+
+    def pending_orders(self):
+        '''
+        Returns the number of submitted orders that haven't been completely filled or cancelled yet
+        '''
+        with self._fill_lock:
+            return sum(1 for fd in self.fill_dict.values() if not fd['filled'])
+
+    def close(self):
+        '''
+        Sends the orders still queued, stops the I/O thread and disconnects from TWS
+        '''
+        self._outbox.put(None)
+        self._io_thread.join()
+        self.tws_conn.disconnect()
@@ -0,0 +1,300 @@
+# indicator_cache.py
+
+# A memo of indicator series shared by the IndicatorBanks of a process. The value of an indicator after every
+# bar is recorded into a series per symbol, keyed by (symbol, fields, indicator, params, data version). Another
+# bank on the same data handler (e.g. a second strategy using the same moving average) replays the series as
+# it is being recorded instead of computing the indicator again, and once a run has gone through all of the
+# data its series are reused by later runs over the same data, e.g. the members of a parameter sweep.
+#
+# Memory is bounded by evicting the least recently used series, counting the series still being recorded, and
+# complete series can be persisted to a directory so they outlive the process. A bank stops recording once all
+# of the series it records have been evicted, except series another bank is replaying while they are recorded.
+
+from __future__ import print_function
+
+from collections import OrderedDict
+import hashlib
+import os, os.path
+import uuid
+
+import numpy as np
+
+from checkpoint import saving_segments, save_segment, keep_segments, load_segment
+
+
+class SeriesRecorder(object):
+    '''
+    A growable (bars x columns) float array that rows are appended to. A windowed recorder only keeps its latest
+    rows, for the banks replaying series that were evicted from the cache while they were being recorded
+    '''
+
+    window_rows = 16
+
+    def __init__(self, n_columns, capacity = 256):
+        self.data = np.empty((max(1, capacity), n_columns))
+        self.n = 0
+        self.offset = 0 # the bar of data[0]; the rows before it were dropped by window()
+        self.windowed = False
+        self.prefix = 'series_%s' % uuid.uuid4().hex[:12]
+        self._checkpoints = {} # checkpoint segment directory -> (segment names, number of rows they hold)
+
+    @classmethod
+    def from_column(cls, values):
+        '''
+        Returns a single column recorder holding a copy of values
+        '''
+        recorder = cls(1, len(values))
+        recorder.data[:len(values), 0] = values
+        recorder.n = len(values)
+        return recorder
+
+    def window(self):
+        '''
+        Drops every row but the latest, and from then on keeps at most window_rows rows
+        '''
+        keep = min(self.n - self.offset, 1)
+        rows = self.data[self.n - self.offset - keep:self.n - self.offset]
+        self.data = np.empty((self.window_rows, self.data.shape[1]))
+        self.data[:keep] = rows
+        self.offset = self.n - keep
+        self.windowed = True
+
+    def append(self, row):
+        '''
+        Appends a row. Returns True if the array had to grow to take it
+        '''
+        i = self.n - self.offset
+        grew = False
+        if i == len(self.data):
+            if self.windowed:
+                # start over from the latest row
+                self.data[0] = self.data[i - 1]
+                self.offset = self.n - 1
+                i = 1
+            else:
+                grown = np.empty((2 * len(self.data), self.data.shape[1]))
+                grown[:i] = self.data[:i]
+                self.data = grown
+                grew = True
+        self.data[i] = row
+        self.n += 1
+        return grew
+
+    def column(self, j):
+        return self.data[:self.n - self.offset, j]
+
+    def __getstate__(self):
+        '''
+        In a checkpoint the rows are saved as segments, only the rows appended since the last checkpoint being
+        written out. A windowed recorder only has a few rows and is pickled as it is
+        '''
+        state = self.__dict__.copy()
+        directory = saving_segments()
+        if directory is None or self.windowed:
+            return state
+
+        names, saved = self._checkpoints.get(directory, ([], 0))
+        if self.n > saved:
+            name = '%s_%d.pkl' % (self.prefix, saved)
+            names = names + [save_segment(name, self.data[saved:self.n].copy())]
+            saved = self.n
+        self._checkpoints[directory] = (names, saved)
+        keep_segments(names)
+
+        state['_checkpoints'] = dict(self._checkpoints)
+        state['data'] = (names, self.data.shape)
+        state['_segmented'] = True
+        return state
+
+    def __setstate__(self, state):
+        segmented = state.pop('_segmented', False)
+        self.__dict__.update(state)
+        if segmented:
+            names, shape = state['data']
+            self.data = np.empty(shape)
+            if names:
+                self.data[:self.n] = np.concatenate([load_segment(name) for name in names])
+
+
+class CachedSeries(object):
+    '''
+    One symbol's indicator series: a column of a SeriesRecorder, row t being the value after bar t
+    '''
+
+    def __init__(self, recorder, column, owner = None):
+        '''
+        Parameters:
+        recorder - The SeriesRecorder holding the series
+        column - The column of the series in the recorder
+        owner - A token of the data handler whose run is still recording the series, None once it is complete
+        '''
+        self.recorder = recorder
+        self.column = column
+        self.owner = owner
+        self.replayed = False # whether another bank replays the series while it is being recorded
+
+    def __len__(self):
+        return self.recorder.n
+
+    @property
+    def complete(self):
+        return self.owner is None
+
+    @property
+    def nbytes(self):
+        return self.recorder.n * self.recorder.data.itemsize
+
+    def values(self):
+        return self.recorder.column(self.column)
+
+
+class IndicatorCache(object):
+    '''
+    An LRU cache of CachedSeries, bounded by the bytes of their values, optionally backed by a directory of
+    .npy files (one per complete series)
+    '''
+
+    def __init__(self, max_bytes = 64 * 1024 * 1024, cache_dir = None):
+        '''
+        Parameters:
+        max_bytes - The least recently used series are dropped from memory once the series held take more
+        cache_dir - (Optional) The directory complete series are saved to and looked up in
+        '''
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def nbytes(self):
+        '''
+        Returns the bytes taken by the values of the series held in memory, counting the whole array of the
+        recorders of series still being recorded
+        '''
+        total = 0
+        recording = set()
+        for entry in self._entries.values():
+            if entry.complete:
+                total += entry.nbytes
+            elif id(entry.recorder) not in recording:
+                recording.add(id(entry.recorder))
+                total += entry.recorder.data.nbytes
+        return total
+
+    def holds(self, key, entry):
+        '''
+        Whether entry is still the series held under key (it may have been evicted or replaced)
+        '''
+        return self._entries.get(key) is entry
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npy')
+
+    def lookup(self, key, owner):
+        '''
+        Returns the CachedSeries under key that a bank on the data handler with the token owner can replay: a
+        complete series, or one that is being recorded on that same handler. Returns None otherwise
+        '''
+        entry = self._entries.get(key)
+        if entry is not None and (entry.complete or entry.owner is owner):
+            # move it to the most recently used end
+            del self._entries[key]
+            self._entries[key] = entry
+            if not entry.complete:
+                entry.replayed = True
+            self.hits += 1
+            return entry
+
+        if entry is None and self.cache_dir is not None and os.path.exists(self._path(key)):
+            entry = CachedSeries(SeriesRecorder.from_column(np.load(self._path(key))), 0)
+            self.insert(key, entry)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        return None
+
+    def insert(self, key, entry):
+        '''
+        Adds (or replaces) the series under key
+        '''
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        self.evict()
+
+    def complete(self, key, entry):
+        '''
+        Marks a recorded series as complete, so other runs can reuse it, compacting it into its own array and
+        saving it to the cache directory if there is one
+        '''
+        entry.recorder = SeriesRecorder.from_column(entry.values())
+        entry.column = 0
+        entry.owner = None
+
+        if self.cache_dir is not None:
+            path = self._path(key)
+            tmp_path = path + '.tmp.npy'
+            np.save(tmp_path, entry.values())
+            os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        '''
+        Drops the least recently used series until the series held fit in max_bytes (except the last complete
+        one). Banks call this whenever their recordings grow
+        '''
+        total = self.nbytes()
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            if entry.complete:
+                if len(self._entries) <= 1:
+                    break
+                total -= entry.nbytes
+                del self._entries[key]
+                continue
+
+            # a recorder's array is only freed with all of its series, so they are evicted together
+            recorder = entry.recorder
+            total -= recorder.data.nbytes
+            series = [(k, e) for k, e in self._entries.items() if not e.complete and e.recorder is recorder]
+            for k, e in series:
+                del self._entries[k]
+            if any(e.replayed for k, e in series):
+                # another bank replays the series as they are recorded, which only needs their latest rows
+                recorder.window()
+
+    def clear(self):
+        '''
+        Drops every series held in memory (the files in the cache directory are kept)
+        '''
+        self._entries.clear()
+
+
+_cache = IndicatorCache()
+
+
+def get_indicator_cache():
+    '''
+    Returns the cache IndicatorBanks record to and replay from (None if caching was turned off)
+    '''
+    return _cache
+
+
+def set_indicator_cache(cache):
+    '''
+    Sets the cache returned by get_indicator_cache(), e.g. an IndicatorCache with a cache_dir for a sweep.
+    Passing None turns caching off
+    '''
+    global _cache
+    _cache = cache
+    return _cache
@@ -0,0 +1,593 @@
+# indicators.py
+
+# Streaming technical indicators. Each indicator keeps its state for all symbols in numpy arrays, with a column
+# per symbol, and is updated with one array of new values per bar, so the cost of a bar is O(1) per symbol
+# (independent of the window length) and the work is vectorised across symbols. NaN inputs mean "no new bar
+# for this symbol" and leave that symbol's state untouched.
+#
+# An IndicatorBank registers itself as a bar listener on the DataHandler and feeds its indicators the latest
+# bar values after every update_bars(), before the strategies see the MarketEvent:
+#
+#   bank = IndicatorBank(bars)
+#   fast = bank.add('fast', SMA(100), 'adj_close_price')
+#   ...
+#   fast.value  # numpy array, one value per symbol of bank.symbol_list
+#
+# Banks record their indicators' values into the indicator cache (see indicator_cache.py), so an indicator
+# another bank or an earlier run over the same data has already computed is replayed instead.
+
+from __future__ import print_function
+
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
+import numpy as np
+
+from indicator_cache import CachedSeries, SeriesRecorder, get_indicator_cache
+
+
+class StreamingIndicator(object):
+    '''
+    An abstract base class for indicators that are updated one bar at a time for a fixed set of symbols
+
+    After bind(n_symbols), every update(*inputs) takes one array of length n_symbols per input and updates
+    value (NaN until a symbol's first bar) and count (the number of bars seen per symbol).
+    '''
+
+    __metaclass__ = ABCMeta
+
+    # the number of input arrays update() takes, e.g. 3 for (high, low, close)
+    n_inputs = 1
+
+    # the attributes that, with the class, identify the indicator's values (its cache key)
+    param_names = ()
+
+    # only value is recorded to the indicator cache, so indicators with other outputs turn caching off
+    cacheable = True
+
+    @property
+    def params(self):
+        return tuple((name, getattr(self, name)) for name in self.param_names)
+
+    def bind(self, n_symbols):
+        '''
+        Allocates the state for n_symbols symbols. Subclasses extend this with their own arrays
+        '''
+        self.n_symbols = n_symbols
+        self.value = np.full(n_symbols, np.nan)
+        self.count = np.zeros(n_symbols, dtype = np.int64)
+
+    @property
+    def ready(self):
+        '''
+        A boolean array, True for the symbols that have seen enough bars for a full lookback
+        '''
+        return self.count >= self.period
+
+    @abstractmethod
+    def update(self, *inputs):
+        '''
+        Adds the new bar values of every symbol and returns the updated value array
+        '''
+        raise NotImplementedError('Should implement update()')
+
+    @staticmethod
+    def _columns(x):
+        '''
+        Returns the indices of the symbols with a new (non-NaN) value in x
+        '''
+        return np.flatnonzero(~np.isnan(x))
+
+
+def push_ring_buffer(buffer, count, cols, new, window):
+    '''
+    Writes a new row for each of the columns into a (window x columns x ...) ring buffer and advances their
+    counts. Returns the rows that were overwritten (zero while a buffer is filling up) and the columns whose
+    buffer just wrapped, i.e. holds the window in time order
+
+    Parameters:
+    buffer - The ring buffers, window rows per column
+    count - The number of rows pushed per column, updated
+    cols - The columns that get a new row
+    new - The new rows, one per column of cols
+    window - The length of the buffers
+    '''
+    pos = count[cols] % window
+    old = buffer[pos, cols]
+    buffer[pos, cols] = new
+    count[cols] += 1
+    return old, cols[count[cols] % window == 0]
+
+
+class _RollingWindow(StreamingIndicator):
+    '''
+    Keeps the last `window` values of each symbol in a ring buffer, with running sums that are maintained
+    incrementally and recomputed from the buffer once per window to stop rounding errors building up
+    '''
+
+    param_names = ('window',)
+
+    def __init__(self, window):
+        if window < 1:
+            raise ValueError('window must be at least 1')
+        self.window = window
+        self.period = window
+
+    def bind(self, n_symbols):
+        super(_RollingWindow, self).bind(n_symbols)
+        self.buffer = np.zeros((self.window, n_symbols))
+        self.total = np.zeros(n_symbols)
+        self.total_sq = np.zeros(n_symbols)
+
+    def _push(self, x):
+        '''
+        Puts the new values into the ring buffers, updates the running sums and returns the updated columns
+        '''
+        cols = self._columns(x)
+        if len(cols) == 0:
+            return cols
+        new = x[cols]
+        old, wrapped = push_ring_buffer(self.buffer, self.count, cols, new, self.window)
+        self.total[cols] += new - old
+        self.total_sq[cols] += new * new - old * old
+
+        # when a buffer wraps it holds the window in time order; summing it sequentially (cumsum rather than
+        # the pairwise sum()) gives the same total as adding the values one by one, so e.g. two SMAs of
+        # different lengths over the same bars are exactly equal while both are still filling up
+        if len(wrapped):
+            self.total[wrapped] = self.buffer[:, wrapped].cumsum(axis = 0)[-1]
+            self.total_sq[wrapped] = (self.buffer[:, wrapped] ** 2).cumsum(axis = 0)[-1]
+        return cols
+
+    def _n(self, cols):
+        return np.minimum(self.count[cols], self.window)
+
+
+class SMA(_RollingWindow):
+    '''
+    Simple moving average. Until a symbol has `window` bars it is the mean of the bars seen so far
+    '''
+
+    def update(self, x):
+        cols = self._push(x)
+        self.value[cols] = self.total[cols] / self._n(cols)
+        return self.value
+
+
+class RollingStd(_RollingWindow):
+    '''
+    Rolling standard deviation, from running sums of the values and their squares
+    '''
+
+    param_names = ('window', 'ddof')
+
+    def __init__(self, window, ddof = 1):
+        super(RollingStd, self).__init__(window)
+        self.ddof = ddof
+
+    def _std(self, cols):
+        n = self._n(cols).astype(np.float64)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            var = (self.total_sq[cols] - self.total[cols] ** 2 / n) / (n - self.ddof)
+        var[n <= self.ddof] = np.nan
+        return np.sqrt(np.maximum(var, 0.0))
+
+    def update(self, x):
+        cols = self._push(x)
+        self.value[cols] = self._std(cols)
+        return self.value
+
+
+class ZScore(RollingStd):
+    '''
+    The number of rolling standard deviations the latest value is from the rolling mean (NaN when the
+    standard deviation is zero)
+    '''
+
+    def update(self, x):
+        cols = self._push(x)
+        std = self._std(cols)
+        mean = self.total[cols] / self._n(cols)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            z = (x[cols] - mean) / std
+        z[std == 0] = np.nan
+        self.value[cols] = z
+        return self.value
+
+
+class RollingMax(StreamingIndicator):
+    '''
+    Rolling maximum, using the van Herk/Gil-Werman block decomposition: the window is the start of the current
+    block of `window` bars (a running prefix maximum) plus the end of the previous block (suffix maxima,
+    computed once per block), so each bar costs O(1) amortised
+    '''
+
+    _sign = 1.0 # -1.0 turns it into a rolling minimum
+    param_names = ('window',)
+
+    def __init__(self, window):
+        if window < 1:
+            raise ValueError('window must be at least 1')
+        self.window = window
+        self.period = window
+
+    def bind(self, n_symbols):
+        super(RollingMax, self).bind(n_symbols)
+        self.block = np.full((self.window, n_symbols), -np.inf)
+        self.suffix = np.full((self.window + 1, n_symbols), -np.inf) # the last row stays -inf
+        self.prefix = np.full(n_symbols, -np.inf)
+
+    def update(self, x):
+        cols = self._columns(x)
+        if len(cols) == 0:
+            return self.value
+        new = self._sign * x[cols]
+        pos = self.count[cols] % self.window
+
+        self.block[pos, cols] = new
+        self.prefix[cols] = np.where(pos == 0, new, np.maximum(self.prefix[cols], new))
+        self.value[cols] = self._sign * np.maximum(self.prefix[cols], self.suffix[pos + 1, cols])
+        self.count[cols] += 1
+
+        done = cols[pos == self.window - 1]
+        if len(done):
+            self.suffix[:self.window, done] = np.maximum.accumulate(self.block[::-1, done], axis = 0)[::-1]
+        return self.value
+
+
+class RollingMin(RollingMax):
+    '''
+    Rolling minimum (a RollingMax of the negated values)
+    '''
+
+    _sign = -1.0
+
+
+class EMA(StreamingIndicator):
+    '''
+    Exponential moving average, seeded with a symbol's first value (pandas' ewm(adjust = False))
+    '''
+
+    param_names = ('alpha',)
+
+    def __init__(self, span = None, alpha = None):
+        '''
+        Parameters:
+        span - The span of the average, alpha = 2 / (span + 1)
+        alpha - (Optional) The smoothing factor, instead of span
+        '''
+        if (span is None) == (alpha is None):
+            raise ValueError('Give exactly one of span and alpha')
+        self.alpha = alpha if alpha is not None else 2.0 / (span + 1.0)
+        self.period = span if span is not None else 1
+
+    def update(self, x):
+        cols = self._columns(x)
+        new = x[cols]
+        prev = self.value[cols]
+        self.value[cols] = np.where(self.count[cols] == 0, new, self.alpha * new + (1.0 - self.alpha) * prev)
+        self.count[cols] += 1
+        return self.value
+
+
+class _WilderIndicator(StreamingIndicator):
+    '''
+    Base for indicators built on Wilder's smoothing: the first `window` observations are averaged, then
+    avg = (avg * (window - 1) + x) / window. The first bar of a symbol only sets its previous close
+    '''
+
+    param_names = ('window',)
+
+    def __init__(self, window):
+        if window < 1:
+            raise ValueError('window must be at least 1')
+        self.window = window
+        self.period = window + 1 # bars, including the one that only sets the previous close
+
+    def bind(self, n_symbols):
+        super(_WilderIndicator, self).bind(n_symbols)
+        self.prev_close = np.full(n_symbols, np.nan)
+
+    def _smooth(self, avg, n_obs, x):
+        '''
+        Returns the smoothed averages after adding observation x, where n_obs observations were seen before
+        '''
+        w = self.window
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            seed = (np.nan_to_num(avg) * n_obs + x) / (n_obs + 1.0)
+        return np.where(n_obs < w, seed, (avg * (w - 1) + x) / w)
+
+
+class ATR(_WilderIndicator):
+    '''
+    Average true range. With only closes available (high and low omitted or equal to the close) the true
+    range is the absolute close-to-close change
+    '''
+
+    n_inputs = 3
+
+    def update(self, high, low, close):
+        cols = self._columns(close)
+        if len(cols) == 0:
+            return self.value
+        h, l, c = high[cols], low[cols], close[cols]
+        prev = self.prev_close[cols]
+        has_prev = ~np.isnan(prev)
+
+        tr = np.maximum(h - l, np.maximum(np.abs(h - prev), np.abs(l - prev)))
+        n_obs = self.count[cols] - 1 # true ranges seen before this bar
+        smoothed = self._smooth(self.value[cols], n_obs, tr)
+        self.value[cols] = np.where(has_prev, smoothed, self.value[cols])
+
+        self.prev_close[cols] = c
+        self.count[cols] += 1
+        return self.value
+
+
+class RSI(_WilderIndicator):
+    '''
+    Relative strength index, 100 - 100 / (1 + average gain / average loss) with Wilder's smoothing. It is 100
+    when there were only gains and 50 when the price hasn't moved
+    '''
+
+    def bind(self, n_symbols):
+        super(RSI, self).bind(n_symbols)
+        self.avg_gain = np.full(n_symbols, np.nan)
+        self.avg_loss = np.full(n_symbols, np.nan)
+
+    def update(self, x):
+        cols = self._columns(x)
+        if len(cols) == 0:
+            return self.value
+        new = x[cols]
+        prev = self.prev_close[cols]
+        has_prev = ~np.isnan(prev)
+        change = np.where(has_prev, new - prev, 0.0)
+
+        n_obs = self.count[cols] - 1
+        gain = self._smooth(self.avg_gain[cols], n_obs, np.maximum(change, 0.0))
+        loss = self._smooth(self.avg_loss[cols], n_obs, np.maximum(-change, 0.0))
+        self.avg_gain[cols] = np.where(has_prev, gain, np.nan)
+        self.avg_loss[cols] = np.where(has_prev, loss, np.nan)
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            rsi = 100.0 - 100.0 / (1.0 + gain / loss)
+        rsi = np.where(loss == 0, np.where(gain == 0, 50.0, 100.0), rsi)
+        self.value[cols] = np.where(has_prev, rsi, np.nan)
+
+        self.prev_close[cols] = new
+        self.count[cols] += 1
+        return self.value
+
+
+class ReplayIndicator(StreamingIndicator):
+    '''
+    Stands in for an indicator whose series are all in the indicator cache: each update() reads the values of
+    the next bar from the cached series instead of computing them. The counts are still kept from the inputs
+    '''
+
+    def __init__(self, indicator, entries, start = 0):
+        '''
+        Parameters:
+        indicator - The indicator that is replayed
+        entries - The CachedSeries of each symbol, in the order of the bank's symbols
+        start - The bar the replay starts at
+        '''
+        self.indicator = indicator
+        self.entries = entries
+        self.t = start
+        self.n_inputs = indicator.n_inputs
+        self.period = indicator.period
+
+    @property
+    def params(self):
+        return self.indicator.params
+
+    def bind(self, n_symbols):
+        super(ReplayIndicator, self).bind(n_symbols)
+        # group the symbols by the recorder their series is in, so every group is read with one fancy index
+        # (a series being recorded keeps its recorder when it is completed, so the recorders are held on to)
+        groups = OrderedDict()
+        for j, entry in enumerate(self.entries):
+            groups.setdefault(id(entry.recorder), []).append(j)
+        self.groups = [
+            (self.entries[cols[0]].recorder, np.array(cols), np.array([self.entries[j].column for j in cols]))
+            for cols in groups.values()
+        ]
+
+    def update(self, *inputs):
+        new = ~np.isnan(inputs[0])
+        for x in inputs[1:]:
+            new &= ~np.isnan(x)
+        self.count[new] += 1
+        for recorder, cols, columns in self.groups:
+            if recorder.offset <= self.t < recorder.n:
+                self.value[cols] = recorder.data[self.t - recorder.offset, columns]
+            else:
+                self.value[cols] = np.nan
+        self.t += 1
+        return self.value
+
+
+class IndicatorBank(object):
+    '''
+    A set of streaming indicators over the symbols of a DataHandler, updated by the handler after every bar
+    '''
+
+    def __init__(self, bars, symbol_list = None):
+        '''
+        Registers the bank as a bar listener of the data handler
+
+        Parameters:
+        bars - The DataHandler object that provides bar information
+        symbol_list - (Optional) The symbols to compute the indicators for, defaults to all of the handler's
+        '''
+        self.bars = bars
+        self.symbol_list = list(symbol_list if symbol_list is not None else bars.symbol_list)
+        self.symbol_index = dict((s, i) for i, s in enumerate(self.symbol_list))
+        self.n_columns = len(self.symbol_list) # the columns of the indicators, one per symbol
+        handler_index = dict((s, i) for i, s in enumerate(bars.symbol_list))
+        self._bar_columns = np.array([handler_index[s] for s in self.symbol_list], dtype = np.int64)
+        self.indicators = OrderedDict() # name -> (indicator, fields)
+        self.n_updates = bars.bars_pushed # the number of bars the handler has pushed
+
+        # the indicators being recorded to the cache: (indicator, recorder, [(key, CachedSeries)])
+        self.cache = get_indicator_cache()
+        self.recordings = []
+
+        # series being recorded are tagged with a token of the handler (not its id(), which can be reused)
+        self.owner = bars._indicator_cache_owner
+        if self.owner is None:
+            self.owner = bars._indicator_cache_owner = object()
+
+        self.bars.add_bar_listener(self.on_bars)
+
+    def add(self, name, indicator, fields = 'adj_close_price'):
+        '''
+        Adds an indicator and returns it
+
+        Parameters:
+        name - The name the indicator is looked up by
+        indicator - A StreamingIndicator instance (not yet bound)
+        fields - The bar field, or a tuple of fields (one per input, e.g. (high, low, close) for ATR), that
+                 the indicator is fed with
+        '''
+        if isinstance(fields, str):
+            fields = (fields,) * indicator.n_inputs
+        if len(fields) != indicator.n_inputs:
+            raise ValueError('%s takes %d input fields' % (type(indicator).__name__, indicator.n_inputs))
+        fields = tuple(fields)
+
+        keys = self._cache_keys(indicator, fields) if indicator.cacheable else None
+        if keys is not None:
+            entries = [self.cache.lookup(key, self.owner) for key in keys]
+            if all(entry is not None for entry in entries):
+                indicator = ReplayIndicator(indicator, entries, self.n_updates)
+            elif self.n_updates == 0:
+                # record the series the cache doesn't have yet (a series has to start at the first bar)
+                recorder = SeriesRecorder(self.n_columns)
+                recorded = []
+                for j, (key, entry) in enumerate(zip(keys, entries)):
+                    if entry is None:
+                        entry = CachedSeries(recorder, j, owner = self.owner)
+                        self.cache.insert(key, entry)
+                        recorded.append((key, entry))
+                # the recorder may already be over the cache's budget
+                recorded = [(key, entry) for key, entry in recorded if self.cache.holds(key, entry)]
+                if recorded or recorder.windowed:
+                    self.recordings.append((indicator, recorder, recorded))
+
+        indicator.bind(self.n_columns)
+        self.indicators[name] = (indicator, fields)
+        return indicator
+
+    def __getstate__(self):
+        # the cache is the process's; only the series this bank is recording (and replaying) go into a checkpoint
+        state = self.__dict__.copy()
+        state['cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = get_indicator_cache()
+        if self.cache is None:
+            self.recordings = []
+        for indicator, recorder, recorded in self.recordings:
+            for key, entry in recorded:
+                self.cache.insert(key, entry)
+
+    def extendable(self):
+        '''
+        Whether the bank can go on with bars appended to the data after a run finished: not if any of its
+        indicators are replayed from the cache, as their series end with the old data
+        '''
+        return not any(isinstance(indicator, ReplayIndicator) for indicator, fields in self.indicators.values())
+
+    def _cache_keys(self, indicator, fields):
+        '''
+        Returns the cache key of the indicator's series for each symbol, or None if the indicator can't be
+        cached (no cache, or a data handler that can't tell which version of the data it is pushing)
+        '''
+        if self.cache is None or not hasattr(self.bars, 'data_version'):
+            return None
+        keys = []
+        for s in self.symbol_list:
+            version = self.bars.data_version(s)
+            if version is None:
+                return None
+            keys.append((s, fields, type(indicator).__name__, indicator.params, version))
+        return keys
+
+    def on_bars(self, symbols):
+        '''
+        Feeds the indicators the latest bar values of the given symbols; the other symbols get NaN (no bar)
+
+        Parameters:
+        symbols - The symbols that got a new bar
+        '''
+        self.n_updates += 1
+        if not self.indicators:
+            return
+        # every indicator is updated on every bar, even without new values, so the recorded series of all
+        # the banks on a handler have a row per bar
+        updated = [s for s in symbols if s in self.symbol_index]
+        cols = [self.symbol_index[s] for s in updated]
+
+        # read each field once, however many indicators use it; when every symbol has a new bar (the usual
+        # case) as one array across the symbols
+        inputs = {}
+        for indicator, fields in self.indicators.values():
+            for field in fields:
+                if field not in inputs:
+                    if len(cols) == len(self.symbol_list):
+                        values = self.bars.get_latest_bar_array(field)[self._bar_columns].astype(np.float64)
+                    else:
+                        values = np.full(len(self.symbol_list), np.nan)
+                        values[cols] = [self.bars.get_latest_bar_value(s, field) for s in updated]
+                    inputs[field] = values
+            indicator.update(*self._column_inputs(fields, inputs))
+
+        grew = False
+        for indicator, recorder, recorded in self.recordings:
+            grew = recorder.append(indicator.value) or grew
+        if grew:
+            # the recordings count against the cache's memory budget, so check it whenever they take more
+            self.cache.evict()
+            self._drop_evicted_recordings()
+        if not self.bars.continue_backtest:
+            # the data is exhausted, so the series are complete and later runs can reuse them
+            for indicator, recorder, recorded in self.recordings:
+                for key, entry in recorded:
+                    if entry.owner is self.owner and self.cache.holds(key, entry):
+                        self.cache.complete(key, entry)
+            self.recordings = []
+
+    def _drop_evicted_recordings(self):
+        '''
+        Stops recording the indicators none of whose series are held by the cache any more, unless another bank
+        is replaying them (then their recorder is windowed and only keeps the latest rows)
+        '''
+        recordings = []
+        for indicator, recorder, recorded in self.recordings:
+            recorded = [(key, entry) for key, entry in recorded if self.cache.holds(key, entry)]
+            if recorded or recorder.windowed:
+                recordings.append((indicator, recorder, recorded))
+        self.recordings = recordings
+
+    def _column_inputs(self, fields, inputs):
+        '''
+        Returns the input arrays of an indicator fed with fields, given the bar values of every symbol per field
+        '''
+        return [inputs[f] for f in fields]
+
+    def __getitem__(self, name):
+        '''
+        Returns the value array of the named indicator, in the order of symbol_list
+        '''
+        return self.indicators[name][0].value
+
+    def value(self, name, symbol):
+        '''
+        Returns the named indicator's value for one symbol
+        '''
+        return self.indicators[name][0].value[self.symbol_index[symbol]]
@@ -0,0 +1,203 @@
+# journal.py
+
+# A buffered, structured journal for trades and other events. It replaces print() calls in the hot path of the
+# event loop: recording an entry only appends a dict to an in-memory buffer, and a background thread serialises
+# the buffer to a line-delimited JSON file. The default journal is a NullJournal that discards everything.
+
+from __future__ import print_function
+
+import collections
+import json
+import os.path
+import threading
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+
+class NullJournal(object):
+    '''
+    A journal that records nothing. This is the default so that components can always call their journal
+    without checking whether one was configured, at the cost of a single no-op method call
+    '''
+
+    level = ERROR + 1
+
+    def enabled_for(self, level):
+        return False
+
+    def record(self, level, kind, **fields):
+        pass
+
+    def debug(self, kind, **fields):
+        pass
+
+    def info(self, kind, **fields):
+        pass
+
+    def warning(self, kind, **fields):
+        pass
+
+    def error(self, kind, **fields):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class EventJournal(NullJournal):
+    '''
+    Writes structured records to a line-delimited JSON file from a background thread.
+
+    Each record is a flat dict with a 'level', a 'kind' (e.g. 'ORDER', 'SIGNAL', 'IB_ERROR') and whatever fields
+    the caller passes. Records below the journal's level are dropped before anything is allocated. Values that
+    aren't JSON types (datetimes, numpy scalars) are written with str().
+    '''
+
+    def __init__(self, path, level=INFO, flush_interval=0.5, max_buffer=10000):
+        '''
+        Opens the journal file for appending and starts the writer thread
+
+        Parameters:
+        path - The file the records are appended to, one JSON object per line
+        level - The minimum level that is recorded (DEBUG, INFO, WARNING or ERROR)
+        flush_interval - Seconds between background flushes
+        max_buffer - Number of buffered records that triggers an early flush
+        '''
+        self.path = path
+        self.level = level
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+
+        # deque.append and deque.popleft are atomic, so the hot path never has to take a lock
+        self._buffer = collections.deque()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+
+        self._file = open(path, 'a')
+        self._thread = threading.Thread(target = self._flush_loop, name = 'EventJournal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def enabled_for(self, level):
+        '''
+        Returns True if records at this level are kept. Use it to skip building expensive fields
+        '''
+        return level >= self.level
+
+    def record(self, level, kind, **fields):
+        '''
+        Buffers a record. The record is serialised later by the writer thread
+
+        Parameters:
+        level - The level of the record
+        kind - A short upper-case tag describing the record
+        fields - The payload of the record
+        '''
+        if level < self.level:
+            return
+        fields['level'] = LEVEL_NAMES.get(level, level)
+        fields['kind'] = kind
+        self._buffer.append(fields)
+        if len(self._buffer) >= self.max_buffer:
+            self._wakeup.set()
+
+    def debug(self, kind, **fields):
+        self.record(DEBUG, kind, **fields)
+
+    def info(self, kind, **fields):
+        self.record(INFO, kind, **fields)
+
+    def warning(self, kind, **fields):
+        self.record(WARNING, kind, **fields)
+
+    def error(self, kind, **fields):
+        self.record(ERROR, kind, **fields)
+
+    def _write_pending(self):
+        '''
+        Drains the buffer into the file. Safe to call from the writer thread and from flush() at the same time
+        '''
+        with self._write_lock:
+            lines = []
+            while True:
+                try:
+                    rec = self._buffer.popleft()
+                except IndexError:
+                    break
+                lines.append(json.dumps(rec, default = str, separators = (',', ':')))
+            if lines:
+                self._file.write('\n'.join(lines) + '\n')
+                self._file.flush()
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._write_pending()
+
+    def flush(self):
+        '''
+        Synchronously writes everything buffered so far
+        '''
+        self._write_pending()
+
+    def __getstate__(self):
+        '''
+        A checkpointed journal keeps its settings and how far its file had been written
+        '''
+        if self._closed:
+            offset = os.path.getsize(self.path)
+        else:
+            self.flush()
+            offset = self._file.tell()
+        return {
+            'path': self.path, 'level': self.level, 'flush_interval': self.flush_interval,
+            'max_buffer': self.max_buffer, 'offset': offset
+        }
+
+    def __setstate__(self, state):
+        # records written after the checkpoint are dropped, as they will be written again
+        if os.path.exists(state['path']) and os.path.getsize(state['path']) > state['offset']:
+            with open(state['path'], 'r+') as f:
+                f.truncate(state['offset'])
+        self.__init__(state['path'], state['level'], state['flush_interval'], state['max_buffer'])
+
+    def close(self):
+        '''
+        Stops the writer thread, writes the remaining records and closes the file
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self._write_pending()
+        self._file.close()
+
+
+_journal = NullJournal()
+
+
+def get_journal():
+    '''
+    Returns the journal components should record to (a NullJournal unless set_journal() was called)
+    '''
+    return _journal
+
+
+def set_journal(journal):
+    '''
+    Sets the journal returned by get_journal(). Passing None restores the NullJournal
+    '''
+    global _journal
+    _journal = journal if journal is not None else NullJournal()
+    return _journal
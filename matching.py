@@ -0,0 +1,204 @@
+# matching.py
+
+# A resting-order book for simulated limit, stop and stop-limit orders. Orders are indexed per symbol in heaps
+# sorted by the price that triggers them, so matching a new bar only pops the orders whose trigger price lies
+# inside that bar's range; orders that can't trade on the bar are never looked at. Cancelled and expired orders
+# are removed lazily, when they reach the top of a heap.
+
+from __future__ import print_function
+
+import heapq
+import itertools
+
+
+class RestingOrder(object):
+    '''
+    An OrderEvent waiting in the OrderBook, plus its bookkeeping
+    '''
+
+    def __init__(self, order_id, order, expire_bar):
+        self.order_id = order_id
+        self.order = order
+        self.expire_bar = expire_bar
+        self.active = True
+        self.triggered = False # set once a stop-limit order's stop has been hit
+
+
+class OrderBook(object):
+    '''
+    Holds resting 'LMT', 'STP' and 'STP LMT' orders and matches them against each new bar's open/high/low.
+
+    Per symbol there are four heaps, each ordered so that the most marketable order is on top:
+        buy limits  - highest limit first, they trade when the low reaches the limit
+        sell limits - lowest limit first, they trade when the high reaches the limit
+        buy stops   - lowest stop first, they trigger when the high reaches the stop
+        sell stops  - highest stop first, they trigger when the low reaches the stop
+
+    Fill prices allow for gaps: a buy limit fills at min(limit, open), a buy stop at max(stop, open), and
+    the mirror images for sells. A triggered stop-limit fills at its trigger price if that is within its limit,
+    otherwise it rests as a limit order from the next bar on.
+    '''
+
+    def __init__(self):
+        self._books = {}
+        self._orders = {}
+        self._ids = itertools.count(1)
+        self._seq = itertools.count() # tie-breaker that keeps time priority between equal prices
+
+        # expiry queues: DAY orders by bar number, GTD orders by datetime
+        self._expire_bars = []
+        self._expire_times = []
+
+    def _book(self, symbol):
+        book = self._books.get(symbol)
+        if book is None:
+            book = {'buy_limit': [], 'sell_limit': [], 'buy_stop': [], 'sell_stop': []}
+            self._books[symbol] = book
+        return book
+
+    def __len__(self):
+        return len(self._orders)
+
+    def symbols(self):
+        '''
+        Returns the symbols that have resting orders
+        '''
+        return [s for s, book in self._books.items() if any(book.values())]
+
+    def _push_limit(self, resting, limit_price):
+        book = self._book(resting.order.symbol)
+        if resting.order.direction == 'BUY':
+            heapq.heappush(book['buy_limit'], (-limit_price, next(self._seq), resting))
+        else:
+            heapq.heappush(book['sell_limit'], (limit_price, next(self._seq), resting))
+
+    def _push_stop(self, resting, stop_price):
+        book = self._book(resting.order.symbol)
+        if resting.order.direction == 'BUY':
+            heapq.heappush(book['buy_stop'], (stop_price, next(self._seq), resting))
+        else:
+            heapq.heappush(book['sell_stop'], (-stop_price, next(self._seq), resting))
+
+    def add(self, order, bar_no):
+        '''
+        Adds an order to the book and returns its order id. It is first matched against the bar after bar_no
+
+        Parameters:
+        order - An OrderEvent with order_type 'LMT', 'STP' or 'STP LMT'
+        bar_no - The number of the bar the order was placed on
+        '''
+        if order.order_type not in ('LMT', 'STP', 'STP LMT'):
+            raise ValueError('OrderBook cannot rest a %r order' % order.order_type)
+
+        order_id = next(self._ids)
+        expire_bar = bar_no + 1 if order.time_in_force == 'DAY' else None
+        resting = RestingOrder(order_id, order, expire_bar)
+        self._orders[order_id] = resting
+
+        if order.order_type == 'LMT':
+            self._push_limit(resting, order.limit_price)
+        else:
+            self._push_stop(resting, order.stop_price)
+
+        if expire_bar is not None:
+            heapq.heappush(self._expire_bars, (expire_bar, order_id))
+        if order.time_in_force == 'GTD':
+            heapq.heappush(self._expire_times, (order.expire_time, order_id))
+        return order_id
+
+    def cancel(self, order_id):
+        '''
+        Cancels a resting order. Returns the RestingOrder, or None if it is no longer in the book
+        '''
+        resting = self._orders.pop(order_id, None)
+        if resting is not None:
+            resting.active = False
+        return resting
+
+    def expire_until_time(self, now):
+        '''
+        Cancels the GTD orders that expired before now and returns them
+        '''
+        expired = []
+        while self._expire_times and self._expire_times[0][0] < now:
+            resting = self.cancel(heapq.heappop(self._expire_times)[1])
+            if resting is not None:
+                expired.append(resting)
+        return expired
+
+    def expire_through_bar(self, bar_no):
+        '''
+        Cancels the DAY orders whose bar has passed and returns them
+        '''
+        expired = []
+        while self._expire_bars and self._expire_bars[0][0] <= bar_no:
+            resting = self.cancel(heapq.heappop(self._expire_bars)[1])
+            if resting is not None:
+                expired.append(resting)
+        return expired
+
+    @staticmethod
+    def _pop_crossing(heap, crosses):
+        '''
+        Pops and returns the active orders at the top of the heap for which crosses(price) holds, discarding
+        inactive entries on the way
+        '''
+        hits = []
+        while heap:
+            key, _, resting = heap[0]
+            if not resting.active:
+                heapq.heappop(heap)
+                continue
+            if not crosses(key):
+                break
+            heapq.heappop(heap)
+            hits.append(resting)
+        return hits
+
+    def match(self, symbol, open_price, high, low):
+        '''
+        Matches the symbol's resting orders against one bar and returns a list of (RestingOrder, fill price).
+        Filled orders are removed from the book
+
+        Parameters:
+        symbol - The symbol of the bar
+        open_price - The bar's open
+        high - The bar's high
+        low - The bar's low
+        '''
+        book = self._books.get(symbol)
+        if book is None:
+            return []
+        fills = []
+
+        # stops first: a triggered stop becomes a market order, a triggered stop-limit a limit order
+        triggered = []
+        for resting in self._pop_crossing(book['buy_stop'], lambda stop: stop <= high):
+            order = resting.order
+            price = max(order.stop_price, open_price)
+            if order.order_type == 'STP' or price <= order.limit_price:
+                fills.append((resting, price))
+            else:
+                triggered.append(resting)
+        for resting in self._pop_crossing(book['sell_stop'], lambda neg_stop: -neg_stop >= low):
+            order = resting.order
+            price = min(order.stop_price, open_price)
+            if order.order_type == 'STP' or price >= order.limit_price:
+                fills.append((resting, price))
+            else:
+                triggered.append(resting)
+
+        for resting in self._pop_crossing(book['buy_limit'], lambda neg_limit: -neg_limit >= low):
+            fills.append((resting, min(resting.order.limit_price, open_price)))
+        for resting in self._pop_crossing(book['sell_limit'], lambda limit: limit <= high):
+            fills.append((resting, max(resting.order.limit_price, open_price)))
+
+        # stop-limits triggered on this bar rest as limit orders from the next bar on
+        for resting in triggered:
+            resting.triggered = True
+            self._push_limit(resting, resting.order.limit_price)
+
+        for resting, _ in fills:
+            self._orders.pop(resting.order_id, None)
+            resting.active = False
+        return fills
@@ -0,0 +1,251 @@
+# memory.py
+
+# Estimates of the memory held by the components of a backtest, broken down by attribute, to tell which part of
+# a run (the data handler's bars, the portfolio's history, the strategy's state, the queued events) outgrows the
+# machine on a big universe. The estimates walk the object graph of each component: numpy arrays count their
+# buffers, pandas objects their memory_usage(deep=True), and containers and plain objects their own size plus
+# what they hold. Long containers (e.g. a bar history of a million rows) are estimated from an evenly spaced
+# sample of their items, which keeps a report cheap enough to take during a run. Objects reachable from several
+# components are counted once, under the first one walked, and code (classes, functions, modules) and threads
+# aren't counted at all.
+#
+# tracemalloc_diff() complements the estimates with what the Python allocator actually saw, by source line,
+# between two tracemalloc snapshots.
+
+from __future__ import print_function
+
+import collections
+import os
+import sys
+import threading
+import tracemalloc
+import types
+
+import numpy as np
+import pandas as pd
+
+_SKIPPED_TYPES = (
+    type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType, threading.Thread
+)
+
+SAMPLE_SIZE = 200 # containers longer than this are estimated from this many of their items
+
+
+def _sampled_size(items, seen):
+    '''
+    Estimates the bytes held by the items of a long container from an evenly spaced sample of them. The items
+    must be objects the container holds (e.g. a dict's keys or values, never the temporary tuples of its
+    items()), since their ids are added to seen
+    '''
+    items = list(items)
+    sample = items[::len(items) // SAMPLE_SIZE][:SAMPLE_SIZE]
+    size = sum(estimate_size(item, seen) for item in sample)
+    return int(size * len(items) / float(len(sample)))
+
+
+def estimate_size(obj, seen = None):
+    '''
+    Returns an estimate of the bytes held by obj and everything it references. Containers longer than
+    SAMPLE_SIZE are extrapolated from a sample of their items
+
+    Parameters:
+    obj - The object
+    seen - (Optional) A set of the ids of the objects already counted, which is updated. Pass the same set to
+           several calls to count shared objects once
+    '''
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SKIPPED_TYPES):
+            continue
+        seen.add(id(obj))
+
+        if isinstance(obj, np.ndarray):
+            # a view counts its header, its base the buffer
+            total += sys.getsizeof(obj)
+            if obj.base is not None:
+                stack.append(obj.base)
+            continue
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            usage = obj.memory_usage(index = True, deep = True)
+            total += int(usage.sum()) if isinstance(usage, pd.Series) else int(usage)
+            continue
+        if isinstance(obj, pd.Index):
+            total += int(obj.memory_usage(deep = True))
+            continue
+
+        try:
+            total += sys.getsizeof(obj)
+        except TypeError:
+            continue
+
+        if isinstance(obj, dict):
+            if len(obj) > SAMPLE_SIZE:
+                total += _sampled_size(obj.keys(), seen) + _sampled_size(obj.values(), seen)
+            else:
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            if len(obj) > SAMPLE_SIZE:
+                total += _sampled_size(obj, seen)
+            else:
+                stack.extend(obj)
+        else:
+            state = getattr(obj, '__dict__', None)
+            if isinstance(state, dict):
+                stack.append(state)
+            for name in getattr(type(obj), '__slots__', ()):
+                if hasattr(obj, name):
+                    stack.append(getattr(obj, name))
+    return total
+
+
+def component_memory(component, seen = None):
+    '''
+    Returns {'total': bytes, 'attributes': {name: bytes}} for an object, with the attributes largest first
+
+    Parameters:
+    component - The object, e.g. a Portfolio
+    seen - (Optional) The set of ids of the objects already counted, see estimate_size()
+    '''
+    seen = set() if seen is None else seen
+    seen.add(id(component))
+    attributes = {}
+    state = getattr(component, '__dict__', {})
+    seen.add(id(state))
+    for name, value in list(state.items()):
+        size = estimate_size(value, seen)
+        if size:
+            attributes[name] = size
+
+    total = sys.getsizeof(component) + sys.getsizeof(state) + sum(attributes.values())
+    return {
+        'total': total,
+        'attributes': collections.OrderedDict(sorted(attributes.items(), key = lambda item: -item[1]))
+    }
+
+
+def memory_report(components):
+    '''
+    Returns the memory held by each of a set of components, e.g. the parts of a Backtest:
+
+        {'total': bytes, 'components': {name: {'total': bytes, 'attributes': {name: bytes}}}}
+
+    Parameters:
+    components - A list of (name, object) pairs. An object reachable from several of them is counted under the
+                 first, and the components themselves are never counted under another one
+    '''
+    seen = set(id(component) for _, component in components)
+    report = collections.OrderedDict()
+    for name, component in components:
+        seen.discard(id(component))
+        report[name] = component_memory(component, seen)
+    return {'total': sum(r['total'] for r in report.values()), 'components': report}
+
+
+def format_bytes(n):
+    '''
+    Returns a number of bytes as a string such as '12.3 MB'
+    '''
+    if abs(n) < 1024:
+        return '%d B' % n
+    for unit in ('KB', 'MB', 'GB'):
+        n /= 1024.0
+        if abs(n) < 1024 or unit == 'GB':
+            return '%.1f %s' % (n, unit)
+
+
+def format_memory_report(report, allocations = None, top = 3):
+    '''
+    Returns a memory report as a table of the components, largest first, with their largest attributes
+
+    Parameters:
+    report - A report from memory_report()
+    allocations - (Optional) A diff from tracemalloc_diff(), whose top source lines are listed too
+    top - The number of attributes listed per component
+    '''
+    lines = ['%-20s %10s' % ('total', format_bytes(report['total']))]
+    components = sorted(report['components'].items(), key = lambda item: -item[1]['total'])
+    for name, component in components:
+        largest = list(component['attributes'].items())[:top]
+        lines.append(('%-20s %10s  %s' % (
+            name, format_bytes(component['total']),
+            ', '.join('%s %s' % (attribute, format_bytes(size)) for attribute, size in largest)
+        )).rstrip())
+
+    if allocations is not None:
+        lines.append('allocated during the run: %s' % format_bytes(allocations['total_diff']))
+        for line in allocations['top'][:top * 2]:
+            lines.append('  %10s  %s' % (format_bytes(line['size_diff']), line['location']))
+    return '\n'.join(lines)
+
+
+def tracemalloc_diff(before, after, limit = 20, root = None):
+    '''
+    Returns the source lines whose allocations grew (or shrank) the most between two tracemalloc snapshots, as
+    a list of {'location', 'size_diff', 'size', 'count_diff'} dicts, largest change first, plus the total change
+
+    Parameters:
+    before - The tracemalloc.Snapshot taken first
+    after - The tracemalloc.Snapshot taken last
+    limit - The number of source lines listed
+    root - (Optional) A directory. Allocations are put down to the innermost line of a file under it in their
+           traceback (e.g. the line of our code that called into pandas) rather than to the line that made them.
+           Needs tracemalloc to have been started with more than one frame
+    '''
+    stats = after.compare_to(before, 'lineno' if root is None else 'traceback')
+
+    root = None if root is None else os.path.abspath(root) + os.sep
+    in_root = {}
+    grouped = collections.OrderedDict()
+    total_diff = 0
+    for stat in stats:
+        frame = stat.traceback[-1]
+        if frame.filename == tracemalloc.__file__:
+            continue # the snapshots themselves
+        total_diff += stat.size_diff
+        if root is not None:
+            # tracebacks run from the oldest frame to the most recent
+            for f in reversed(stat.traceback):
+                if f.filename not in in_root:
+                    in_root[f.filename] = os.path.abspath(f.filename).startswith(root)
+                if in_root[f.filename]:
+                    frame = f
+                    break
+        location = '%s:%d' % (frame.filename, frame.lineno)
+        size_diff, size, count_diff = grouped.get(location, (0, 0, 0))
+        grouped[location] = (size_diff + stat.size_diff, size + stat.size, count_diff + stat.count_diff)
+
+    lines = []
+    for location, (size_diff, size, count_diff) in sorted(grouped.items(), key = lambda item: -abs(item[1][0]))[:limit]:
+        lines.append(collections.OrderedDict([
+            ('location', location), ('size_diff', size_diff), ('size', size), ('count_diff', count_diff)
+        ]))
+    return {'total_diff': total_diff, 'top': lines}
+
+
+if __name__ == '__main__':
+    # the estimate of a portfolio-like history (rows of a few hundred symbols, so every row is sampled) should
+    # be close to what tracemalloc saw allocated for it, also when several histories are counted with one seen
+    import datetime
+
+    symbols = ['S%03d' % i for i in range(300)]
+    tracemalloc.start()
+    histories = []
+    for h in range(3):
+        before = tracemalloc.get_traced_memory()[0]
+        rows = []
+        for t in range(1000):
+            row = dict((s, float(h * 1e7 + t * 1000 + i)) for i, s in enumerate(symbols))
+            row['datetime'] = datetime.datetime(2020, 1, 1) + datetime.timedelta(minutes = t)
+            rows.append(row)
+        histories.append((rows, tracemalloc.get_traced_memory()[0] - before))
+    tracemalloc.stop()
+
+    seen = set()
+    for rows, traced in histories:
+        estimate = estimate_size(rows, seen)
+        print('traced %s, estimated %s' % (format_bytes(traced), format_bytes(estimate)))
+        assert abs(estimate - traced) < 0.1 * traced, 'the estimate is off by more than 10%'
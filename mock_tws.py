@@ -0,0 +1,221 @@
+# mock_tws.py
+
+# A local stand-in for Trader Workstation, so the IBExecutionHandler can be exercised offline. MockTWSConnection
+# has the parts of IbPy's ibConnection interface the handler uses; the orders it receives are worked by a
+# MockTWSServer thread, which answers with openOrder and (possibly partial) orderStatus messages on its own
+# thread, like the IbPy reader thread does.
+#
+# Running this file submits a burst of orders through the handler and reports throughput and fill ordering:
+#   python mock_tws.py --orders 2000 --partials 3
+
+from __future__ import print_function
+
+import argparse
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class MockMessage(object):
+    '''
+    A server message with a typeName and the fields of the corresponding IbPy message as attributes
+    '''
+
+    def __init__(self, typeName, **fields):
+        self.typeName = typeName
+        self.__dict__.update(fields)
+
+    def __str__(self):
+        fields = ', '.join('%s=%s' % (k, v) for k, v in sorted(self.__dict__.items()) if k != 'typeName')
+        return '<%s %s>' % (self.typeName, fields)
+
+
+class MockContract(object):
+    '''
+    Stand-in for ib.ext.Contract.Contract
+    '''
+
+    def __init__(self):
+        self.m_symbol = None
+        self.m_secType = None
+        self.m_exchange = None
+        self.m_primaryExch = None
+        self.m_currency = None
+
+
+class MockOrder(object):
+    '''
+    Stand-in for ib.ext.Order.Order
+    '''
+
+    def __init__(self):
+        self.m_orderType = None
+        self.m_totalQuantity = 0
+        self.m_action = None
+        self.m_lmtPrice = None
+        self.m_auxPrice = None
+        self.m_tif = None
+
+
+class MockTWSServer(object):
+    '''
+    Works the orders sent to it on a background thread, in the order they were received. Each order is filled
+    in `partials` roughly equal parts, each reported as a cumulative orderStatus message; the last one has
+    status 'Filled'.
+    '''
+
+    def __init__(self, prices = None, default_price = 100.0, partials = 1, latency = 0.0, price_step = 0.01):
+        '''
+        Parameters:
+        prices - (Optional) dict of symbol -> price the orders fill at
+        default_price - The fill price of symbols not in prices
+        partials - The number of parts each order is filled in
+        latency - Seconds the server waits before working each order
+        price_step - Amount each successive partial fill moves against the order, so average prices vary
+        '''
+        self.prices = prices or {}
+        self.default_price = default_price
+        self.partials = partials
+        self.latency = latency
+        self.price_step = price_step
+
+        self.inbox = queue.Queue()
+        self.dispatch = None # set by the connection
+        self.orders_received = 0
+        self._thread = None
+
+    def start(self, dispatch):
+        self.dispatch = dispatch
+        self._thread = threading.Thread(target = self._run, name = 'MockTWSServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.inbox.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            item = self.inbox.get()
+            if item is None:
+                break
+            if self.latency:
+                time.sleep(self.latency)
+            self._work(*item)
+
+    def _work(self, order_id, contract, order):
+        self.dispatch(MockMessage('openOrder', orderId = order_id, contract = contract, order = order))
+
+        total = int(order.m_totalQuantity)
+        direction = 1 if order.m_action == 'BUY' else -1
+        base = self.prices.get(contract.m_symbol, self.default_price)
+        filled, cost = 0, 0.0
+        for i in range(self.partials):
+            # split the quantity as evenly as possible, the last part taking the remainder
+            part = total // self.partials if i < self.partials - 1 else total - filled
+            if part <= 0:
+                continue
+            filled += part
+            cost += part * (base + direction * self.price_step * i)
+            self.dispatch(MockMessage(
+                'orderStatus', orderId = order_id, status = 'Filled' if filled == total else 'Submitted',
+                filled = filled, remaining = total - filled, avgFillPrice = cost / filled
+            ))
+
+
+class MockTWSConnection(object):
+    '''
+    Implements the parts of IbPy's ibConnection used by IBExecutionHandler, backed by a MockTWSServer
+    '''
+
+    Contract = MockContract
+    Order = MockOrder
+
+    def __init__(self, server = None):
+        self.server = server if server is not None else MockTWSServer()
+        self._listeners = {}
+        self._all_listeners = []
+        self.connected = False
+
+    def register(self, listener, *types):
+        for t in types:
+            self._listeners.setdefault(t, []).append(listener)
+
+    def registerAll(self, listener):
+        self._all_listeners.append(listener)
+
+    def _dispatch(self, msg):
+        for listener in self._listeners.get(msg.typeName, []) + self._all_listeners:
+            listener(msg)
+
+    def connect(self):
+        self.server.start(self._dispatch)
+        self.connected = True
+        self._dispatch(MockMessage('nextValidId', orderId = 1))
+        return True
+
+    def disconnect(self):
+        self.server.stop()
+        self.connected = False
+
+    def placeOrder(self, order_id, contract, order):
+        self.server.orders_received += 1
+        self.server.inbox.put((order_id, contract, order))
+
+
+def main(argv = None):
+    from event import OrderEvent
+    from ib_execution import IBExecutionHandler
+    from tracer import Tracer, set_tracer
+
+    parser = argparse.ArgumentParser(description = 'Throughput and ordering check of IBExecutionHandler against a mock TWS')
+    parser.add_argument('--orders', type = int, default = 1000)
+    parser.add_argument('--partials', type = int, default = 1)
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'server seconds per order')
+    parser.add_argument('--emit-partial-fills', action = 'store_true')
+    parser.add_argument('--trace', help = 'write a Chrome trace of the handler\'s threads to this file')
+    args = parser.parse_args(argv)
+
+    # the handler picks the tracer up when it is created; without an event loop the one "bar" is always sampled
+    tracer = set_tracer(Tracer(args.trace) if args.trace else None)
+    tracer.sample()
+
+    events = queue.Queue()
+    conn = MockTWSConnection(MockTWSServer(partials = args.partials, latency = args.latency))
+    conn.connect()
+    handler = IBExecutionHandler(events, connection = conn, emit_partial_fills = args.emit_partial_fills)
+
+    symbols = ['SYM%d' % (i % 50) for i in range(args.orders)]
+    start = time.perf_counter()
+    for i, s in enumerate(symbols):
+        handler.execute_order(OrderEvent(s, 'MKT', 100 + i, 'BUY' if i % 2 else 'SELL'))
+    submitted = time.perf_counter() - start
+
+    while handler.pending_orders():
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    handler.close()
+    tracer.close()
+
+    fills = []
+    while not events.empty():
+        fills.append(events.get())
+    quantities = [f.quantity for f in fills]
+    expected_fills = args.orders * (args.partials if args.emit_partial_fills else 1)
+
+    print('Orders submitted: %d in %.1f ms (%.0f orders/s from the event loop)' % (
+        args.orders, submitted * 1000.0, args.orders / submitted))
+    print('All fills received after %.1f ms (%.0f orders/s end to end)' % (elapsed * 1000.0, args.orders / elapsed))
+    print('Fills: %d (expected %d), total quantity %d (expected %d)' % (
+        len(fills), expected_fills, sum(quantities), sum(100 + i for i in range(args.orders))))
+    if not args.emit_partial_fills:
+        print('Fills in submission order: %s' % (quantities == [100 + i for i in range(args.orders)]))
+
+
+if __name__ == '__main__':
+    main()
@@ -44,3 +44,101 @@ def create_drawdowns(pnl):
         drawdown[t] = -(hwm[t] - pnl[t])
         duration[t] = (0 if drawdown[t] == 0 else duration[t-1] + 1)
     return drawdown, drawdown.min(), duration.max()
+
+class StreamingPerformance(object):
+    '''
+    Computes the same statistics as create_sharpe_ratio() and create_drawdowns() over a total equity series
+    that arrives in consecutive chunks, so a history that has been spilled to disk never has to be loaded whole.
+
+    The first value seen is the base of the equity curve, matching (1 + pct_change).cumprod() in the Portfolio.
+    '''
+
+    def __init__(self, periods = 252):
+        '''
+        Parameters:
+        periods - Daily (252), Hourly (252 * 6.5), Minutely (252 * 6.5 * 60) etc.
+        '''
+        self.periods = periods
+
+        self.n = 0 # number of totals seen
+        self.first_total = None
+        self.last_total = None
+
+        # running moments of the returns (Chan et al. parallel update)
+        self.n_returns = 0
+        self.mean_return = 0.0
+        self.m2_return = 0.0
+
+        # drawdown state carried between chunks
+        self.hwm = 0.0
+        self.duration = 0.0
+        self.max_dd = 0.0
+        self.max_duration = 0.0
+
+    def update(self, total):
+        '''
+        Adds the next chunk of total equity values and returns its (returns, equity_curve, drawdown) arrays,
+        with NaN where the value is undefined (the very first bar)
+
+        Parameters:
+        total - A numpy array with the next chunk of the portfolio total
+        '''
+        total = np.asarray(total, dtype = np.float64)
+        if len(total) == 0:
+            return total, total, total
+
+        if self.first_total is None:
+            self.first_total = total[0]
+            prev = np.nan
+        else:
+            prev = self.last_total
+        previous = np.concatenate(([prev], total[:-1]))
+        returns = total / previous - 1.0
+        equity = total / self.first_total
+
+        # the drawdown of the very first bar is undefined, as in create_drawdowns()
+        start = 1 if self.n == 0 else 0
+        if start:
+            equity[0] = np.nan
+
+        # update the running mean/variance of the returns
+        valid = returns[~np.isnan(returns)]
+        if len(valid):
+            n_b = len(valid)
+            mean_b = valid.mean()
+            m2_b = ((valid - mean_b) ** 2).sum()
+            n_ab = self.n_returns + n_b
+            delta = mean_b - self.mean_return
+            self.m2_return += m2_b + delta ** 2 * self.n_returns * n_b / n_ab
+            self.mean_return += delta * n_b / n_ab
+            self.n_returns = n_ab
+
+        drawdown = np.full(len(total), np.nan)
+        if len(total) > start:
+            pnl = equity[start:]
+            hwm = np.maximum.accumulate(np.concatenate(([self.hwm], pnl)))[1:]
+            dd = -(hwm - pnl)
+
+            # duration counts the bars since the last bar that was at the high water mark
+            idx = np.arange(1, len(dd) + 1)
+            last_zero = np.maximum.accumulate(np.where(dd == 0, idx, 0))
+            duration = np.where(last_zero > 0, idx - last_zero, idx + self.duration)
+
+            drawdown[start:] = dd
+            self.hwm = hwm[-1]
+            self.duration = duration[-1]
+            self.max_dd = min(self.max_dd, dd.min())
+            self.max_duration = max(self.max_duration, duration.max())
+
+        self.n += len(total)
+        self.last_total = total[-1]
+        return returns, equity, drawdown
+
+    def results(self):
+        '''
+        Returns total_return (as a multiple), sharpe_ratio, max_drawdown, drawdown_duration
+        '''
+        std = np.sqrt(self.m2_return / self.n_returns) if self.n_returns else np.nan
+        sharpe = np.sqrt(self.periods) * self.mean_return / std if self.n_returns else np.nan
+        total_return = self.last_total / self.first_total if self.n else np.nan
+        return total_return, sharpe, self.max_dd, self.max_duration
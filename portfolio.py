@@ -12,11 +12,12 @@ except ImportError:
 import numpy as np
 import pandas as pd
 
+from blotter import TradeBlotter
 from event import FillEvent, OrderEvent
-from performance import create_sharpe_ratio, create_drawdowns
-
-import matplotlib.pyplot as plt
-from matplotlib.ticker import PercentFormatter, FuncFormatter
+from history import BarHistory
+from journal import get_journal, INFO
+from performance import create_sharpe_ratio, create_drawdowns, StreamingPerformance
+from rebalance import TargetWeightRebalancer
 
 
 class Portfolio(object):
@@ -30,7 +31,8 @@ class Portfolio(object):
     the percentage change in portfolio value across bars.
     '''
 
-    def __init__(self, bars, events, start_date, initial_capital=100000.0):
+    def __init__(self, bars, events, start_date, initial_capital=100000.0, history_dir=None, memory_budget=None,
+                 chart_points=5000, rebalancer=None, risk_manager=None):
         '''
         Initialises the portfolio with bars and an event queue.
         Also includes a starting datetime index and initial capital
@@ -40,12 +42,24 @@ class Portfolio(object):
         events - The Event Queue object
         start_date - The start date (bar)  of the portfolio
         initial_capital - The starting capital
+        history_dir - (Optional) Directory the positions/holdings history is spilled to once it outgrows memory_budget
+        memory_budget - (Optional) Approximate bytes of history kept in memory, shared by positions and holdings
+        chart_points - The number of points the equity curve is downsampled to when the history has been spilled
+        rebalancer - (Optional) The TargetWeightRebalancer used for RebalanceEvents. Defaults to whole shares
+        risk_manager - (Optional) A RiskManager that every batch of orders is checked against before it is queued
         '''
         self.bars = bars
         self.events = events
         self.symbol_list = self.bars.symbol_list # the DataHandler object has a 'symbol_list' attribute
         self.start_date = start_date
         self.initial_capital = initial_capital
+        self.history_dir = history_dir
+        self.memory_budget = memory_budget
+        self.chart_points = chart_points
+        self.rebalancer = rebalancer if rebalancer is not None else TargetWeightRebalancer()
+        self.risk_manager = risk_manager
+        if self.risk_manager is not None:
+            self.risk_manager.bind(self.symbol_list)
 
         self.all_positions = self.construct_all_positions()
         self.current_positions = dict( (k,v) for k, v in [(s, 0) for s in self.symbol_list] ) # initialize a position of 0 for all symbols
@@ -53,6 +67,15 @@ class Portfolio(object):
         self.all_holdings = self.construct_all_holdings()
         self.current_holdings = self.construct_current_holdings()
 
+        # array views of the current positions and latest prices, aligned with symbol_list, for the vectorised
+        # order sizing and risk checks
+        self.symbol_index = dict((s, i) for i, s in enumerate(self.symbol_list))
+        self.position_vector = np.zeros(len(self.symbol_list))
+        self.latest_prices = np.full(len(self.symbol_list), np.nan)
+
+        self.blotter = TradeBlotter()
+        self.journal = get_journal()
+
     def construct_all_positions(self):
         '''
         Constructs the positions list using the start_date to determine when the index will begin.
@@ -62,11 +85,12 @@ class Portfolio(object):
         start_date = pd.to_datetime('1/1/2018')
 
         d = {'AAPL': 0, 'GM.': 0, 'TSLA': 0, 'datetime': Timestamp('2018-01-01 00:00:00')}
-        d is returned in a list as [d] because it will be appended to over time to keep track of the positions across time
+        d is returned as the first row of a BarHistory because it will be appended to over time to keep track
+        of the positions across time
         '''
         d = dict( (k,v) for k, v in [(s, 0) for s in self.symbol_list] )
         d['datetime'] = self.start_date
-        return [d]
+        return self._construct_history(list(d.keys()), 'positions', d)
 
     def construct_all_holdings(self):
         '''
@@ -84,7 +108,16 @@ class Portfolio(object):
         d['cash'] = self.initial_capital
         d['commission'] = 0.0
         d['total'] = self.initial_capital
-        return [d]
+        return self._construct_history(list(d.keys()), 'holdings', d)
+
+    def _construct_history(self, columns, name, first_row):
+        '''
+        Creates a BarHistory holding first_row. Positions and holdings each get half of the memory budget
+        '''
+        budget = None if self.memory_budget is None else self.memory_budget / 2.0
+        history = BarHistory(columns, spill_dir = self.history_dir, memory_budget = budget, name = name)
+        history.append(first_row)
+        return history
 
     def construct_current_holdings(self):
         '''
@@ -105,7 +138,7 @@ class Portfolio(object):
 
         Makes use of a MarketEvent from the events queue.
         '''
-        latest_datetime = self.bars.get_latest_bar_datetime( self.symbol_list[0] )
+        latest_datetime = self.bars.get_latest_datetime()
 
         # Update positions
         # ================
@@ -126,9 +159,13 @@ class Portfolio(object):
         dh['commission'] = self.current_holdings['commission']
         dh['total'] = self.current_holdings['cash']
 
-        for s in self.symbol_list:
-            # Approximation of the real value
-            market_value = self.current_positions[s] * self.bars.get_latest_bar_value(s, 'Adj_Close')
+        active = self.bars.active_mask
+        for i, s in enumerate(self.symbol_list):
+            # Approximation of the real value. Symbols outside the data handler's universe get no bars, so a
+            # position in one (e.g. a delisted name) is valued at the last price seen
+            if active[i]:
+                self.latest_prices[i] = self.bars.get_latest_bar_value(s, 'Adj_Close')
+            market_value = self.current_positions[s] * self.latest_prices[i] if self.current_positions[s] != 0 else 0.0
             dh[s] = market_value
             dh['total'] += market_value
 
@@ -151,6 +188,7 @@ class Portfolio(object):
 
         # update positions list with new quantities
         self.current_positions[fill.symbol] += fill_dir * fill.quantity
+        self.position_vector[self.symbol_index[fill.symbol]] += fill_dir * fill.quantity
 
     def update_holdings_from_fill(self, fill):
         '''
@@ -167,23 +205,39 @@ class Portfolio(object):
             fill_dir = -1
 
         # Update holdings list with new quantities
-        fill_cost = self.bars.get_latest_bar_value(fill.symbol, 'Adj_Close')
+        fill_cost = self.fill_price(fill)
         cost = fill_dir * fill_cost * fill.quantity
         self.current_holdings[fill.symbol] += cost # update the holdings for the symbol we traded
         self.current_holdings['commission'] += fill.commission
         self.current_holdings['cash'] -= (cost + fill.commission)
         self.current_holdings['total'] -= (cost + fill.commission) # WARNING : is this right???
 
+    def fill_price(self, fill):
+        '''
+        Returns the price per share a fill is valued at: the fill's own fill_cost when the execution handler
+        modelled one, otherwise the latest bar's adjusted close
+        '''
+        if fill.fill_cost is not None:
+            return fill.fill_cost
+        return self.bars.get_latest_bar_value(fill.symbol, 'Adj_Close')
+
     def update_fill(self, event):
         '''
         Updates the portfolio current positions and holdings from the FillEvent
 
-        Serves as a wrapper around update_positions_from_fill() and update_holdings_from_fill()
+        Serves as a wrapper around update_positions_from_fill() and update_holdings_from_fill(),
+        and records the fill in the trade blotter at the same price the holdings were valued at
         '''
         if event.type == 'FILL':
             self.update_positions_from_fill(event)
             self.update_holdings_from_fill(event)
 
+            fill_dir = 1 if event.direction == 'BUY' else -1
+            self.blotter.record_fill(
+                self.bars.get_latest_bar_datetime(event.symbol), event.symbol, fill_dir * event.quantity,
+                self.fill_price(event), event.commission
+            )
+
     def generate_naive_order(self, signal):
         '''
         Generates an Order object (event?) with a constant quantity of shares to purchase
@@ -216,7 +270,8 @@ class Portfolio(object):
 
     def generate_percentage_order(self, signal):
         '''
-        Generates an OrderEvent with a constant percentage of shares to purchase
+        Generates an OrderEvent with a constant percentage of shares to purchase: 5% of the initial capital,
+        scaled by the signal's strength
 
         Parameters:
         signal - A tuple containing the Signal information
@@ -228,29 +283,33 @@ class Portfolio(object):
         strength = signal.strength
 
         current_price = self.bars.get_latest_bar_value(signal.symbol, 'Adj_Close')
-        current_date = self.bars.get_latest_bar_datetime(signal.symbol).date()
-        mkt_quantity = floor((self.initial_capital * 0.05) / current_price) #100
+        # the signal's strength scales the position, e.g. to size the legs of a pair by its hedge ratio
+        mkt_quantity = floor((self.initial_capital * 0.05 * strength) / current_price) #100
         cur_quantity = self.current_positions[symbol]
         order_type = 'MKT'
+        action = None
 
         # only buy if current hold 0 shares of the symbol
         if direction == 'LONG' and cur_quantity == 0: # long stock
             order = OrderEvent(symbol, order_type, mkt_quantity, 'BUY')
-            print(str(current_date) + ': Buying ' + str(mkt_quantity) + ' of ' + symbol + ' at ' + str(current_price))
-            print('\n')
+            action = 'BUY'
         if direction == 'SHORT' and cur_quantity == 0: # short stock
             order = OrderEvent(symbol, order_type, mkt_quantity, 'SELL')
-            print(str(current_date) + ': Shorting ' + str(mkt_quantity) + ' of ' + symbol + ' at ' + str(current_price))
-            print('\n')
+            action = 'SHORT'
 
         if direction == 'EXIT' and cur_quantity > 0: # sell to close
             order = OrderEvent(symbol, order_type, abs(cur_quantity), 'SELL')
-            print(str(current_date) + ': Selling to close ' + str(abs(cur_quantity)) + ' of ' + symbol + ' at ' + str(current_price))
-            print('\n')
+            action = 'SELL_TO_CLOSE'
         if direction == 'EXIT' and cur_quantity < 0: # buy to cover
             order = OrderEvent(symbol, order_type, abs(cur_quantity), 'BUY')
-            print(str(current_date) + ': Buying to cover ' + str(abs(cur_quantity)) + ' of ' + symbol + ' at ' + str(current_price))
-            print('\n')
+            action = 'BUY_TO_COVER'
+
+        # only look up the bar date when the journal will actually keep the record
+        if order is not None and self.journal.enabled_for(INFO):
+            self.journal.info(
+                'ORDER', date = self.bars.get_latest_bar_datetime(symbol).date(), action = action,
+                symbol = symbol, quantity = order.quantity, price = current_price
+            )
 
         return order
 
@@ -261,42 +320,158 @@ class Portfolio(object):
         if event.type == 'SIGNAL':
             # order_event = self.generate_naive_order(event)
             order_event = self.generate_percentage_order(event)
-            self.events.put(order_event)
+            if order_event is not None:
+                self.submit_orders([order_event])
+
+    def submit_orders(self, orders):
+        '''
+        Puts a batch of OrderEvents on the events queue, after the risk manager (if there is one) has resized
+        or rejected them as a whole
+        '''
+        if self.risk_manager is not None and orders:
+            orders = self._apply_risk_checks(orders)
+        for order in orders:
+            self.events.put(order)
+
+    def _apply_risk_checks(self, orders):
+        '''
+        Runs the batch through the risk manager and returns the approved orders with their quantities cut back.
+        Orders cut to zero are dropped
+        '''
+        proposed = np.zeros(len(self.symbol_list))
+        for order in orders:
+            proposed[self.symbol_index[order.symbol]] += order.quantity if order.direction == 'BUY' else -order.quantity
+
+        approved = self.risk_manager.check_orders(
+            proposed, self.latest_prices, self.position_vector, self.current_holdings['cash']
+        )
+
+        # hand the approved quantity of each symbol out to its orders in the order they were proposed
+        remaining = np.abs(approved)
+        checked = []
+        for order in orders:
+            i = self.symbol_index[order.symbol]
+            quantity = int(min(order.quantity, remaining[i])) if np.sign(approved[i]) == np.sign(proposed[i]) else 0
+            remaining[i] -= quantity
+            if quantity != order.quantity:
+                self.journal.info(
+                    'RISK', symbol = order.symbol, direction = order.direction,
+                    requested = order.quantity, approved = quantity
+                )
+            if quantity > 0:
+                order.quantity = quantity
+                checked.append(order)
+        return checked
+
+    def update_rebalance(self, event):
+        '''
+        Acts when a RebalanceEvent is generated. Works out the orders for every symbol in one vectorised step
+        from the current equity, prices and positions, then puts them on the queue as one batch, sells first
+        so that their proceeds are available to the buys
+        '''
+        if event.type == 'REBALANCE':
+            prices = self.latest_prices
+            weights = np.array([event.weights.get(s, 0.0) for s in self.symbol_list], dtype = np.float64)
+
+            quantity, commission = self.rebalancer.compute_orders(
+                weights, prices, self.position_vector, self.current_holdings['cash']
+            )
+
+            orders = []
+            for i in np.argsort(quantity > 0, kind = 'stable'):
+                if quantity[i] != 0:
+                    direction = 'BUY' if quantity[i] > 0 else 'SELL'
+                    orders.append(OrderEvent(self.symbol_list[i], 'MKT', int(abs(quantity[i])), direction))
+
+            self.journal.info(
+                'REBALANCE', datetime = event.datetime, orders = len(orders),
+                traded_value = float(np.abs(quantity * np.nan_to_num(prices)).sum()),
+                estimated_commission = float(commission.sum())
+            )
+            self.submit_orders(orders)
 
     def create_equity_curve_dataframe(self):
         '''
         Creates a pandas DataFrame from the all_holdings list of dictionaries
+
+        If the holdings history has been spilled to disk, the chunks are streamed instead: the full curve is
+        written to equity.csv chunk by chunk, the summary statistics are accumulated as it goes, and only a
+        downsampled curve (about chart_points rows) is kept as the equity_curve DataFrame for the chart.
         '''
-        curve = pd.DataFrame(self.all_holdings)
+        if self.all_holdings.spilled:
+            self._create_chunked_equity_curve()
+            return
+        self._chunked_stats = None
+
+        curve = self.all_holdings.to_dataframe()
         curve.set_index('datetime', inplace = True)
         curve['returns'] = curve['total'].pct_change()
         curve['equity_curve'] = (1.0 + curve['returns']).cumprod()
         self.equity_curve = curve
 
+    def _create_chunked_equity_curve(self, periods = 252):
+        '''
+        Streams the spilled holdings history once, writing equity.csv and building the downsampled equity curve
+        '''
+        perf = StreamingPerformance(periods = periods)
+        stride = max(1, int(np.ceil(len(self.all_holdings) / float(self.chart_points))))
+        offset = 0
+        sampled = []
+        header = True
+
+        for chunk in self.all_holdings.iter_chunks():
+            returns, equity, drawdown = perf.update(chunk['total'])
+            frame = pd.DataFrame(chunk, columns = self.all_holdings.columns)
+            frame['datetime'] = pd.to_datetime(frame['datetime'])
+            frame.set_index('datetime', inplace = True)
+            frame['returns'] = returns
+            frame['equity_curve'] = equity
+            frame['drawdown'] = drawdown
+
+            frame.to_csv('equity.csv', mode = 'w' if header else 'a', header = header)
+            header = False
+
+            # keep every stride-th row of the whole history for the chart
+            first = (-offset) % stride
+            sampled.append(frame.iloc[first::stride])
+            offset += len(frame)
+
+        self.equity_curve = pd.concat(sampled)
+        self._chunked_stats = perf.results()
+
     def output_summary_stats(self, strategy_title):
         '''
         Creates a list of summary statistics for the portfolio.
         '''
-        total_return = self.equity_curve['equity_curve'][-1]
-        returns = self.equity_curve['returns']
-        pnl = self.equity_curve['equity_curve']
-
-        sharpe_ratio = create_sharpe_ratio(returns, periods = 252) # i guess this is for minute resolution
-        drawdown, max_dd, dd_duration = create_drawdowns(pnl)
-        self.equity_curve['drawdown'] = drawdown
+        if self._chunked_stats is not None:
+            total_return, sharpe_ratio, max_dd, dd_duration = self._chunked_stats
+        else:
+            total_return = self.equity_curve['equity_curve'][-1]
+            returns = self.equity_curve['returns']
+            pnl = self.equity_curve['equity_curve']
+
+            sharpe_ratio = create_sharpe_ratio(returns, periods = 252) # i guess this is for minute resolution
+            drawdown, max_dd, dd_duration = create_drawdowns(pnl)
+            self.equity_curve['drawdown'] = drawdown
+            self.equity_curve.to_csv('equity.csv')
 
         stats = ['Total Return', '%0.2f%%' % ((total_return - 1.0) * 100.0),
                  ('Sharpe Ratio', '%0.2f' % sharpe_ratio),
                  ('Max Drawdown', '%0.2f%%' % (max_dd * 100.0)),
                  ('Drawdown Duration', '%d' % dd_duration)]
-        self.equity_curve.to_csv('equity.csv')
         self.print_chart(max_dd, dd_duration, total_return, sharpe_ratio, strategy_title)
         return stats
 
     def print_chart(self, max_dd, dd_duration, total_return, sharpe_ratio, strategy_title):
         '''
         Outputs a chart to the screen to show the summary stats
+
+        matplotlib is imported here rather than at module level so that runs which never
+        draw a chart don't pay for it at startup
         '''
+        import matplotlib.pyplot as plt
+        from matplotlib.ticker import PercentFormatter
+
         strategy_return = np.round((total_return - 1.0) * 100.0, 2)
         strategy_drawdown = np.round(max_dd * 100.0, 2)
 
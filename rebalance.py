@@ -0,0 +1,88 @@
+# rebalance.py
+
+# Turns a vector of target portfolio weights into order quantities for every symbol at once. All the arithmetic
+# (target quantities, lot rounding, commission estimates and the cash constraint) is done on numpy arrays
+# aligned with the Portfolio's symbol_list, so rebalancing hundreds of names costs a few array operations.
+
+from __future__ import print_function
+
+import numpy as np
+
+
+def estimate_ib_commission(quantity):
+    '''
+    Vectorised version of FillEvent.calculate_ib_commission(). Zero quantities cost nothing.
+
+    Parameters:
+    quantity - A numpy array of (absolute) share quantities
+    '''
+    quantity = np.abs(quantity)
+    per_share = np.where(quantity <= 500, 0.013, 0.008)
+    return np.where(quantity > 0, np.maximum(1.3, per_share * quantity), 0.0)
+
+
+class TargetWeightRebalancer(object):
+    '''
+    Computes the orders that move a portfolio to target weights of its current (marked to market) equity.
+
+    Targets are rounded towards zero to whole lots. If the buys plus all estimated commissions cost more than the
+    cash available after the sells, the buys are scaled down pro rata (and re-rounded) until they fit.
+    '''
+
+    def __init__(self, lot_size = 1, cash_buffer = 0.0, min_trade_value = 0.0, commission_model = estimate_ib_commission):
+        '''
+        Parameters:
+        lot_size - Order quantities are multiples of this many shares
+        cash_buffer - Fraction of equity that is always left in cash
+        min_trade_value - Trades with a smaller notional value than this are skipped
+        commission_model - A function of an array of quantities returning an array of estimated commissions
+        '''
+        self.lot_size = lot_size
+        self.cash_buffer = cash_buffer
+        self.min_trade_value = min_trade_value
+        self.commission_model = commission_model
+
+    def _round_lots(self, quantity):
+        return np.trunc(quantity / self.lot_size) * self.lot_size
+
+    def compute_orders(self, weights, prices, positions, cash):
+        '''
+        Returns (quantity, commission): the signed order quantity per symbol (positive to buy, negative to sell)
+        and its estimated commission. Symbols without a usable price are not traded.
+
+        Parameters:
+        weights - Array of target weights, aligned with prices and positions
+        prices - Array of current prices
+        positions - Array of current (signed) positions in shares
+        cash - The current cash balance
+        '''
+        weights = np.asarray(weights, dtype = np.float64)
+        prices = np.asarray(prices, dtype = np.float64)
+        positions = np.asarray(positions, dtype = np.float64)
+
+        tradable = np.isfinite(prices) & (prices > 0)
+        safe_prices = np.where(tradable, prices, 1.0)
+
+        market_value = np.where(tradable, positions * safe_prices, 0.0)
+        equity = cash + market_value.sum()
+        investable = equity * (1.0 - self.cash_buffer)
+
+        target = self._round_lots(weights * investable / safe_prices)
+        delta = np.where(tradable, target - positions, 0.0)
+        delta[np.abs(delta) * safe_prices < self.min_trade_value] = 0.0
+
+        # sells free up cash first, then the buys have to fit in what is left
+        sells = np.minimum(delta, 0.0)
+        available = cash - (sells * safe_prices).sum() - self.commission_model(sells).sum()
+        buys = np.maximum(delta, 0.0)
+        for _ in range(10):
+            cost = (buys * safe_prices).sum() + self.commission_model(buys).sum()
+            if cost <= available or cost == 0:
+                break
+            buys = self._round_lots(buys * max(available, 0.0) / cost)
+        else:
+            # still over budget after rounding, so drop the buys altogether
+            buys = np.zeros_like(buys)
+
+        quantity = sells + buys
+        return quantity, self.commission_model(quantity)
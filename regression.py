@@ -0,0 +1,386 @@
+# regression.py
+
+# Incremental regression estimators for pairs and other relative-value strategies. Like the indicators in
+# indicators.py they keep their state in numpy arrays with a column per regression (e.g. per pair) and are
+# updated with one array per input on every bar, so hundreds of pairs cost a few vectorised operations per bar
+# instead of an OLS refit per pair. The inputs are (y, x_1, .., x_m); NaN in any of them means no new bar.
+#
+# A PairBank is an IndicatorBank whose columns are pairs of symbols, feeding these estimators the prices of
+# each pair's legs:
+#
+#   pairs = PairBank(bars, [('NVS', 'NVO'), ('VRTX', 'AGN')], log_prices = True)
+#   kalman = pairs.add('kalman', KalmanHedgeRatio(), 'Adj_Close')
+#   ...
+#   kalman.zscore  # numpy array, one value per pair
+
+from __future__ import print_function
+
+import numpy as np
+
+from indicators import StreamingIndicator, IndicatorBank, push_ring_buffer
+
+
+class _RollingRegression(StreamingIndicator):
+    '''
+    Running sums of the cross products of z = [1, x_1, .., x_m, y] over the last `window` bars, which is all a
+    least squares fit over the window needs. Adding a bar and dropping the oldest one costs O(k^2) per column
+    (k = m + 1 coefficients); the sums are recomputed from the ring buffer once per window to stop rounding
+    errors building up
+    '''
+
+    param_names = ('window', 'n_regressors')
+    cacheable = False # coef and resid aren't cached
+
+    def __init__(self, window, n_regressors = 1):
+        if window < n_regressors + 2:
+            raise ValueError('window must be at least n_regressors + 2')
+        self.window = window
+        self.n_regressors = n_regressors
+        self.n_inputs = 1 + n_regressors
+        self.period = window
+
+    def bind(self, n_symbols):
+        super(_RollingRegression, self).bind(n_symbols)
+        k = self.n_regressors + 1
+        self.buffer = np.zeros((self.window, n_symbols, k + 1))
+        self.moments = np.zeros((n_symbols, k + 1, k + 1))
+        self.coef = np.full((n_symbols, k), np.nan) # intercept, slopes
+        self.resid = np.full(n_symbols, np.nan)
+
+    def _push(self, y, *xs):
+        '''
+        Adds the new observations to the window sums and returns the updated columns with their z rows
+        '''
+        valid = ~np.isnan(y)
+        for x in xs:
+            valid &= ~np.isnan(x)
+        cols = np.flatnonzero(valid)
+        if len(cols) == 0:
+            return cols, None
+
+        z = np.column_stack([np.ones(len(cols))] + [x[cols] for x in xs] + [y[cols]])
+        old, wrapped = push_ring_buffer(self.buffer, self.count, cols, z, self.window)
+        self.moments[cols] += z[:, :, None] * z[:, None, :] - old[:, :, None] * old[:, None, :]
+
+        if len(wrapped):
+            window = self.buffer[:, wrapped]
+            self.moments[wrapped] = np.einsum('tci,tcj->cij', window, window)
+        return cols, z
+
+    def _fit(self, cols):
+        '''
+        Returns the least squares coefficients and their standard errors for the columns, NaN where there are
+        too few observations or the regressors are (nearly) collinear
+        '''
+        k = self.n_regressors + 1
+        m = self.moments[cols]
+        xtx = m[:, :k, :k]
+        xty = m[:, :k, k]
+        n = np.minimum(self.count[cols], self.window).astype(np.float64)
+
+        coef = np.full((len(cols), k), np.nan)
+        stderr = np.full((len(cols), k), np.nan)
+        ok = n > k
+        if ok.any():
+            ok[ok] = np.linalg.cond(xtx[ok]) < 1e12
+        if ok.any():
+            inv = np.linalg.inv(xtx[ok])
+            beta = np.einsum('cij,cj->ci', inv, xty[ok])
+            ssr = m[ok, k, k] - np.einsum('ci,ci->c', beta, xty[ok])
+            sigma2 = np.maximum(ssr, 0.0) / (n[ok] - k)
+            coef[ok] = beta
+            stderr[ok] = np.sqrt(sigma2[:, None] * np.einsum('cii->ci', inv))
+        return coef, stderr
+
+
+class RollingOLS(_RollingRegression):
+    '''
+    Least squares regression of y on an intercept and m regressors over a rolling window. value is the slope
+    of the first regressor (the hedge ratio of a pair); coef has all the coefficients and resid the residual
+    of the latest bar
+    '''
+
+    def update(self, y, *xs):
+        cols, z = self._push(y, *xs)
+        if len(cols) == 0:
+            return self.value
+        coef, _ = self._fit(cols)
+        self.coef[cols] = coef
+        self.value[cols] = coef[:, 1]
+        self.resid[cols] = z[:, -1] - np.einsum('ci,ci->c', z[:, :-1], coef)
+        return self.value
+
+
+class RollingBeta(RollingOLS):
+    '''
+    Rolling beta of y on x, cov(x, y) / var(x)
+    '''
+
+    param_names = ('window',)
+    cacheable = True
+
+    def __init__(self, window):
+        super(RollingBeta, self).__init__(window, n_regressors = 1)
+
+
+class RollingCorrelation(_RollingRegression):
+    '''
+    Rolling correlation of y and x
+    '''
+
+    param_names = ('window',)
+    cacheable = True
+
+    def __init__(self, window):
+        super(RollingCorrelation, self).__init__(window, n_regressors = 1)
+
+    def update(self, y, x):
+        cols, _ = self._push(y, x)
+        if len(cols) == 0:
+            return self.value
+        m = self.moments[cols]
+        n, sx, sy = m[:, 0, 0], m[:, 0, 1], m[:, 0, 2]
+        cov = n * m[:, 1, 2] - sx * sy
+        var_x = n * m[:, 1, 1] - sx * sx
+        var_y = n * m[:, 2, 2] - sy * sy
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            corr = cov / np.sqrt(var_x * var_y)
+        corr[(var_x <= 0) | (var_y <= 0)] = np.nan
+        self.value[cols] = corr
+        return self.value
+
+
+class RollingADF(_RollingRegression):
+    '''
+    An online Dickey-Fuller style stationarity score of a series s: the t-statistic of b in the regression
+    ds_t = a + b * s_(t-1) + e over a rolling window (no lagged differences). The more negative, the faster
+    the series reverts to its mean; about -2.9 is the 5% critical value of the test
+    '''
+
+    param_names = ('window',)
+    cacheable = True
+
+    def __init__(self, window):
+        super(RollingADF, self).__init__(window, n_regressors = 1)
+        self.n_inputs = 1
+        self.period = window + 1
+
+    def bind(self, n_symbols):
+        super(RollingADF, self).bind(n_symbols)
+        self.prev = np.full(n_symbols, np.nan)
+
+    def update(self, s):
+        new = ~np.isnan(s)
+        cols, _ = self._push(s - self.prev, self.prev) # NaN (skipped) where there is no previous value
+        self.prev[new] = s[new]
+        if len(cols) == 0:
+            return self.value
+        coef, stderr = self._fit(cols)
+        self.coef[cols] = coef
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            self.value[cols] = coef[:, 1] / stderr[:, 1]
+        return self.value
+
+
+class CointegrationScore(StreamingIndicator):
+    '''
+    An online Engle-Granger style score of a pair: the spread y - a - b * x, with a and b from a RollingOLS over
+    the window, is fed to a RollingADF over the same window. value is the ADF score of the spread, and
+    hedge_ratio and spread are the RollingOLS slope and latest residual
+    '''
+
+    n_inputs = 2
+    param_names = ('window',)
+    cacheable = False
+
+    def __init__(self, window):
+        self.window = window
+        self.ols = RollingOLS(window)
+        self.adf = RollingADF(window)
+        self.period = 2 * window
+
+    def bind(self, n_symbols):
+        super(CointegrationScore, self).bind(n_symbols)
+        self.ols.bind(n_symbols)
+        self.adf.bind(n_symbols)
+        self.hedge_ratio = self.ols.value
+        self.spread = self.ols.resid
+
+    def update(self, y, x):
+        self.ols.update(y, x)
+        spread = np.where(np.isnan(y) | np.isnan(x), np.nan, self.ols.resid)
+        self.adf.update(spread)
+        self.value[:] = self.adf.value
+        self.count[:] = self.ols.count
+        return self.value
+
+
+class RecursiveLS(StreamingIndicator):
+    '''
+    Recursive least squares of y on an intercept and m regressors, over all the bars seen so far with
+    exponential forgetting. Each bar updates the coefficients and their inverse information matrix in O(k^2).
+    value is the slope of the first regressor, coef has all the coefficients and error the one step ahead
+    forecast error of the latest bar
+    '''
+
+    param_names = ('n_regressors', 'forgetting', 'delta')
+    cacheable = False
+
+    def __init__(self, n_regressors = 1, forgetting = 1.0, delta = 1000.0):
+        '''
+        Parameters:
+        n_regressors - The number of regressors (besides the intercept)
+        forgetting - The weight of an observation is multiplied by this every bar (1.0 for ordinary least squares)
+        delta - The initial variance of the coefficients (large means an uninformative start)
+        '''
+        self.n_regressors = n_regressors
+        self.forgetting = forgetting
+        self.delta = delta
+        self.n_inputs = 1 + n_regressors
+        self.period = n_regressors + 2
+
+    def bind(self, n_symbols):
+        super(RecursiveLS, self).bind(n_symbols)
+        k = self.n_regressors + 1
+        self.coef = np.zeros((n_symbols, k))
+        self.P = np.tile(np.eye(k) * self.delta, (n_symbols, 1, 1))
+        self.error = np.full(n_symbols, np.nan)
+
+    def update(self, y, *xs):
+        valid = ~np.isnan(y)
+        for x in xs:
+            valid &= ~np.isnan(x)
+        cols = np.flatnonzero(valid)
+        if len(cols) == 0:
+            return self.value
+
+        X = np.column_stack([np.ones(len(cols))] + [x[cols] for x in xs])
+        P = self.P[cols]
+        coef = self.coef[cols]
+        Px = np.einsum('cij,cj->ci', P, X)
+        gain = Px / (self.forgetting + np.einsum('ci,ci->c', X, Px))[:, None]
+        error = y[cols] - np.einsum('ci,ci->c', X, coef)
+
+        self.coef[cols] = coef + gain * error[:, None]
+        self.P[cols] = (P - gain[:, :, None] * Px[:, None, :]) / self.forgetting
+        self.error[cols] = error
+        self.value[cols] = self.coef[cols, 1]
+        self.count[cols] += 1
+        return self.value
+
+
+class KalmanHedgeRatio(StreamingIndicator):
+    '''
+    A Kalman filter estimate of a time-varying hedge ratio, y = beta * x + alpha + noise, with beta and alpha
+    following random walks. value is beta; intercept is alpha, error the forecast error of the latest y given
+    the previous estimate, error_std its predicted standard deviation and zscore their ratio, which is the usual
+    entry/exit signal of a Kalman filter pairs trade
+    '''
+
+    n_inputs = 2
+    param_names = ('delta', 'obs_var')
+    cacheable = False
+
+    def __init__(self, delta = 1e-4, obs_var = 1e-3):
+        '''
+        Parameters:
+        delta - How fast the hedge ratio may drift: the state noise covariance is delta / (1 - delta) * I
+        obs_var - The variance of the observation noise
+        '''
+        self.delta = delta
+        self.obs_var = obs_var
+        self.period = 2
+
+    def bind(self, n_symbols):
+        super(KalmanHedgeRatio, self).bind(n_symbols)
+        self.state = np.zeros((n_symbols, 2)) # beta, alpha
+        self.P = np.zeros((n_symbols, 2, 2))
+        self.intercept = np.full(n_symbols, np.nan)
+        self.error = np.full(n_symbols, np.nan)
+        self.error_std = np.full(n_symbols, np.nan)
+        self.zscore = np.full(n_symbols, np.nan)
+        self._state_noise = np.eye(2) * self.delta / (1.0 - self.delta)
+
+    def update(self, y, x):
+        cols = np.flatnonzero(~(np.isnan(y) | np.isnan(x)))
+        if len(cols) == 0:
+            return self.value
+
+        X = np.column_stack([x[cols], np.ones(len(cols))])
+        state = self.state[cols]
+        R = self.P[cols] + self._state_noise
+        error = y[cols] - np.einsum('ci,ci->c', X, state)
+        RX = np.einsum('cij,cj->ci', R, X)
+        Q = np.einsum('ci,ci->c', X, RX) + self.obs_var
+        K = RX / Q[:, None]
+
+        self.state[cols] = state + K * error[:, None]
+        self.P[cols] = R - K[:, :, None] * RX[:, None, :] # R is symmetric, so x'R = (Rx)'
+        self.value[cols] = self.state[cols, 0]
+        self.intercept[cols] = self.state[cols, 1]
+        self.error[cols] = error
+        self.error_std[cols] = np.sqrt(Q)
+        self.zscore[cols] = error / np.sqrt(Q)
+        self.count[cols] += 1
+        return self.value
+
+
+class PairBank(IndicatorBank):
+    '''
+    An IndicatorBank whose columns are pairs of symbols: two-input estimators are fed the first leg as y and
+    the second as x, one-input indicators the first leg
+    '''
+
+    def __init__(self, bars, pairs, log_prices = False):
+        '''
+        Parameters:
+        bars - The DataHandler object that provides bar information
+        pairs - A list of (y symbol, x symbol) tuples
+        log_prices - Feed the estimators log prices (so e.g. hedge ratios are in returns terms)
+        '''
+        self.pairs = [tuple(pair) for pair in pairs]
+        symbols = []
+        for pair in self.pairs:
+            symbols.extend(s for s in pair if s not in symbols)
+        super(PairBank, self).__init__(bars, symbols)
+
+        self.log_prices = log_prices
+        self.n_columns = len(self.pairs)
+        self.pair_index = dict((pair, i) for i, pair in enumerate(self.pairs))
+        self.legs = np.array([[self.symbol_index[y], self.symbol_index[x]] for y, x in self.pairs], dtype = np.int64)
+
+    def add(self, name, indicator, fields = 'Adj_Close'):
+        if indicator.n_inputs > 2:
+            raise ValueError('A PairBank can only feed indicators with one or two inputs')
+        return super(PairBank, self).add(name, indicator, fields)
+
+    def _cache_keys(self, indicator, fields):
+        '''
+        Returns the cache key of the indicator's series for each pair (see IndicatorBank._cache_keys())
+        '''
+        if self.cache is None or not hasattr(self.bars, 'data_version'):
+            return None
+        keys = []
+        for pair in self.pairs:
+            versions = tuple(self.bars.data_version(s) for s in pair)
+            if None in versions:
+                return None
+            params = indicator.params + (('log_prices', self.log_prices),)
+            keys.append((pair, fields, type(indicator).__name__, params, versions))
+        return keys
+
+    def _column_inputs(self, fields, inputs):
+        columns = []
+        for i, field in enumerate(fields):
+            values = inputs[field][self.legs[:, i]]
+            if self.log_prices:
+                with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                    values = np.log(values)
+            columns.append(values)
+        return columns
+
+    def value(self, name, pair):
+        '''
+        Returns the named indicator's value for one (y symbol, x symbol) pair
+        '''
+        return self.indicators[name][0].value[self.pair_index[tuple(pair)]]
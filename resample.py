@@ -0,0 +1,199 @@
+# resample.py
+
+# Higher timeframe bars built on the fly from a data handler's base bars. Each base bar is folded into the
+# bar of every subscribed timeframe that it falls in (open = first, high = max, low = min, volume = sum, any
+# other field = last), vectorised across the symbols, so the cost per base bar doesn't depend on how long
+# the timeframes are. A timeframe's bar closes on the last base bar inside it, at which point the handler
+# puts a MarketEvent for that timeframe on the queue.
+
+from __future__ import print_function
+
+import re
+
+import numpy as np
+import pandas as pd
+
+from indicator_cache import SeriesRecorder
+
+_UNIT_NANOS = {
+    's': 10 ** 9,
+    'min': 60 * 10 ** 9,
+    'h': 3600 * 10 ** 9,
+    'd': 86400 * 10 ** 9,
+    'w': 7 * 86400 * 10 ** 9,
+}
+_UNIT_ALIASES = {
+    's': 's', 'sec': 's', 'm': 'min', 'min': 'min', 't': 'min', 'h': 'h', 'hour': 'h',
+    'd': 'd', 'day': 'd', 'w': 'w', 'week': 'w'
+}
+
+# weeks start on Mondays, and 1970-01-01 was a Thursday
+_WEEK_ORIGIN = 4 * 86400 * 10 ** 9
+
+
+class Timeframe(object):
+    '''
+    A bar length such as '5min', '1h', '1D' or '1W', which maps timestamps to the start of the bar they're in.
+    Bars are aligned to midnight (days and shorter) or to Monday midnight (weeks)
+    '''
+
+    def __init__(self, spec):
+        '''
+        Parameters:
+        spec - A string of an optional count and a unit: s, m/min, h, D or W
+        '''
+        match = re.match(r'^\s*(\d*)\s*([a-zA-Z]+)\s*$', spec)
+        unit = _UNIT_ALIASES.get(match.group(2).lower()) if match else None
+        if unit is None:
+            raise ValueError('Unknown timeframe %r' % spec)
+
+        self.count = int(match.group(1) or 1)
+        self.unit = unit
+        self.name = '%d%s' % (self.count, unit if unit in ('s', 'min', 'h') else unit.upper())
+        self.nanos = self.count * _UNIT_NANOS[unit]
+        self.origin = _WEEK_ORIGIN if unit == 'w' else 0
+
+    def bucket(self, dt):
+        '''
+        Returns the start of the bar dt falls in, as integer nanoseconds since the epoch
+        '''
+        value = pd.Timestamp(dt).value - self.origin
+        return value - value % self.nanos + self.origin
+
+    def __eq__(self, other):
+        return isinstance(other, Timeframe) and self.nanos == other.nanos and self.origin == other.origin
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.nanos, self.origin))
+
+    def __repr__(self):
+        return 'Timeframe(%r)' % self.name
+
+
+def aggregation(field):
+    '''
+    Returns how a field is aggregated into a longer bar, from its name: 'first', 'max', 'min', 'sum' or 'last'
+    '''
+    name = field.lower()
+    if 'open' in name:
+        return 'first'
+    if 'high' in name:
+        return 'max'
+    if 'low' in name:
+        return 'min'
+    if 'volume' in name:
+        return 'sum'
+    return 'last'
+
+
+class ResampledBars(object):
+    '''
+    The closed bars of one timeframe for every symbol of a data handler, built incrementally from its base bars.
+
+    Symbols without a value on a base bar (NaN) are left out of that base bar's aggregation, and a bar is
+    labelled with the start of its period.
+    '''
+
+    def __init__(self, timeframe, symbol_list, fields):
+        '''
+        Parameters:
+        timeframe - A Timeframe or its spec, e.g. '1h'
+        symbol_list - The symbols of the data handler
+        fields - The fields of the base bars
+        '''
+        self.timeframe = timeframe if isinstance(timeframe, Timeframe) else Timeframe(timeframe)
+        self.name = self.timeframe.name
+        self.symbol_list = symbol_list
+        self.fields = list(fields)
+        self._field_index = dict((f, j) for j, f in enumerate(self.fields))
+
+        rules = [aggregation(f) for f in self.fields]
+        self._rules = dict(
+            (rule, np.array([j for j, r in enumerate(rules) if r == rule], dtype = np.int64))
+            for rule in set(rules)
+        )
+
+        self._partial = np.full((len(self.fields), len(symbol_list)), np.nan)
+        self._bucket = None
+        self._history = [SeriesRecorder(len(symbol_list)) for _ in self.fields]
+        self.datetimes = []
+        self.closed_by_end = False # whether the last bar was closed because the data ended
+
+    def __len__(self):
+        return len(self.datetimes)
+
+    def _fold(self, rows):
+        partial = self._partial
+        missing = np.isnan(partial)
+        for rule, idx in self._rules.items():
+            if not len(idx):
+                continue
+            p, r, m = partial[idx], rows[idx], missing[idx]
+            if rule == 'first':
+                partial[idx] = np.where(m, r, p)
+            elif rule == 'max':
+                partial[idx] = np.fmax(p, r)
+            elif rule == 'min':
+                partial[idx] = np.fmin(p, r)
+            elif rule == 'sum':
+                partial[idx] = np.where(m, r, np.where(np.isnan(r), p, p + r))
+            else:
+                partial[idx] = np.where(np.isnan(r), p, r)
+
+    def update(self, dt, rows, next_dt = None):
+        '''
+        Folds a base bar into the current bar of the timeframe
+
+        Parameters:
+        dt - The datetime of the base bar
+        rows - A (fields x symbols) array of the base bar's values
+        next_dt - The datetime of the next base bar, None if there isn't one (or it isn't known yet)
+
+        Returns:
+        True if the base bar closed a bar of the timeframe
+        '''
+        bucket = self.timeframe.bucket(dt)
+        if bucket != self._bucket:
+            self._partial[:] = rows
+            self._bucket = bucket
+        else:
+            self._fold(rows)
+
+        if next_dt is not None and self.timeframe.bucket(next_dt) == bucket:
+            return False
+
+        for j, recorder in enumerate(self._history):
+            recorder.append(self._partial[j])
+        self.datetimes.append(pd.Timestamp(bucket))
+        self._bucket = None
+        self.closed_by_end = next_dt is None
+        return True
+
+    def get_latest_bar_datetime(self):
+        return self.datetimes[-1] if self.datetimes else None
+
+    def get_latest_bar_array(self, field):
+        '''
+        Returns the field's value of every symbol on the latest closed bar (NaN before the first)
+        '''
+        recorder = self._history[self._field_index[field]]
+        if recorder.n == 0:
+            return np.full(len(self.symbol_list), np.nan)
+        return recorder.data[recorder.n - 1]
+
+    def get_latest_bars_matrix(self, field, N = 1):
+        '''
+        Returns an (N x symbols) array of the field's values on the last N closed bars, oldest first, or N-k
+        rows if less available
+        '''
+        recorder = self._history[self._field_index[field]]
+        return recorder.data[max(0, recorder.n - N):recorder.n]
+
+    def get_latest_bar_value(self, symbol, field):
+        return self.get_latest_bar_array(field)[self.symbol_list.index(symbol)]
+
+    def get_latest_bars_values(self, symbol, field, N = 1):
+        return self.get_latest_bars_matrix(field, N)[:, self.symbol_list.index(symbol)]
@@ -0,0 +1,185 @@
+# risk.py
+
+# A pre-trade risk stage that sits between the Portfolio's order generation and the event queue. A batch of
+# proposed orders is checked against the whole book at once: every limit is evaluated on numpy arrays aligned
+# with the Portfolio's symbol_list, and orders that would breach a limit are resized (or cut to zero) rather
+# than passed through.
+
+from __future__ import print_function
+
+import numpy as np
+
+from rebalance import estimate_ib_commission
+
+
+class RiskManager(object):
+    '''
+    Resizes or rejects proposed orders so the resulting portfolio stays within its limits.
+
+    Exposure limits are fractions of the current (marked to market) equity. An order is only ever cut back
+    towards zero, never increased or reversed, and positions that already breach a limit may still be reduced.
+    Limits left as None are not checked.
+    '''
+
+    def __init__(self, max_gross_exposure = None, max_net_exposure = None, max_position_weight = None,
+                 sector_map = None, max_sector_weight = None, max_order_notional = None, check_cash = True,
+                 lot_size = 1, commission_model = estimate_ib_commission):
+        '''
+        Parameters:
+        max_gross_exposure - Cap on sum(|position value|) / equity
+        max_net_exposure - Cap on |sum(position value)| / equity
+        max_position_weight - Cap on |position value| / equity for every symbol
+        sector_map - dict of symbol -> sector name, used by max_sector_weight
+        max_sector_weight - Cap on the gross exposure of each sector / equity, either one number for all sectors
+                            or a dict of sector -> cap (sectors missing from the dict are uncapped)
+        max_order_notional - Cap on |quantity * price| of a single order that increases a position
+        check_cash - If True, buys that open or add to a position are scaled down to what the cash (plus the batch's
+                     sell proceeds, less the cost of its buys to cover) can pay for
+        lot_size - Resized orders are rounded towards zero to a multiple of this
+        commission_model - Function of an array of quantities returning the estimated commissions
+        '''
+        self.max_gross_exposure = max_gross_exposure
+        self.max_net_exposure = max_net_exposure
+        self.max_position_weight = max_position_weight
+        self.sector_map = sector_map or {}
+        self.max_sector_weight = max_sector_weight
+        self.max_order_notional = max_order_notional
+        self.check_cash = check_cash
+        self.lot_size = lot_size
+        self.commission_model = commission_model
+
+        self.symbol_list = None
+        self.sector_codes = None
+        self.sector_caps = None
+
+    def bind(self, symbol_list):
+        '''
+        Precomputes the per-symbol sector codes and per-sector caps for the Portfolio's symbol_list
+        '''
+        self.symbol_list = list(symbol_list)
+        sectors = sorted(set(self.sector_map.get(s, '') for s in self.symbol_list))
+        codes = dict((sector, i) for i, sector in enumerate(sectors))
+        self.sector_codes = np.array([codes[self.sector_map.get(s, '')] for s in self.symbol_list], dtype = np.intp)
+
+        if isinstance(self.max_sector_weight, dict):
+            caps = [self.max_sector_weight.get(sector, np.inf) for sector in sectors]
+        elif self.max_sector_weight is not None:
+            # symbols without a sector aren't grouped together under a single cap
+            caps = [np.inf if sector == '' else self.max_sector_weight for sector in sectors]
+        else:
+            caps = [np.inf] * len(sectors)
+        self.sector_caps = np.array(caps, dtype = np.float64)
+
+    def _round(self, quantity):
+        return np.trunc(quantity / self.lot_size) * self.lot_size
+
+    def _cap_exposure(self, new, positions, prices, groups, limits):
+        '''
+        Scales back the exposure-increasing part of the orders in every group whose gross exposure would exceed
+        its limit. Returns the capped new positions
+
+        Parameters:
+        new - The proposed positions after the orders
+        positions - The current positions
+        prices - The current prices
+        groups - Group code of every symbol
+        limits - Limit on the gross exposure (in dollars) of every group
+        '''
+        exposure = np.abs(new * prices)
+        # the part of each position that stays if its order is cut back to no increase in exposure
+        same_side = np.sign(new) == np.sign(positions)
+        base = np.minimum(exposure, np.where(same_side, np.abs(positions * prices), 0.0))
+        increase = exposure - base
+
+        n_groups = len(limits)
+        group_exposure = np.bincount(groups, weights = exposure, minlength = n_groups)
+        if not (group_exposure > limits).any():
+            return new
+
+        group_base = np.bincount(groups, weights = base, minlength = n_groups)
+        group_increase = np.bincount(groups, weights = increase, minlength = n_groups)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            factor = np.clip((limits - group_base) / group_increase, 0.0, 1.0)
+        factor = np.where(group_exposure > limits, np.nan_to_num(factor), 1.0)
+
+        capped = np.sign(new) * (base + factor[groups] * increase) / prices
+        return positions + self._round(capped - positions)
+
+    def check_orders(self, quantity, prices, positions, cash):
+        '''
+        Returns the approved signed order quantities, aligned with the bound symbol_list
+
+        Parameters:
+        quantity - Array of proposed signed order quantities (0 where there is no order)
+        prices - Array of current prices
+        positions - Array of current signed positions
+        cash - The current cash balance
+        '''
+        quantity = np.asarray(quantity, dtype = np.float64)
+        positions = np.asarray(positions, dtype = np.float64)
+        tradable = np.isfinite(prices) & (prices > 0)
+        prices = np.where(tradable, prices, 1.0)
+        quantity = np.where(tradable, quantity, 0.0)
+
+        equity = cash + (np.where(tradable, positions, 0.0) * prices).sum()
+
+        if self.max_order_notional is not None:
+            # orders that only reduce a position are never held back by the order size cap
+            max_quantity = np.floor(self.max_order_notional / prices / self.lot_size) * self.lot_size
+            increasing = np.abs(positions + quantity) > np.abs(positions)
+            quantity = np.where(increasing, np.clip(quantity, -max_quantity, max_quantity), quantity)
+
+        new = positions + quantity
+
+        if self.max_position_weight is not None:
+            n = len(new)
+            new = self._cap_exposure(new, positions, prices, np.arange(n), np.full(n, self.max_position_weight * equity))
+
+        if self.max_sector_weight is not None:
+            new = self._cap_exposure(new, positions, prices, self.sector_codes, self.sector_caps * equity)
+
+        if self.max_gross_exposure is not None:
+            groups = np.zeros(len(new), dtype = np.intp)
+            new = self._cap_exposure(new, positions, prices, groups, np.array([self.max_gross_exposure * equity]))
+
+        quantity = new - positions
+
+        # the part of each order that only takes its position towards zero (e.g. a buy to cover), which the net
+        # exposure and cash checks never hold back; they scale the part that opens or adds to a position
+        reducing = np.where(
+            quantity * positions < 0, np.sign(quantity) * np.minimum(np.abs(quantity), np.abs(positions)), 0.0
+        )
+
+        if self.max_net_exposure is not None:
+            net = (new * prices).sum()
+            limit = self.max_net_exposure * equity
+            if abs(net) > limit:
+                # scale down the orders that push the net exposure further in the offending direction
+                side = np.sign(net)
+                increasing = quantity - reducing
+                pushing = increasing * side > 0
+                push_value = (increasing[pushing] * prices[pushing]).sum() * side
+                factor = max(0.0, 1.0 - (abs(net) - limit) / push_value) if push_value > 0 else 1.0
+                quantity = np.where(pushing, reducing + self._round(increasing * factor), quantity)
+
+        if self.check_cash:
+            sells = np.minimum(quantity, 0.0)
+            covers = np.maximum(reducing, 0.0)
+            buys = np.maximum(quantity, 0.0) - covers
+
+            def cost(buys):
+                return ((covers + buys) * prices).sum() + self.commission_model(covers + buys).sum()
+
+            available = cash - (sells * prices).sum() - self.commission_model(sells).sum()
+            if buys.any() and cost(buys) > available:
+                # the covers are paid for first, the buys get what is left
+                cover_cost = cost(np.zeros_like(buys))
+                factor = max(available - cover_cost, 0.0) / (cost(buys) - cover_cost)
+                buys = self._round(buys * factor)
+                # rounding may leave the commission just over budget, so drop lots until it fits
+                while buys.any() and cost(buys) > available:
+                    largest = np.argmax(buys * prices)
+                    buys[largest] = max(0.0, buys[largest] - self.lot_size)
+                quantity = sells + covers + buys
+
+        return np.where(tradable, quantity, 0.0)
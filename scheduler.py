@@ -0,0 +1,47 @@
+# scheduler.py
+
+# A priority queue of items keyed by simulated time. Items are released in time order (and in the order they
+# were scheduled when their times are equal) as the simulation clock advances, and releasing only ever looks
+# at the items that are due.
+
+from __future__ import print_function
+
+import heapq
+import itertools
+
+
+class FillScheduler(object):
+    '''
+    Holds delayed items until the simulated clock reaches their release time.
+
+    The release times only need to be comparable with each other and with the clock passed to release(),
+    e.g. all bar numbers or all datetimes.
+    '''
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, release_at, item):
+        '''
+        Schedules item to be released once the clock reaches release_at
+        '''
+        heapq.heappush(self._heap, (release_at, next(self._seq), item))
+
+    def next_release(self):
+        '''
+        Returns the earliest scheduled release time, or None if nothing is scheduled
+        '''
+        return self._heap[0][0] if self._heap else None
+
+    def release(self, now):
+        '''
+        Pops and returns, in release order, every item due at or before now
+        '''
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
@@ -33,3 +33,206 @@ class Strategy(object):
         Provides the mechanisms to calculate the list of signals
         '''
         raise NotImplementedError('Should implement calculate_signals()')
+
+
+# signal codes of CrossSectionalStrategy.calculate_signal_vector()
+SIGNAL_NONE = 0
+SIGNAL_LONG = 1
+SIGNAL_SHORT = -1
+SIGNAL_EXIT = 2
+
+SIGNAL_TYPES = {SIGNAL_LONG: 'LONG', SIGNAL_SHORT: 'SHORT', SIGNAL_EXIT: 'EXIT'}
+
+
+class CrossSectionalStrategy(Strategy):
+    '''
+    A base class for strategies that look at all of their symbols at once. On each MarketEvent the latest bar
+    is read as one array per field across the symbols (and lookback matrices on request), and the subclass
+    returns a vector of signal codes, one per symbol, so a bar costs a few numpy operations rather than several
+    DataHandler calls per symbol.
+
+    Subclasses set `fields` and implement calculate_signal_vector(), e.g.
+
+        class Momentum(CrossSectionalStrategy):
+            fields = ('Adj_Close',)
+
+            def calculate_signal_vector(self, bar):
+                prices = self.lookback('Adj_Close', 21)
+                if len(prices) < 21:
+                    return np.zeros(len(self.symbol_list), dtype = int)
+                momentum = prices[-1] / prices[0] - 1
+                enter, leave = momentum > 0.1, momentum < 0
+                return np.where(enter, SIGNAL_LONG, np.where(leave, SIGNAL_EXIT, SIGNAL_NONE))
+
+    and are run by a Backtest like any other strategy (Backtest(..., strategy = Momentum, ...)).
+    '''
+
+    __metaclass__ = ABCMeta
+
+    # the bar fields read into the arrays passed to calculate_signal_vector()
+    fields = ('Adj_Close',)
+
+    def __init__(self, bars, events, external_data_dir = None):
+        '''
+        Parameters:
+        bars - The DataHandler object that provides bar information
+        events - The Event Queue object
+        external_data_dir - (Optional) The external data the Backtest was given, unused by default
+        '''
+        self.bars = bars
+        self.symbol_list = self.bars.symbol_list
+        self.events = events
+
+    def current_bar(self):
+        '''
+        Returns a dict of field -> array of the latest values of the symbols, plus 'datetime'
+        '''
+        bar = dict((field, self.bars.get_latest_bar_array(field)) for field in self.fields)
+        bar['datetime'] = self.bars.get_latest_datetime()
+        return bar
+
+    def lookback(self, field, N):
+        '''
+        Returns an (N x symbols) array of the last N values of field, oldest first (fewer rows at the start)
+        '''
+        return self.bars.get_latest_bars_matrix(field, N)
+
+    @abstractmethod
+    def calculate_signal_vector(self, bar):
+        '''
+        Returns an array with a signal code (SIGNAL_NONE, SIGNAL_LONG, SIGNAL_SHORT or SIGNAL_EXIT) per symbol
+        of symbol_list, given the current bar from current_bar(). It may also return a (codes, strengths) tuple
+
+        Parameters:
+        bar - A dict of field -> array of the latest values of the symbols, plus 'datetime'
+        '''
+        raise NotImplementedError('Should implement calculate_signal_vector()')
+
+    def calculate_signals(self, event):
+        '''
+        Reacts to a MarketEvent object by computing the signal vector and putting a SignalEvent on the queue for
+        each symbol with a signal, in the order of symbol_list
+
+        Parameters:
+        event - a MarketEvent object
+        '''
+        if event.type == 'MARKET':
+            result = self.calculate_signal_vector(self.current_bar())
+            if isinstance(result, tuple):
+                codes, strengths = result
+            else:
+                codes, strengths = result, None
+            codes = np.asarray(codes)
+
+            # symbols outside the data handler's universe on this bar can't trade
+            dt = datetime.datetime.utcnow()
+            for i in np.flatnonzero((codes != SIGNAL_NONE) & self.bars.active_mask):
+                strength = 1.0 if strengths is None else float(strengths[i])
+                signal = SignalEvent(
+                    strategy_id = 1, symbol = self.symbol_list[i], datetime = dt,
+                    signal_type = SIGNAL_TYPES[int(codes[i])], strength = strength
+                )
+                self.events.put(signal)
+
+
+class PerSymbolStrategy(Strategy):
+    '''
+    A base class for strategies whose signal for a symbol only depends on that symbol, e.g. a model fitted per
+    symbol on every bar. Subclasses implement calculate_symbol_signal(), which may only change the state of the
+    symbol it is called for.
+
+    With workers > 1 the symbols are split into contiguous chunks that are evaluated on a thread pool. All the
+    chunks of a bar are finished before any SignalEvent is put on the queue, and the signals are put in
+    symbol_list order, so a run gives the same results as a serial one. This pays off when the per-symbol work
+    is numpy/statsmodels code that releases the GIL.
+    '''
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, bars, events, external_data_dir = None, workers = None):
+        '''
+        Parameters:
+        bars - The DataHandler object that provides bar information
+        events - The Event Queue object
+        external_data_dir - (Optional) The external data the Backtest was given, unused by default
+        workers - (Optional) The number of threads the symbols are evaluated on; None or 1 to run serially
+        '''
+        self.bars = bars
+        self.symbol_list = self.bars.symbol_list
+        self.events = events
+        self.workers = workers
+        self._pool = None
+        self._chunks = None
+        self._chunked = None
+
+    @abstractmethod
+    def calculate_symbol_signal(self, symbol, event):
+        '''
+        Returns the signal for one symbol: None, a signal type ('LONG', 'SHORT' or 'EXIT') or a
+        (signal type, strength) tuple. Runs on a worker thread when workers > 1
+
+        Parameters:
+        symbol - The symbol to evaluate
+        event - The MarketEvent object
+        '''
+        raise NotImplementedError('Should implement calculate_symbol_signal()')
+
+    def _evaluate_chunk(self, symbols, event):
+        return [self.calculate_symbol_signal(s, event) for s in symbols]
+
+    def _evaluate(self, symbols, event):
+        '''
+        Returns the results of calculate_symbol_signal() for the symbols, in their order
+        '''
+        if not self.workers or self.workers <= 1 or len(symbols) < 2:
+            return self._evaluate_chunk(symbols, event)
+
+        if self._pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor(max_workers = self.workers)
+        if symbols is not self._chunked:
+            # a few chunks per thread, so one slow chunk doesn't hold up the bar
+            n_chunks = min(len(symbols), 4 * self.workers)
+            size = -(-len(symbols) // n_chunks)
+            self._chunks = [symbols[i:i + size] for i in range(0, len(symbols), size)]
+            self._chunked = symbols
+
+        # map() hands the results back in submission order, and collecting them all is the barrier
+        results = []
+        for chunk_results in self._pool.map(self._evaluate_chunk, self._chunks, [event] * len(self._chunks)):
+            results.extend(chunk_results)
+        return results
+
+    def calculate_signals(self, event):
+        '''
+        Reacts to a MarketEvent object by evaluating every symbol that got the bar (all of them unless the data
+        handler has a Universe) and putting a SignalEvent on the queue for each symbol with a signal, in the
+        order of symbol_list
+
+        Parameters:
+        event - a MarketEvent object
+        '''
+        if event.type == 'MARKET':
+            symbols = self.bars.active_symbols
+            results = self._evaluate(symbols, event)
+            dt = datetime.datetime.utcnow()
+            for symbol, result in zip(symbols, results):
+                if result is None:
+                    continue
+                signal_type, strength = result if isinstance(result, tuple) else (result, 1.0)
+                signal = SignalEvent(strategy_id = 1, symbol = symbol, datetime = dt, signal_type = signal_type, strength = strength)
+                self.events.put(signal)
+
+    def __getstate__(self):
+        # the thread pool is started again when the strategy is restored from a checkpoint
+        state = self.__dict__.copy()
+        state['_pool'] = state['_chunks'] = state['_chunked'] = None
+        return state
+
+    def close(self):
+        '''
+        Shuts the thread pool down
+        '''
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
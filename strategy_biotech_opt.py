@@ -7,11 +7,10 @@ from datetime import date
 from dateutil.relativedelta import relativedelta
 
 import numpy as np
-import pandas as pd
-import statsmodels.api as sm
 
 from strategy import Strategy
 from event import SignalEvent
+from event_calendar import CatalystCalendar
 from backtest import Backtest
 from data import HistoricCSVDataHandler, AlphaVantage_HistoricCSVDataHandler
 from execution import SimulatedExecutionHandler
@@ -37,14 +36,18 @@ class BiotechApprovalStrategy(Strategy):
         self.events = events
 
         self.approvals_csv_dir = approvals_csv_dir
-        self.approvals_data = pd.read_csv(approvals_csv_dir)
-        self.approvals_data['catalyst_date'] = pd.to_datetime(self.approvals_data['catalyst_date'])
+        self.calendar = CatalystCalendar(approvals_csv_dir)
+        self.approvals_data = self.calendar.data
+        self.symbol_order = dict((s, i) for i, s in enumerate(self.symbol_list))
 
         # Set to True if a symbol is in the market
         self.bought = self._calculate_initial_bought()
         self.entry_signals = self._calculate_initial_entry_signals()
         self.exit_dates = {}
 
+        # symbols with a pending entry signal or an open position, i.e. the ones to look at on every bar
+        self.active = set()
+
     def _calculate_initial_entry_signals(self):
         '''
         Creates a dict of 0's for each symbol.
@@ -79,7 +82,14 @@ class BiotechApprovalStrategy(Strategy):
         '''
         # print(bar_date)
         if event.type == 'MARKET':
-            for s in self.symbol_list:
+            # besides the active symbols, only the ones with a catalyst on this bar's day need to be looked at
+            # (symbols outside the data handler's universe on this bar have no new bar and are skipped)
+            bar_date = self.bars.get_latest_datetime()
+            candidates = set(self.active)
+            candidates.update(c for c in self.calendar.symbols_on(bar_date) if c in self.symbol_order)
+            candidates = sorted((c for c in candidates if self.bars.is_active(c)), key = self.symbol_order.get)
+
+            for s in candidates:
                 bar = self.bars.get_latest_bar_value(s, 'Adj_Close')
                 bar_date = self.bars.get_latest_bar_datetime(s)
 
@@ -106,13 +116,13 @@ class BiotechApprovalStrategy(Strategy):
                         self.events.put(signal)
                         self.bought[s] = 'OUT'
                         self.exit_dates[s] = None
+                        self.active.discard(s)
 
                     # generate the buy signals
                     if self.bought[s] == 'OUT':
-                        entry_result = self.approvals_data[(self.approvals_data['ticker'] == s) &
-                             (pd.to_datetime(self.approvals_data['catalyst_date']) == pd.to_datetime(bar_date))]
-                        if len(entry_result) > 0:
+                        if self.calendar.has_event(s, bar_date):
                             self.entry_signals[s] = 1
+                            self.active.add(s)
 
 
 
@@ -5,11 +5,10 @@ from __future__ import print_function
 import datetime
 
 import numpy as np
-import pandas as pd
-import statsmodels.api as sm
 
 from strategy import Strategy
 from event import SignalEvent
+from event_calendar import CatalystCalendar
 from backtest import Backtest
 from data import HistoricCSVDataHandler, AlphaVantage_HistoricCSVDataHandler
 from execution import SimulatedExecutionHandler
@@ -34,8 +33,9 @@ class BiotechApprovalStrategy(Strategy):
         self.events = events
 
         self.approvals_csv_dir = approvals_csv_dir
-        self.approvals_data = pd.read_csv(approvals_csv_dir)
-        self.approvals_data['catalyst_date'] = pd.to_datetime(self.approvals_data['catalyst_date'])
+        self.calendar = CatalystCalendar(approvals_csv_dir)
+        self.approvals_data = self.calendar.data
+        self.symbol_order = dict((s, i) for i, s in enumerate(self.symbol_list))
 
         # Set to True if a symbol is in the market
         self.bought = self._calculate_initial_bought()
@@ -65,7 +65,15 @@ class BiotechApprovalStrategy(Strategy):
         '''
         # print(bar_date)
         if event.type == 'MARKET':
-            for s in self.symbol_list:
+            # only the symbols with an exit or a catalyst on this bar's day need to be looked at
+            bar_date = self.bars.get_latest_datetime()
+            candidates = set(self.calendar.symbols_on(bar_date, 'exit_date'))
+            candidates.update(self.calendar.symbols_on(bar_date, 'catalyst_date'))
+            candidates = sorted(
+                (c for c in candidates if c in self.symbol_order and self.bars.is_active(c)), key = self.symbol_order.get
+            )
+
+            for s in candidates:
                 bar = self.bars.get_latest_bar_value(s, 'Adj_Close')
                 bar_date = self.bars.get_latest_bar_datetime(s)
 
@@ -74,14 +82,10 @@ class BiotechApprovalStrategy(Strategy):
                     symbol = s
                     dt = datetime.datetime.utcnow()
                     sig_dir = ''
-                    exit_result = []
-                    entry_result = []
 
                     if self.bought[s] != 'OUT':
 
-                        exit_result = self.approvals_data[(self.approvals_data['ticker'] == s) &
-                         (pd.to_datetime(self.approvals_data['exit_date']) == pd.to_datetime(bar_date))]
-                        if len(exit_result) > 0:
+                        if self.calendar.has_event(s, bar_date, 'exit_date'):
                             sig_dir = 'EXIT'
                             signal = SignalEvent(strategy_id = 1, symbol = symbol, datetime = dt, signal_type = sig_dir, strength = 1.0)
                             self.events.put(signal)
@@ -89,9 +93,7 @@ class BiotechApprovalStrategy(Strategy):
 
                     if self.bought[s] == 'OUT':
 
-                        entry_result = self.approvals_data[(self.approvals_data['ticker'] == s) &
-                         (pd.to_datetime(self.approvals_data['catalyst_date']) == pd.to_datetime(bar_date))]
-                        if len(entry_result) > 0 and self.bought[s] == 'OUT':
+                        if self.calendar.has_event(s, bar_date, 'catalyst_date'):
                             sig_dir = 'BUY'
                             signal = SignalEvent(strategy_id = 1, symbol = symbol, datetime = dt, signal_type = sig_dir, strength = 1.0)
                             self.events.put(signal)
@@ -6,10 +6,11 @@ import datetime
 
 import numpy as np
 import pandas as pd
-import statsmodels.api as sm
 
 from strategy import Strategy
 from event import SignalEvent
+from indicators import IndicatorBank, SMA
+from journal import get_journal
 from backtest import Backtest
 from data import HistoricCSVDataHandler
 from execution import SimulatedExecutionHandler
@@ -41,6 +42,13 @@ class MovingAverageCrossStrategy(Strategy):
         # Set to True if a symbol is in the market
         self.bought = self._calculate_initial_bought()
 
+        # the moving averages are updated incrementally by the data handler on every bar
+        self.indicators = IndicatorBank(self.bars, self.symbol_list)
+        self.short_sma = self.indicators.add('short_sma', SMA(self.short_window), 'adj_close_price')
+        self.long_sma = self.indicators.add('long_sma', SMA(self.long_window), 'adj_close_price')
+
+        self.journal = get_journal()
+
     def _calculate_initial_bought(self):
         '''
         Adds keys to the bought dictionary for all symbols and
@@ -54,10 +62,10 @@ class MovingAverageCrossStrategy(Strategy):
 
     def calculate_signals(self, event):
         '''
-        Reacts to a MarketEvent object and for each symbol obtains the
-        latest N bar closing prices where N is the larger lookback period.
-        Then it calculates the simple moving averages. If the short SMA
-        exceeds the long SMA, go long. If the long SMA exceeds the short SMA,
+        Reacts to a MarketEvent object and for each symbol compares the
+        simple moving averages over the short and long lookback periods
+        (over the bars available so far while there are fewer).
+        If the short SMA exceeds the long SMA, go long. If the long SMA exceeds the short SMA,
         exit the position.
 
         It does this by generating a SignalEvent object if there is a moving average cross
@@ -67,23 +75,24 @@ class MovingAverageCrossStrategy(Strategy):
         event - a MarketEvent object
         '''
         if event.type == 'MARKET':
-            for s in self.symbol_list:
-                bars = self.bars.get_latest_bars_values(s, 'adj_close_price', N=self.long_window)
-                bar_date = self.bars.get_latest_bar_datetime(s)
-                if bars is not None and bars != []:
-                    short_sma = np.mean(bars[-self.short_window:])
-                    long_sma = np.mean(bars[-self.long_window:])
+            # a symbol without a price on some of the bars of its long window (e.g. before it was listed) is
+            # skipped until the window is full; at the start of the data the averages are over the bars so far
+            full = self.long_sma.count >= min(self.indicators.n_updates, self.long_window)
+            full &= self.bars.active_mask
+            for i in np.flatnonzero(full & (self.short_sma.value > self.long_sma.value)):
+                s = self.symbol_list[i]
+                if self.bought[s] == 'OUT':
+                    bar_date = self.bars.get_latest_bar_datetime(s)
 
                     symbol = s
                     dt = datetime.datetime.utcnow()
                     sig_dir = ''
 
-                    if short_sma > long_sma and self.bought[s] == 'OUT':
-                        print('LONG: %s' % bar_date)
-                        sig_dir = 'LONG'
-                        signal = SignalEvent(strategy_id = 1, symbol = symbol, datetime = dt, signal_type = sig_dir, strength = 1.0)
-                        self.events.put(signal)
-                        self.bought[s] = 'LONG'
+                    self.journal.info('SIGNAL', date = bar_date, symbol = symbol, signal_type = 'LONG')
+                    sig_dir = 'LONG'
+                    signal = SignalEvent(strategy_id = 1, symbol = symbol, datetime = dt, signal_type = sig_dir, strength = 1.0)
+                    self.events.put(signal)
+                    self.bought[s] = 'LONG'
 
 
 if __name__ == '__main__':
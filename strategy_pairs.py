@@ -0,0 +1,139 @@
+# strategy_pairs.py
+
+from __future__ import print_function
+
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from strategy import Strategy
+from event import SignalEvent
+from regression import PairBank, KalmanHedgeRatio, CointegrationScore
+from journal import get_journal
+from backtest import Backtest
+from data import AlphaVantage_HistoricCSVDataHandler
+from execution import SimulatedExecutionHandler
+from portfolio import Portfolio
+
+class PairsTradingStrategy(Strategy):
+    '''
+    Trades the spread of pairs of stocks, y - beta * x - alpha, with the hedge ratio beta tracked by a Kalman
+    filter. It goes long the spread (long y, short x) when the filter's forecast error is more than entry_z
+    standard deviations below zero, short the spread when it is as far above, and exits both legs once it is
+    back within exit_z. Optionally, only pairs whose rolling cointegration score is below max_adf are entered.
+
+    The legs are sized by the hedge ratio at entry: the signals' strengths split the two legs' usual size
+    between y and x in the proportion 1 : |beta| (the prices are logs, so beta is a ratio of dollar amounts).
+
+    The estimators of all the pairs are updated together, once per bar, by the data handler. The Portfolio holds
+    one position per symbol, so the pairs shouldn't share symbols.
+    '''
+
+    def __init__(self, bars, events, pairs, entry_z = 2.0, exit_z = 0.5, delta = 1e-4, obs_var = 1e-3,
+                 adf_window = None, max_adf = -2.9, field = 'Adj_Close'):
+        '''
+        Initializes the pairs trading strategy
+
+        Parameters:
+        bars - The DataHandler object that provides bar information
+        events - The Event Queue object
+        pairs - A list of (y symbol, x symbol) tuples, or the path to a csv file with the pairs in its first two columns
+        entry_z - The forecast error z-score beyond which a pair is entered
+        exit_z - The forecast error z-score within which a pair is exited
+        delta - The hedge ratio drift of the Kalman filter (see regression.KalmanHedgeRatio)
+        obs_var - The observation noise variance of the Kalman filter, in log price units
+        adf_window - (Optional) The window of the cointegration score; None to trade every pair
+        max_adf - Pairs are only entered while their cointegration score is below this
+        field - The price field of the bars
+        '''
+        self.bars = bars
+        self.symbol_list = self.bars.symbol_list
+        self.events = events
+
+        if isinstance(pairs, str):
+            pairs = pd.read_csv(pairs).iloc[:, :2].values.tolist()
+        self.pairs = [tuple(pair) for pair in pairs]
+        self.entry_z = entry_z
+        self.exit_z = exit_z
+        self.max_adf = max_adf
+
+        self.estimators = PairBank(self.bars, self.pairs, log_prices = True)
+        self.kalman = self.estimators.add('kalman', KalmanHedgeRatio(delta, obs_var), field)
+        self.coint = None
+        if adf_window is not None:
+            self.coint = self.estimators.add('coint', CointegrationScore(adf_window), field)
+
+        # 1 if a pair is long the spread, -1 if short and 0 if out of the market
+        self.position = np.zeros(len(self.pairs), dtype = np.int64)
+
+        self.journal = get_journal()
+
+    def _signal(self, symbol, signal_type, strength = 1.0):
+        signal = SignalEvent(strategy_id = 1, symbol = symbol, datetime = datetime.datetime.utcnow(), signal_type = signal_type, strength = strength)
+        self.events.put(signal)
+
+    def calculate_signals(self, event):
+        '''
+        Reacts to a MarketEvent object by comparing every pair's latest forecast error z-score with the entry
+        and exit thresholds, and generating a SignalEvent for each leg of the pairs that are entered or exited
+
+        Parameters:
+        event - a MarketEvent object
+        '''
+        if event.type == 'MARKET':
+            z = self.kalman.zscore
+            tradable = self.kalman.ready & ~np.isnan(z)
+            if self.coint is not None:
+                tradable &= self.coint.ready & (self.coint.value < self.max_adf)
+
+            flat = self.position == 0
+            enter_long = flat & tradable & (z < -self.entry_z)
+            enter_short = flat & tradable & (z > self.entry_z)
+            exit_ = ~flat & (np.abs(z) < self.exit_z)
+
+            for i in np.flatnonzero(enter_long | enter_short | exit_):
+                y, x = self.pairs[i]
+                if exit_[i]:
+                    sig_y = sig_x = 'EXIT'
+                    self.position[i] = 0
+                elif enter_long[i]:
+                    sig_y, sig_x = 'LONG', 'SHORT'
+                    self.position[i] = 1
+                else:
+                    sig_y, sig_x = 'SHORT', 'LONG'
+                    self.position[i] = -1
+
+                self.journal.info(
+                    'SIGNAL', date = self.bars.get_latest_bar_datetime(y), pair = '%s/%s' % (y, x),
+                    signal_type = sig_y, zscore = z[i], hedge_ratio = self.kalman.value[i]
+                )
+                # y - beta * x is hedged by holding |beta| dollars of x per dollar of y
+                beta = abs(self.kalman.value[i])
+                self._signal(y, sig_y, 2.0 / (1.0 + beta))
+                self._signal(x, sig_x, 2.0 * beta / (1.0 + beta))
+
+
+if __name__ == '__main__':
+    csv_dir = 'Data'
+    pairs = [('NVS', 'NVO'), ('VRTX', 'AGN')]
+
+    symbol_list = [s for pair in pairs for s in pair]
+    initial_capital = 1000000.0
+    heartbeat = 0.0
+    start_date = datetime.datetime(2017, 1, 1, 0, 0, 0)
+
+    backtest = Backtest(
+        csv_dir = csv_dir,
+        symbol_list = symbol_list,
+        initial_capital = initial_capital,
+        heartbeat = heartbeat,
+        start_date = start_date,
+        data_handler = AlphaVantage_HistoricCSVDataHandler,
+        execution_handler = SimulatedExecutionHandler,
+        portfolio = Portfolio,
+        strategy = PairsTradingStrategy,
+        external_data_dir = pairs,
+        strategy_title = 'Kalman Filter Pairs Trading Strategy'
+    )
+    backtest.simulate_trading()
@@ -0,0 +1,109 @@
+# strategy_trend.py
+
+from __future__ import print_function
+
+import datetime
+import os
+
+import numpy as np
+
+from strategy import PerSymbolStrategy
+from backtest import Backtest
+from data import AlphaVantage_HistoricCSVDataHandler
+from execution import SimulatedExecutionHandler
+from portfolio import Portfolio
+
+class TrendFitStrategy(PerSymbolStrategy):
+    '''
+    Fits a polynomial trend to the log prices of the last `window` bars of each symbol on every bar, goes long
+    when the slope of the trend at the latest bar is above entry_slope and exits when it falls below -entry_slope.
+    The fits are independent per symbol, so they can be evaluated on a thread pool (workers > 1).
+    '''
+
+    def __init__(self, bars, events, external_data_dir = None, workers = None, window = 60, degree = 5,
+                 entry_slope = 0.05):
+        '''
+        Initializes the trend fit strategy
+
+        Parameters:
+        bars - The DataHandler object that provides bar information
+        events - The Event Queue object
+        external_data_dir - (Optional) Unused
+        workers - (Optional) The number of threads the symbols are evaluated on; None or 1 to run serially
+        window - The number of bars the trend is fitted to
+        degree - The degree of the polynomial
+        entry_slope - The slope of the trend (in log price over the window) beyond which a symbol is entered
+        '''
+        super(TrendFitStrategy, self).__init__(bars, events, external_data_dir, workers)
+        self.window = window
+        self.degree = degree
+        self.entry_slope = entry_slope
+
+        # the design matrix is the same for every symbol and bar
+        self.design = np.vander(np.linspace(-1, 1, self.window), self.degree + 1)
+
+        # Set to True if a symbol is in the market; each symbol's entry is only touched by its own evaluation
+        self.bought = dict((s, False) for s in self.symbol_list)
+
+    def calculate_symbol_signal(self, symbol, event):
+        '''
+        Returns 'LONG' or 'EXIT' when the slope of the symbol's trend crosses the entry threshold
+        '''
+        prices = self.bars.get_latest_bars_values(symbol, 'Adj_Close', self.window)
+        if len(prices) < self.window or np.isnan(prices).any():
+            return None
+
+        coef = np.linalg.lstsq(self.design, np.log(prices), rcond = None)[0]
+        # the derivative of the polynomial at x = 1, the latest bar
+        slope = np.polyval(np.polyder(coef), 1.0)
+
+        if slope > self.entry_slope and not self.bought[symbol]:
+            self.bought[symbol] = True
+            return 'LONG'
+        if slope < -self.entry_slope and self.bought[symbol]:
+            self.bought[symbol] = False
+            return 'EXIT'
+        return None
+
+
+def run(csv_dir, symbol_list, workers = None):
+    '''
+    Runs the strategy over the symbols and returns the Backtest
+
+    Parameters:
+    csv_dir - The directory of the symbols' csv files
+    symbol_list - The symbols
+    workers - (Optional) The number of threads the symbols are evaluated on
+    '''
+    backtest = Backtest(
+        csv_dir = csv_dir,
+        symbol_list = symbol_list,
+        initial_capital = 1000000.0,
+        heartbeat = 0.0,
+        start_date = datetime.datetime(2017, 1, 1, 0, 0, 0),
+        data_handler = AlphaVantage_HistoricCSVDataHandler,
+        execution_handler = SimulatedExecutionHandler,
+        portfolio = Portfolio,
+        strategy = TrendFitStrategy,
+        external_data_dir = None,
+        strategy_title = 'Trend Fit Strategy',
+        strategy_params = {'workers': workers}
+    )
+    backtest.simulate_trading()
+    return backtest
+
+
+if __name__ == '__main__':
+    csv_dir = 'Data'
+    symbol_list = sorted(f[:-4] for f in os.listdir(csv_dir) if f.endswith('.csv') and not f.startswith(('Biotech', 'ATVI')))
+
+    # evaluating the symbols on a thread pool must give the same run as evaluating them one by one
+    serial = run(csv_dir, symbol_list)
+    parallel = run(csv_dir, symbol_list, workers = 4)
+
+    assert serial.signals == parallel.signals, 'signals differ: %s != %s' % (serial.signals, parallel.signals)
+    assert serial.fills == parallel.fills, 'fills differ: %s != %s' % (serial.fills, parallel.fills)
+    assert serial.portfolio.equity_curve['total'].equals(parallel.portfolio.equity_curve['total']), 'equity curves differ'
+    print('workers = 4 matches the serial run: %s signals, final equity %.2f' % (
+        parallel.signals, parallel.portfolio.current_holdings['total']
+    ))
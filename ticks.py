@@ -0,0 +1,357 @@
+# ticks.py
+
+# Bars built from raw trade or quote files. The files are read a chunk at a time and each chunk is reduced to
+# bars with numpy group reductions (np.maximum.reduceat etc.) over the runs of ticks that share a bar, so the
+# memory used depends on the chunk size and not on the number of ticks. The bar still open at the end of a
+# chunk is carried over to the next one as a running aggregate.
+#
+# Bars can be cut by time (e.g. every minute), by traded volume or by traded value (dollar bars), and come out
+# in the columns of data.BAR_COLUMNS. TickBarDataHandler feeds them into the DataHandler interface, optionally
+# caching them as bar csv files.
+
+from __future__ import print_function
+
+from abc import ABCMeta, abstractmethod
+import hashlib
+import os, os.path
+
+import numpy as np
+import pandas as pd
+
+from data import BAR_COLUMNS, HistoricCSVDataHandler, read_bar_csv
+from resample import Timeframe
+
+BAR_VERSION = 2 # changed whenever the bars built from the same ticks change, so cached bars are rebuilt
+
+
+def read_ticks(path, chunksize = 1000000, kind = 'trades', timestamp_column = 'timestamp', price_column = 'price',
+               size_column = 'size', bid_column = 'bid', ask_column = 'ask'):
+    '''
+    Reads a csv file of ticks in time order, a chunk at a time
+
+    Parameters:
+    path - The csv file
+    chunksize - The number of ticks per chunk
+    kind - 'trades' for a file of trade prices and sizes, 'quotes' for a file of bids and asks (whose ticks get
+           the mid price and a size of 0)
+    timestamp_column, price_column, size_column, bid_column, ask_column - The names of the columns
+
+    Yields:
+    (timestamps, prices, sizes) arrays, the timestamps as int64 nanoseconds since the epoch
+    '''
+    if kind == 'trades':
+        usecols = [timestamp_column, price_column, size_column]
+    elif kind == 'quotes':
+        usecols = [timestamp_column, bid_column, ask_column]
+    else:
+        raise ValueError('Unknown kind of tick file %r' % kind)
+
+    last = None
+    for chunk in pd.read_csv(path, usecols = usecols, chunksize = chunksize):
+        timestamps = pd.to_datetime(chunk[timestamp_column]).values.astype('datetime64[ns]').view(np.int64)
+        if len(timestamps) and (np.any(np.diff(timestamps) < 0) or (last is not None and timestamps[0] < last)):
+            raise ValueError('The ticks of %s are not in time order' % path)
+        if len(timestamps):
+            last = timestamps[-1]
+
+        if kind == 'trades':
+            prices = chunk[price_column].values.astype(np.float64)
+            sizes = chunk[size_column].values.astype(np.float64)
+        else:
+            prices = 0.5 * (chunk[bid_column].values.astype(np.float64) + chunk[ask_column].values.astype(np.float64))
+            sizes = np.zeros(len(prices))
+        yield timestamps, prices, sizes
+
+
+class BarAggregator(object):
+    '''
+    Turns chunks of ticks into bars. Subclasses assign the ticks to bars by returning a non-decreasing bar key
+    per tick from _keys(); a run of equal keys is one bar.
+
+    Bars are returned as dicts of arrays: datetime (int64 nanoseconds), open, high, low, close, volume, dollar
+    volume and the number of ticks.
+    '''
+
+    __metaclass__ = ABCMeta
+
+    _FIELDS = ('datetime', 'open', 'high', 'low', 'close', 'volume', 'dollar_volume', 'ticks')
+
+    def __init__(self):
+        self._partial = None # the bar still open at the end of the last chunk, as a dict of scalars
+
+    @abstractmethod
+    def _keys(self, timestamps, prices, sizes):
+        '''
+        Returns the int64 bar key of every tick of the chunk
+        '''
+        raise NotImplementedError('Should implement _keys()')
+
+    def _label(self, key, first_timestamp, last_timestamp):
+        '''
+        Returns the datetime a bar is labelled with, by default the time of its last tick
+        '''
+        return last_timestamp
+
+    def _is_complete(self, key, bar):
+        '''
+        Returns whether the last bar of a chunk is complete, i.e. no later tick can belong to it
+        '''
+        return False
+
+    def _empty(self):
+        return dict((f, np.empty(0, dtype = np.int64 if f in ('datetime', 'ticks') else np.float64)) for f in self._FIELDS)
+
+    def update(self, timestamps, prices, sizes):
+        '''
+        Adds a chunk of ticks, returning the bars it completed
+        '''
+        if not len(timestamps):
+            return self._empty()
+
+        keys = self._keys(timestamps, prices, sizes)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+        ends = np.concatenate((starts[1:], [len(keys)]))
+
+        bars = {
+            'key': keys[starts],
+            'first': timestamps[starts],
+            'datetime': timestamps[ends - 1],
+            'open': prices[starts],
+            'high': np.maximum.reduceat(prices, starts),
+            'low': np.minimum.reduceat(prices, starts),
+            'close': prices[ends - 1],
+            'volume': np.add.reduceat(sizes, starts),
+            'dollar_volume': np.add.reduceat(prices * sizes, starts),
+            'ticks': ends - starts,
+        }
+
+        # the first run may continue the bar carried over from the last chunk
+        carried = None
+        partial = self._partial
+        if partial is not None:
+            if partial['key'] == bars['key'][0]:
+                bars['first'][0] = partial['first']
+                bars['open'][0] = partial['open']
+                bars['high'][0] = max(partial['high'], bars['high'][0])
+                bars['low'][0] = min(partial['low'], bars['low'][0])
+                bars['volume'][0] += partial['volume']
+                bars['dollar_volume'][0] += partial['dollar_volume']
+                bars['ticks'][0] += partial['ticks']
+            else:
+                carried = partial
+
+        # and the last run is carried over to the next chunk unless nothing more can be added to it
+        last = dict((f, v[-1]) for f, v in bars.items())
+        if self._is_complete(last['key'], last):
+            self._partial = None
+            n = len(starts)
+        else:
+            self._partial = last
+            n = len(starts) - 1
+
+        out = dict((f, bars[f][:n]) for f in bars)
+        if carried is not None:
+            out = dict((f, np.concatenate(([carried[f]], out[f]))) for f in out)
+        return self._finish(out)
+
+    def flush(self):
+        '''
+        Returns the bar still open, as the data has ended
+        '''
+        partial, self._partial = self._partial, None
+        if partial is None:
+            return self._empty()
+        return self._finish(dict((f, np.array([v])) for f, v in partial.items()))
+
+    def _finish(self, bars):
+        labels = np.array([
+            self._label(k, f, l) for k, f, l in zip(bars['key'], bars['first'], bars['datetime'])
+        ], dtype = np.int64)
+        out = dict((f, bars[f]) for f in self._FIELDS)
+        out['datetime'] = labels
+        return out
+
+
+class TimeBars(BarAggregator):
+    '''
+    Bars over fixed periods, e.g. '1min' or '1h', labelled with the start of the period (periods without ticks
+    have no bar)
+    '''
+
+    def __init__(self, timeframe):
+        super(TimeBars, self).__init__()
+        self.timeframe = timeframe if isinstance(timeframe, Timeframe) else Timeframe(timeframe)
+
+    def _keys(self, timestamps, prices, sizes):
+        shifted = timestamps - self.timeframe.origin
+        return shifted - shifted % self.timeframe.nanos + self.timeframe.origin
+
+    def _label(self, key, first_timestamp, last_timestamp):
+        return key
+
+
+class VolumeBars(BarAggregator):
+    '''
+    Bars of (at least) threshold traded units each: a bar closes with the tick that takes its volume to the
+    threshold, so ticks aren't split between bars, and the next bar starts from zero. Labelled with the time of
+    their last tick
+    '''
+
+    def __init__(self, threshold):
+        super(VolumeBars, self).__init__()
+        self.threshold = float(threshold)
+        self._bar = 0 # the key of the bar still open
+        self._open_total = 0.0 # the measure traded in it in earlier chunks
+
+    def _measure(self, prices, sizes):
+        return sizes
+
+    def _keys(self, timestamps, prices, sizes):
+        cumulative = np.cumsum(self._measure(prices, sizes))
+
+        # the ticks that close a bar, each found with a binary search from the one before; the loop runs once
+        # per bar, not per tick
+        ends = []
+        target = self.threshold - self._open_total
+        while True:
+            end = np.searchsorted(cumulative, target, side = 'left')
+            if end == len(cumulative):
+                break
+            ends.append(end)
+            target = cumulative[end] + self.threshold
+
+        if ends:
+            self._open_total = cumulative[-1] - cumulative[ends[-1]]
+        else:
+            self._open_total += cumulative[-1]
+        # a tick belongs to the bar after the ones closed before it
+        keys = self._bar + np.searchsorted(np.array(ends, dtype = np.int64), np.arange(len(cumulative)), side = 'left')
+        self._bar += len(ends)
+        return keys.astype(np.int64)
+
+    def _is_complete(self, key, bar):
+        return key < self._bar
+
+
+class DollarBars(VolumeBars):
+    '''
+    Bars of (at least) threshold traded value (price times size) each
+    '''
+
+    def _measure(self, prices, sizes):
+        return prices * sizes
+
+
+def make_bar_aggregator(bar_type, bar_size):
+    '''
+    Returns a new aggregator for bar_type 'time' (bar_size a timeframe spec), 'volume' or 'dollar' (bar_size
+    the threshold)
+    '''
+    if bar_type == 'time':
+        return TimeBars(bar_size)
+    if bar_type == 'volume':
+        return VolumeBars(bar_size)
+    if bar_type == 'dollar':
+        return DollarBars(bar_size)
+    raise ValueError('Unknown bar type %r' % bar_type)
+
+
+def aggregate_ticks(path, aggregator, chunksize = 1000000, **read_kwargs):
+    '''
+    Reads a tick file through an aggregator
+
+    Parameters:
+    path - The csv file of ticks
+    aggregator - A BarAggregator, e.g. TimeBars('1min')
+    chunksize - The number of ticks read at a time
+    read_kwargs - Passed to read_ticks(), e.g. kind = 'quotes' or the names of the columns
+
+    Returns:
+    A DataFrame of the bars with the columns of data.BAR_COLUMNS, indexed by price_date
+    '''
+    parts = []
+    for timestamps, prices, sizes in read_ticks(path, chunksize = chunksize, **read_kwargs):
+        parts.append(aggregator.update(timestamps, prices, sizes))
+    parts.append(aggregator.flush())
+
+    bars = dict((f, np.concatenate([p[f] for p in parts])) for f in BarAggregator._FIELDS)
+    frame = pd.DataFrame({
+        'open_price': bars['open'],
+        'high_price': bars['high'],
+        'low_price': bars['low'],
+        'close_price': bars['close'],
+        'adj_close_price': bars['close'],
+        'volume': bars['volume']
+    }, index = pd.DatetimeIndex(bars['datetime'].astype('datetime64[ns]'), name = 'price_date'))
+    return frame[BAR_COLUMNS[1:]]
+
+
+class TickBarDataHandler(HistoricCSVDataHandler):
+    '''
+    A HistoricCSVDataHandler whose bars are built from a tick file per symbol, <<symbol>>.csv in csv_dir.
+    Everything downstream (universe, timeframes, cross-sectional accessors) works as with bar files
+    '''
+
+    def __init__(self, events, csv_dir, symbol_list, bar_type = 'time', bar_size = '1min', cache_dir = None,
+                 chunksize = 1000000, universe = None, **read_kwargs):
+        '''
+        Parameters:
+        events - The Event Queue
+        csv_dir - The directory of the tick files
+        symbol_list - A list of symbol strings
+        bar_type - 'time', 'volume' or 'dollar'
+        bar_size - A timeframe spec for time bars (e.g. '5min'), the units or value per bar otherwise
+        cache_dir - (Optional) A directory the bars are saved to as bar csv files, and reused from while the
+                    tick file and the bar settings are unchanged
+        chunksize - The number of ticks read at a time
+        universe - (Optional) A Universe; if given, bars are only pushed for its active symbols
+        read_kwargs - Passed to read_ticks(), e.g. kind = 'quotes' or the names of the columns
+        '''
+        self.bar_type = bar_type
+        self.bar_size = bar_size
+        self.cache_dir = cache_dir
+        self.chunksize = chunksize
+        self.read_kwargs = read_kwargs
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        super(TickBarDataHandler, self).__init__(events, csv_dir, symbol_list, universe = universe)
+
+    def _data_path(self, symbol):
+        return os.path.join(self.csv_dir, '%s.csv' % symbol)
+
+    def _fingerprint(self, symbol):
+        '''
+        Identifies the bars of a symbol by its tick file's size and modification time and the bar settings
+        '''
+        stat = os.stat(self._data_path(symbol))
+        settings = (
+            stat.st_size, int(stat.st_mtime * 1e6), self.bar_type, self.bar_size, sorted(self.read_kwargs.items()),
+            BAR_VERSION
+        )
+        return hashlib.sha1(repr(settings).encode('utf-8')).hexdigest()
+
+    def _read_symbol_frame(self, symbol):
+        '''
+        Returns the bars of a symbol, from the cache if they are there
+        '''
+        cache_path = None
+        if self.cache_dir is not None:
+            cache_path = os.path.join(self.cache_dir, '%s-%s.csv' % (symbol, self._fingerprint(symbol)[:16]))
+            if os.path.exists(cache_path):
+                return read_bar_csv(cache_path)
+
+        bars = aggregate_ticks(
+            self._data_path(symbol), make_bar_aggregator(self.bar_type, self.bar_size),
+            chunksize = self.chunksize, **self.read_kwargs
+        )
+        if cache_path is not None:
+            tmp_path = cache_path + '.tmp'
+            bars.to_csv(tmp_path)
+            os.replace(tmp_path, cache_path)
+        return bars
+
+    def _data_version(self, symbol, index):
+        if len(index) == 0:
+            return '%s-0' % self._fingerprint(symbol)
+        return '%s-%d-%s-%s' % (self._fingerprint(symbol), len(index), index[0], index[-1])
@@ -0,0 +1,239 @@
+# tracer.py
+
+# A timeline tracer for the event loop. Where the journal records what happened, the tracer records when: begin
+# and end timestamps of every bar, every event handled and every component call, on every thread, so a stall can
+# be pinned on the component (or the IB connection) it happened in. Spans are appended to a fixed-size ring
+# buffer, which keeps the latest ones, and exported in the Chrome trace-event JSON format that Perfetto
+# (ui.perfetto.dev) and chrome://tracing open. Only one bar in sample_every is traced, so the tracer can be left
+# on in production; the default tracer is a NullTracer that traces nothing.
+
+from __future__ import print_function
+
+import collections
+import json
+import os
+import threading
+import time
+
+
+class _NullSpan(object):
+    '''
+    The context manager of a span that isn't traced
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullTracer(object):
+    '''
+    A tracer that traces nothing. This is the default so that components can always call their tracer; the
+    event loop calls sample() once per bar and wraps its calls in span(), which never records anything here
+    '''
+
+    sampling = False
+
+    def sample(self):
+        return False
+
+    def begin(self, name, cat, args = None):
+        pass
+
+    def end(self, name, cat):
+        pass
+
+    def instant(self, name, cat, args = None):
+        pass
+
+    def span(self, name, cat, args = None):
+        return _NULL_SPAN
+
+    def export(self, path = None):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Span(object):
+    '''
+    The context manager of a traced span. Its end is recorded even if sampling was turned off in the meantime
+    (e.g. by the event loop moving on to the next bar while another thread was in the span)
+    '''
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.tracer._record('B', self.name, self.cat, self.args)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer._record('E', self.name, self.cat, None)
+        return False
+
+
+class Tracer(NullTracer):
+    '''
+    Records begin/end spans into a ring buffer and exports them as Chrome trace-event JSON.
+
+    The event loop calls sample() at the start of every bar; it turns sampling on for one bar in sample_every, and
+    begin(), end(), instant() and span() record nothing while it's off. Components on other threads (e.g. the IB
+    connection's) are traced while the bar they run during is sampled. Appending to the buffer is atomic, so
+    no lock is taken on the hot path
+    '''
+
+    def __init__(self, path = None, capacity = 100000, sample_every = 1):
+        '''
+        Parameters:
+        path - (Optional) The JSON file close() exports the trace to
+        capacity - The number of span records kept; the oldest are dropped first
+        sample_every - Trace one bar in this many (1 traces every bar)
+        '''
+        self.path = path
+        self.capacity = capacity
+        self.sample_every = sample_every
+
+        self.sampling = False
+        self.n_bars = 0
+        self._buffer = collections.deque(maxlen = capacity)
+        self._threads = {}
+        self._clock = time.perf_counter
+        self._origin = self._clock()
+        self._pid = os.getpid()
+
+    def sample(self):
+        '''
+        Called by the event loop at the start of every bar. Returns whether the bar is traced
+        '''
+        self.sampling = self.n_bars % self.sample_every == 0
+        self.n_bars += 1
+        return self.sampling
+
+    def _thread(self):
+        ident = threading.get_ident()
+        if ident not in self._threads:
+            self._threads[ident] = threading.current_thread().name
+        return ident
+
+    def _record(self, ph, name, cat, args):
+        self._buffer.append((ph, name, cat, self._clock(), self._thread(), args))
+
+    def begin(self, name, cat, args = None):
+        '''
+        Opens a span on the current thread
+
+        Parameters:
+        name - The name of the span, e.g. 'Portfolio.update_fill'
+        cat - The category it is shown and filtered under, e.g. 'portfolio'
+        args - (Optional) A dict of JSON values shown with the span
+        '''
+        if self.sampling:
+            self._buffer.append(('B', name, cat, self._clock(), self._thread(), args))
+
+    def end(self, name, cat):
+        '''
+        Closes the span the current thread opened last
+        '''
+        if self.sampling:
+            self._buffer.append(('E', name, cat, self._clock(), self._thread(), None))
+
+    def instant(self, name, cat, args = None):
+        '''
+        Records a point in time, e.g. an error message
+        '''
+        if self.sampling:
+            self._buffer.append(('i', name, cat, self._clock(), self._thread(), args))
+
+    def span(self, name, cat, args = None):
+        '''
+        Returns a context manager that opens a span on entry and closes it on exit. While sampling is off this
+        is a shared no-op context manager, so an untraced span costs a call and an attribute check
+        '''
+        if not self.sampling:
+            return _NULL_SPAN
+        return _Span(self, name, cat, args)
+
+    def trace_events(self):
+        '''
+        Returns the buffered spans as a list of Chrome trace events. The ends of spans whose begin has been
+        dropped from the ring buffer are left out
+        '''
+        events = []
+        depth = collections.defaultdict(int)
+        for ph, name, cat, ts, tid, args in list(self._buffer):
+            if ph == 'B':
+                depth[tid] += 1
+            elif ph == 'E':
+                if depth[tid] == 0:
+                    continue
+                depth[tid] -= 1
+            event = {
+                'name': name, 'cat': cat, 'ph': ph, 'ts': (ts - self._origin) * 1e6, 'pid': self._pid, 'tid': tid
+            }
+            if ph == 'i':
+                event['s'] = 't'
+            if args:
+                event['args'] = args
+            events.append(event)
+
+        for tid, thread_name in list(self._threads.items()):
+            events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid, 'args': {'name': thread_name}
+            })
+        return events
+
+    def export(self, path = None):
+        '''
+        Writes the buffered spans to a Chrome trace-event JSON file. Can be called during a run
+
+        Parameters:
+        path - (Optional) The file, defaults to the tracer's path
+        '''
+        path = path or self.path
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, f, default = str)
+
+    def __getstate__(self):
+        '''
+        A checkpointed tracer keeps its settings but not the spans
+        '''
+        return {'path': self.path, 'capacity': self.capacity, 'sample_every': self.sample_every}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['capacity'], state['sample_every'])
+
+    def close(self):
+        '''
+        Exports the trace to the tracer's path, if it has one
+        '''
+        if self.path is not None:
+            self.export()
+
+
+_tracer = NullTracer()
+
+
+def get_tracer():
+    '''
+    Returns the tracer components should trace to (a NullTracer unless set_tracer() was called)
+    '''
+    return _tracer
+
+
+def set_tracer(tracer):
+    '''
+    Sets the tracer returned by get_tracer(). Passing None restores the NullTracer
+    '''
+    global _tracer
+    _tracer = tracer if tracer is not None else NullTracer()
+    return _tracer
@@ -0,0 +1,262 @@
+# universe.py
+
+# The set of symbols a backtest trades on each bar. A symbol is listed between the first and last dates of its
+# own data, so recent IPOs join the universe when they start trading and delisted names leave it, instead of
+# being padded forward over the whole timeline. Screens (price, volume, liquidity) can narrow the listed
+# symbols further; they are re-run on a schedule rather than every bar. Data handlers given a Universe only
+# push bars for its active symbols.
+
+from __future__ import print_function
+
+from abc import ABCMeta, abstractmethod
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from journal import get_journal
+
+
+class ListingWindow(object):
+    '''
+    The first and last dates a symbol has data for
+    '''
+
+    def __init__(self, symbol, first, last):
+        self.symbol = symbol
+        self.first = pd.Timestamp(first)
+        self.last = pd.Timestamp(last)
+
+    def is_listed(self, dt):
+        return self.first <= pd.Timestamp(dt) <= self.last
+
+    def __repr__(self):
+        return 'ListingWindow(%s, %s, %s)' % (self.symbol, self.first.date(), self.last.date())
+
+
+def listing_windows(frames):
+    '''
+    Returns a dict of symbol -> ListingWindow spanning the dates of each symbol's own (not reindexed) DataFrame.
+    Symbols without any rows are left out
+
+    Parameters:
+    frames - A dict of symbol -> DataFrame indexed by date
+    '''
+    windows = {}
+    for s, frame in frames.items():
+        index = frame.index.dropna()
+        if len(index):
+            windows[s] = ListingWindow(s, index.min(), index.max())
+    return windows
+
+
+class Screen(object):
+    '''
+    A filter of the listed symbols, run by a Universe on its schedule. Screens read the data handler's
+    (dates x symbols) matrices, so they see the symbols that are currently screened out too
+    '''
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def passes(self, bars):
+        '''
+        Returns a boolean array over bars.symbol_list of the symbols that pass the screen as of the latest bar
+        '''
+        raise NotImplementedError('Should implement passes()')
+
+
+class PriceScreen(Screen):
+    '''
+    Passes the symbols whose latest price is within [min_price, max_price]
+    '''
+
+    def __init__(self, min_price = None, max_price = None, field = 'Adj_Close'):
+        '''
+        Parameters:
+        min_price - (Optional) The lowest price passed
+        max_price - (Optional) The highest price passed
+        field - The price field of the bars
+        '''
+        self.min_price = min_price
+        self.max_price = max_price
+        self.field = field
+
+    def passes(self, bars):
+        price = bars.get_latest_bars_matrix(self.field, 1)[-1]
+        passed = ~np.isnan(price)
+        with np.errstate(invalid = 'ignore'):
+            if self.min_price is not None:
+                passed &= price >= self.min_price
+            if self.max_price is not None:
+                passed &= price <= self.max_price
+        return passed
+
+    def __repr__(self):
+        return 'PriceScreen(%r, %r, %r)' % (self.min_price, self.max_price, self.field)
+
+
+class VolumeScreen(Screen):
+    '''
+    Passes the symbols whose average volume over the last window bars is at least min_volume
+    '''
+
+    def __init__(self, min_volume, window = 20, field = 'volume'):
+        '''
+        Parameters:
+        min_volume - The lowest average volume passed
+        window - The number of bars averaged over
+        field - The volume field of the bars
+        '''
+        self.min_volume = min_volume
+        self.window = window
+        self.field = field
+
+    def _average(self, values):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category = RuntimeWarning) # symbols without data in the window
+            return np.nanmean(values, axis = 0)
+
+    def passes(self, bars):
+        volume = self._average(bars.get_latest_bars_matrix(self.field, self.window))
+        with np.errstate(invalid = 'ignore'):
+            return volume >= self.min_volume
+
+    def __repr__(self):
+        return 'VolumeScreen(%r, %r, %r)' % (self.min_volume, self.window, self.field)
+
+
+class DollarVolumeScreen(VolumeScreen):
+    '''
+    Passes the symbols whose average price times volume over the last window bars is at least min_dollar_volume
+    '''
+
+    def __init__(self, min_dollar_volume, window = 20, price_field = 'adj_close_price', volume_field = 'volume'):
+        '''
+        Parameters:
+        min_dollar_volume - The lowest average dollar volume passed
+        window - The number of bars averaged over
+        price_field - The price field of the bars
+        volume_field - The volume field of the bars
+        '''
+        super(DollarVolumeScreen, self).__init__(min_dollar_volume, window, volume_field)
+        self.price_field = price_field
+
+    def passes(self, bars):
+        price = bars.get_latest_bars_matrix(self.price_field, self.window)
+        volume = bars.get_latest_bars_matrix(self.field, self.window)
+        dollar_volume = self._average(price * volume)
+        with np.errstate(invalid = 'ignore'):
+            return dollar_volume >= self.min_volume
+
+    def __repr__(self):
+        return 'DollarVolumeScreen(%r, %r, %r, %r)' % (self.min_volume, self.window, self.price_field, self.field)
+
+
+class Universe(object):
+    '''
+    Tracks which symbols of a data handler are active on the current bar: listed, and passing every screen as
+    of the last screening. The screens are run on the first bar, every screen_every bars after that, and
+    whenever a symbol gets listed.
+
+    active is a boolean array over the handler's symbol_list and active_symbols the list of active symbols;
+    added and removed are the symbols that joined and left the active set on the current bar.
+    '''
+
+    def __init__(self, screens = None, screen_every = 21):
+        '''
+        Parameters:
+        screens - (Optional) A list of Screen objects
+        screen_every - The number of bars between screenings
+        '''
+        self.screens = list(screens or [])
+        self.screen_every = screen_every
+
+        self.symbol_list = []
+        self.listings = {}
+        self.active = np.zeros(0, dtype = bool)
+        self.active_symbols = []
+        self.added = []
+        self.removed = []
+        self.n_updates = 0
+
+        self.journal = get_journal()
+
+    def bind(self, symbol_list, listings):
+        '''
+        Called by the data handler once its data is loaded
+
+        Parameters:
+        symbol_list - The handler's list of symbols
+        listings - A dict of symbol -> ListingWindow. Symbols without one are never active
+        '''
+        self.symbol_list = list(symbol_list)
+        self.relist(listings)
+
+        n = len(self.symbol_list)
+        self.listed = np.zeros(n, dtype = bool)
+        self.screened = np.ones(n, dtype = bool)
+        self.active = np.zeros(n, dtype = bool)
+        self.active_symbols = []
+        self._active_set = set()
+        self.n_updates = 0
+
+    def relist(self, listings):
+        '''
+        Replaces the listing windows (e.g. once more data has been appended), keeping the rest of the state
+        '''
+        self.listings = listings
+        missing = np.datetime64('NaT', 'ns')
+        self._first = np.array([
+            listings[s].first.to_datetime64() if s in listings else missing for s in self.symbol_list
+        ], dtype = 'datetime64[ns]')
+        self._last = np.array([
+            listings[s].last.to_datetime64() if s in listings else missing for s in self.symbol_list
+        ], dtype = 'datetime64[ns]')
+
+    def update(self, bars, dt):
+        '''
+        Recomputes the active symbols for the bar at dt, screening them if one is due. Called by the data handler
+        after it has moved on to dt but before it pushes the bars
+
+        Parameters:
+        bars - The data handler
+        dt - The datetime of the bar
+
+        Returns:
+        The list of active symbols
+        '''
+        now = pd.Timestamp(dt).to_datetime64()
+        listed = (self._first <= now) & (now <= self._last)
+
+        if self.screens and (self.n_updates % self.screen_every == 0 or (listed & ~self.listed).any()):
+            screened = listed.copy()
+            for screen in self.screens:
+                screened &= screen.passes(bars)
+            self.screened = screened
+        self.listed = listed
+        self.n_updates += 1
+
+        active = listed & self.screened
+        changed = np.flatnonzero(active != self.active)
+        self.added = [self.symbol_list[i] for i in changed if active[i]]
+        self.removed = [self.symbol_list[i] for i in changed if not active[i]]
+        if len(changed):
+            self.active_symbols = [s for s, a in zip(self.symbol_list, active) if a]
+            self._active_set = set(self.active_symbols)
+            self.journal.debug('UNIVERSE', date = dt, added = self.added, removed = self.removed)
+        self.active = active
+        return self.active_symbols
+
+    def is_active(self, symbol):
+        return symbol in self._active_set
+
+    def cache_key(self):
+        '''
+        Returns a string identifying which bars the Universe lets through (its screens and schedule), for the
+        keys of cached results computed from them. None if a screen has no repr of its own to tell it apart
+        '''
+        for screen in self.screens:
+            if type(screen).__repr__ is object.__repr__:
+                return None
+        return 'Universe(%r, %r)' % (self.screens, self.screen_every)